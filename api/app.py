@@ -1,22 +1,75 @@
 import json
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import partial
+from typing import AsyncIterator, Optional
 
+import numpy as np
 import pandas as pd
 import yfinance
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from loguru import logger
 
-from src.data import ticker_pipe
-from src.model import load_model
-from src.pipeline.calculate_features import WINDOW_LENGTHS, calculate_features
+from api.concurrency import BlockingExecutor, SingleFlight
+from api.history_cache import PriceHistoryCache
+from api.model_store import ModelStore
+from api.snapshot_store import SnapshotStore
+from src.data import DT_FMT, ValidationMode, ticker_pipe
+from src.feature_state import FeatureStateStore, SymbolState
+from src.features import FeaturePlan, calculate_features
+from src.pipeline.calculate_features import load_feature_spec
+from src.snapshot import FeatureSnapshot
 
 MODEL_PATH = "models/model.dill"
+FOREST_PATH = "models/forest"
+# Streaming feature states, saved on shutdown and restored on startup
+FEATURE_STATE_PATH = "data/api/feature_state.npz"
+# Tickers whose feature states are kept, least recently requested ones are evicted
+FEATURE_STATE_CAPACITY = 5000
+# Latest features of symbols processed by the pipeline, written by snapshot stage
+SNAPSHOT_PATH = "data/snapshot"
 LOOKBACK_WINDOW = 365
+# Upper bound on threads running blocking work, i.e. upstream downloads and model inference
+BLOCKING_WORKERS = 8
+# Validation of downloaded history is on the request path, so keep it cheap
+VALIDATION_MODE = ValidationMode.FAST
+# Same features as computed by features stage, from its config
+FEATURE_SPEC = load_feature_spec()
+FEATURE_PLAN = FeaturePlan.from_spec(**FEATURE_SPEC)
+
+model_store = ModelStore(MODEL_PATH, forest_path=FOREST_PATH)
+history_cache = PriceHistoryCache(partial(ticker_pipe, validation_mode=VALIDATION_MODE))
+feature_state = FeatureStateStore(FEATURE_PLAN, capacity=FEATURE_STATE_CAPACITY)
+snapshot_store = SnapshotStore(SNAPSHOT_PATH)
+executor = BlockingExecutor(BLOCKING_WORKERS)
+# Identical requests in flight at the same time share a single upstream call
+single_flight = SingleFlight()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    try:
+        model_store.get()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.warning(f"Model not loaded on startup: {e}")
+    try:
+        feature_state.restore(FEATURE_STATE_PATH)
+        logger.info(f"Restored feature states of {len(feature_state)} tickers")
+    except FileNotFoundError:
+        pass
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.warning(f"Feature states not restored: {e}")
+    yield
+    try:
+        feature_state.save(FEATURE_STATE_PATH)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logger.warning(f"Feature states not saved: {e}")
+
 
 # run using uvicorn api.app:app --reload
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -25,37 +78,80 @@ def index():
 
 
 @app.post("/features")
-def get_current_features_for_ticker(ticker: str) -> JSONResponse:
+async def get_current_features_for_ticker(ticker: str) -> JSONResponse:
     try:
-        logger.info(f"Getting features for ticker: {ticker}")
-        end_date = datetime.now()
-        start_date = (end_date - timedelta(days=LOOKBACK_WINDOW)).strftime("%F")
-        return (
-            ticker_pipe([ticker.upper()], start_date, end_date.strftime("%F"))
-            .pipe(calculate_features, window_lengths=WINDOW_LENGTHS)
-            .loc[lambda x: x["Date"] == x["Date"].max()]
-            .to_json(orient="records")
+        ticker = ticker.upper()
+        return await single_flight.do(
+            ("features", ticker), lambda: executor.run(_current_features, ticker)
         )
     except Exception as e:
         return JSONResponse(content={"err": str(e)})
 
 
+def _current_features(ticker: str) -> str:
+    logger.info(f"Getting features for ticker: {ticker}")
+    hit = _snapshot_row(ticker)
+    if hit is not None:
+        snapshot, row = hit
+        return f"[{snapshot.record(row)}]"
+    state = _latest_state(ticker)
+    return state.record if state is not None else "[]"
+
+
+def _snapshot_row(ticker: str) -> Optional[tuple[FeatureSnapshot, int]]:
+    """Row of ticker in feature snapshot, if the snapshot holds features computed the same way
+    and the row is of the last closed trading day, otherwise features are computed live"""
+    snapshot = snapshot_store.get()
+    if snapshot is None or snapshot.columns != list(FEATURE_PLAN.features):
+        return None
+    row = snapshot.find(ticker)
+    last_closed = np.busday_offset(np.datetime64(datetime.now().date()), -1, roll="forward")
+    if row is None or snapshot.dates[row] < last_closed:
+        return None
+    return snapshot, row
+
+
+def _latest_state(ticker: str) -> Optional[SymbolState]:
+    """Feature state of ticker, updated with bars after the last one it has seen. Ticker without
+    state is initialized from history of the lookback window, same as the features would be
+    calculated from it, so only new bars are downloaded after that. Range without business
+    days, e.g. a weekend, is not downloaded, and the existing state is returned.
+
+    Bars already seen are not checked again, as neither the state nor the history cache
+    download them again. So if a ticker's history is revised, e.g. adjusted for a split, its
+    features keep building on the old prices until its state and cached history are evicted.
+    Tickers processed by the pipeline are served from the nightly snapshot instead, which is
+    computed from whole history again."""
+    end_date = datetime.now().strftime("%F")
+    state = feature_state.get(ticker)
+    if state is None:
+        start_date = (datetime.now() - timedelta(days=LOOKBACK_WINDOW)).strftime("%F")
+    else:
+        start_date = (pd.Timestamp(state.date) + timedelta(days=1)).strftime(DT_FMT)
+    if np.busday_count(start_date, end_date) > 0:
+        history = history_cache.get(ticker, start_date, end_date)
+        if not history.empty:
+            feature_state.update(history)
+    return feature_state.get(ticker)
+
+
 @dataclass
 class Result:
     probability: float
+    model_version: str
 
 
 @app.post("/predict")
-def predict(features: str) -> JSONResponse:
+async def predict(features: str) -> JSONResponse:
     try:
-        logger.info(f"Loading model {MODEL_PATH}")
-        model = load_model(MODEL_PATH)
+        # Model may be reloaded from disk, so not on the event loop
+        loaded = await executor.run(model_store.get)
 
         feature_dict = json.loads(features)
         features_df = pd.DataFrame.from_dict(feature_dict)
 
-        pred = float(model.predict_proba(features_df)[0:, 1])
-        res = Result(probability=pred)
+        pred = float((await executor.run(loaded.model.predict_proba, features_df))[0:, 1])
+        res = Result(probability=pred, model_version=loaded.version)
         logger.info(f"Predicted probability: {res}")
         return JSONResponse(content=json.dumps(res.__dict__))
 
@@ -63,12 +159,116 @@ def predict(features: str) -> JSONResponse:
         return JSONResponse(content={"err": str(e)})
 
 
+@app.post("/predict/batch")
+async def predict_batch(tickers: list[str]) -> JSONResponse:
+    try:
+        return JSONResponse(content=await executor.run(_predict_batch, tickers))
+    except Exception as e:
+        return JSONResponse(content={"err": str(e)})
+
+
+def _predict_batch(tickers: list[str]) -> dict:
+    """Score many tickers at once: histories are fetched together, features calculated over
+    combined frame and model invoked once, returning errors of tickers that couldn't be scored"""
+    logger.info(f"Predicting batch of {len(tickers)} tickers")
+    loaded = model_store.get()
+    tickers = [ticker.upper() for ticker in tickers]
+    end_date = datetime.now()
+    start_date = (end_date - timedelta(days=LOOKBACK_WINDOW)).strftime("%F")
+    history, errors = history_cache.get_many(tickers, start_date, end_date.strftime("%F"))
+
+    features = list(FEATURE_PLAN.features)
+    latest = (
+        history.pipe(calculate_features, **FEATURE_SPEC)
+        .groupby("Symbol", observed=True)
+        .tail(1)
+        .loc[lambda x: x[features].notnull().all(axis=1)]
+    )
+    probabilities = loaded.model.predict_proba(latest)[:, 1] if len(latest) else []
+    predictions = dict(zip(latest["Symbol"].astype(str), map(float, probabilities)))
+    missing = {
+        ticker: "Not enough price history" for ticker in tickers if ticker not in predictions
+    }
+    return {
+        "model_version": loaded.version,
+        "predictions": predictions,
+        "errors": {**missing, **{ticker: str(e) for ticker, e in errors.items()}},
+    }
+
+
+@app.post("/score")
+async def score_ticker(ticker: str) -> JSONResponse:
+    try:
+        ticker = ticker.upper()
+        content = await single_flight.do(
+            ("score", ticker), lambda: executor.run(_score_ticker, ticker)
+        )
+        return JSONResponse(content=content)
+    except Exception as e:
+        return JSONResponse(content={"err": str(e)})
+
+
+def _score_ticker(ticker: str) -> dict:
+    """Validate ticker, get its latest features and predict, all in one call. Features and
+    prediction are taken from feature snapshot if it's up to date, otherwise feature state of
+    ticker is updated, reusing a single download of its new bars. Ticker metadata is only
+    looked up when download fails, to tell unknown ticker from other errors."""
+    logger.info(f"Scoring ticker: {ticker}")
+    hit = _snapshot_row(ticker)
+    if hit is not None:
+        snapshot, row = hit
+        record, features = f"[{snapshot.record(row)}]", snapshot.features[row]
+    else:
+        try:
+            state = _latest_state(ticker)
+        except Exception:
+            if _validate_ticker(ticker)["ticker"] == "Not found!":
+                return {"ticker": "Not found!"}
+            raise
+        if state is None:
+            return {"ticker": "Not found!"}
+        record, features = state.record, state.features
+
+    content = {"ticker": ticker, "features": json.loads(record)}
+    if np.isnan(features).any():
+        return {**content, "err": "Not enough price history"}
+
+    loaded = model_store.get()
+    if hit is not None and hit[0].model_version == loaded.version:
+        probability = float(hit[0].probability[hit[1]])
+    else:
+        latest = pd.DataFrame([features], columns=list(FEATURE_PLAN.features))
+        probability = float(loaded.model.predict_proba(latest)[0, 1])
+    return {**content, **Result(probability, loaded.version).__dict__}
+
+
 @app.post("/validate")
-def validate_ticker(ticker: str) -> JSONResponse:
+async def validate_ticker(ticker: str) -> JSONResponse:
     try:
-        if len(yfinance.Ticker(ticker).history_metadata) == 0:
-            return JSONResponse(content={"ticker": "Not found!"})
-        return JSONResponse(content={"ticker": ticker})
+        content = await single_flight.do(
+            ("validate", ticker), lambda: executor.run(_validate_ticker, ticker)
+        )
+        return JSONResponse(content=content)
+
+    except Exception as e:
+        return JSONResponse(content={"err": str(e)})
+
 
+def _validate_ticker(ticker: str) -> dict:
+    if len(yfinance.Ticker(ticker).history_metadata) == 0:
+        return {"ticker": "Not found!"}
+    return {"ticker": ticker}
+
+
+@app.get("/model")
+def get_model_version() -> JSONResponse:
+    try:
+        loaded = model_store.get()
+        return JSONResponse(content={"path": loaded.path, "version": loaded.version})
     except Exception as e:
         return JSONResponse(content={"err": str(e)})
+
+
+@app.get("/cache")
+def get_cache_stats() -> JSONResponse:
+    return JSONResponse(content=history_cache.info())
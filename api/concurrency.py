@@ -0,0 +1,54 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into a single execution, whose result or
+    error is shared by all callers waiting for it. Once it finishes, next call with the same
+    key executes again, so results are never served stale. If the executing caller is
+    cancelled, e.g. because its client disconnected, waiting callers execute again."""
+
+    def __init__(self) -> None:
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        while (future := self._in_flight.get(key)) is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Execute again if only the shared execution was cancelled, not this caller
+                task = asyncio.current_task()
+                if not future.cancelled() or task is None or task.cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark as retrieved, in case nobody else was waiting
+            raise
+        finally:
+            del self._in_flight[key]
+            # Cancelled or interrupted by other BaseException, so waiting callers don't hang
+            if not future.done():
+                future.cancel()
+
+
+class BlockingExecutor:
+    """Runs blocking calls, e.g. upstream downloads or model inference, on a bounded thread
+    pool, so they neither block the event loop nor spawn unlimited threads"""
+
+    def __init__(self, max_workers: int) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
@@ -0,0 +1,182 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, replace
+from datetime import timedelta
+from typing import Callable, Optional
+
+import pandas as pd
+from loguru import logger
+
+from src.data import DT_FMT, ticker_pipe
+
+EMPTY_HISTORY = pd.DataFrame(
+    {
+        "Date": pd.Series(dtype="datetime64[ns]"),
+        "Symbol": pd.Series(dtype="category"),
+        "Close": pd.Series(dtype="float32"),
+        "Volume": pd.Series(dtype="float32"),
+    }
+)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    evictions: int = 0
+
+
+@dataclass
+class _Entry:
+    df: pd.DataFrame
+    start_date: str
+    end_date: str
+    fetched_at: float
+    size: int
+    # Time of last failed refresh, which isn't retried until `retry_interval` passes
+    failed_at: Optional[float] = None
+
+
+class PriceHistoryCache:
+    """In-process LRU cache of price history per ticker, shaped like `ticker_pipe` output.
+
+    Entry younger than `ttl` seconds is served as is. Once it gets older, only bars after
+    its last cached date are fetched and appended, instead of downloading whole history again.
+    Least recently used tickers are evicted when total size of cached frames exceeds
+    `max_bytes`. Callers receive a copy, so they are free to modify it.
+
+    If refreshing an entry fails, it's served stale and the refresh isn't tried again for
+    `retry_interval` seconds, so that an upstream outage isn't hit by every request."""
+
+    def __init__(
+        self,
+        fetch: Callable[..., pd.DataFrame] = ticker_pipe,
+        max_bytes: int = 64 * 2**20,
+        ttl: float = 15 * 60,
+        retry_interval: float = 60,
+    ) -> None:
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ticker: str, start_date: str, end_date: str) -> pd.DataFrame:
+        df, errors = self.get_many([ticker], start_date, end_date)
+        if ticker in errors:
+            raise errors[ticker]
+        return df
+
+    def get_many(
+        self, tickers: list[str], start_date: str, end_date: str
+    ) -> tuple[pd.DataFrame, dict[str, Exception]]:
+        """Batch version of `get`, returning combined history of `tickers` together with errors
+        of tickers whose history couldn't be downloaded. Tickers that need downloading are
+        fetched together, one request per distinct range start, falling back to fetching them
+        one by one if a combined request fails. Failed refresh of cached ticker is only logged
+        and previously cached history is served."""
+        entries: dict[str, _Entry] = {}
+        ranges: dict[str, list[str]] = {}
+        with self._lock:
+            now = time.monotonic()
+            for ticker in dict.fromkeys(tickers):
+                entry = self._entries.get(ticker)
+                if entry is not None and entry.start_date <= start_date:
+                    self.stats.hits += 1
+                    entries[ticker] = entry
+                    expired = now - entry.fetched_at >= self.ttl
+                    backing_off = (
+                        entry.failed_at is not None and now - entry.failed_at < self.retry_interval
+                    )
+                    if (expired or entry.end_date < end_date) and not backing_off:
+                        self.stats.refreshes += 1
+                        ranges.setdefault(_next_start(entry), []).append(ticker)
+                else:
+                    self.stats.misses += 1
+                    ranges.setdefault(start_date, []).append(ticker)
+
+        errors: dict[str, Exception] = {}
+        for range_start, group in ranges.items():
+            fetched_at = time.monotonic()
+            new_dfs, group_errors = self._fetch(group, range_start, end_date)
+            for ticker in group:
+                old_df = entries[ticker].df if ticker in entries else None
+                if ticker in group_errors:
+                    if old_df is None:
+                        errors[ticker] = group_errors[ticker]
+                    else:
+                        logger.warning(f"Failed to refresh {ticker}: {group_errors[ticker]}")
+                        entries[ticker] = replace(entries[ticker], failed_at=fetched_at)
+                    continue
+                df = _merge(old_df, new_dfs.get(ticker), start_date=start_date)
+                entries[ticker] = _Entry(df, start_date, end_date, fetched_at, _size(df))
+
+        with self._lock:
+            for ticker, entry in entries.items():
+                self._entries[ticker] = entry
+                self._entries.move_to_end(ticker)
+            self._evict()
+        frames = [entries[ticker].df for ticker in dict.fromkeys(tickers) if ticker in entries]
+        return _merge(*frames, start_date=start_date), errors
+
+    def _fetch(
+        self, tickers: list[str], start_date: str, end_date: str
+    ) -> tuple[dict[str, pd.DataFrame], dict[str, Exception]]:
+        if start_date >= end_date:
+            return {}, {}
+        try:
+            df = self.fetch(tickers, start_date, end_date)
+            return {str(ticker): group for ticker, group in df.groupby("Symbol", observed=True)}, {}
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            if len(tickers) == 1:
+                return {}, {tickers[0]: e}
+            dfs: dict[str, pd.DataFrame] = {}
+            errors: dict[str, Exception] = {}
+            for ticker in tickers:
+                ticker_dfs, ticker_errors = self._fetch([ticker], start_date, end_date)
+                dfs.update(ticker_dfs)
+                errors.update(ticker_errors)
+            return dfs, errors
+
+    def _evict(self) -> None:
+        total = sum(entry.size for entry in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry.size
+            self.stats.evictions += 1
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                **asdict(self.stats),
+                "entries": len(self._entries),
+                "bytes": sum(entry.size for entry in self._entries.values()),
+            }
+
+
+def _size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _next_start(entry: _Entry) -> str:
+    """Date from which to fetch bars newer than those already cached"""
+    last_date = entry.df["Date"].max()
+    if pd.isnull(last_date):
+        return entry.start_date
+    return (last_date + timedelta(days=1)).strftime(DT_FMT)
+
+
+def _merge(*dfs: Optional[pd.DataFrame], start_date: str) -> pd.DataFrame:
+    frames = [df for df in dfs if df is not None and len(df)]
+    if not frames:
+        return EMPTY_HISTORY.copy()
+    return (
+        pd.concat(frames, ignore_index=True)
+        .loc[lambda x: x["Date"] >= start_date]
+        .reset_index(drop=True)
+        .assign(Symbol=lambda x: x["Symbol"].astype(str).astype("category"))
+    )
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Callable, Optional
+
+import dill
+from loguru import logger
+
+from src.forest import META_FILE, is_compiled, load_forest
+from src.model import Predictor, model_version
+
+
+@dataclass(frozen=True)
+class LoadedModel:
+    model: Predictor
+    version: str
+    mtime_ns: int
+    path: str = ""
+
+
+class ModelStore:
+    """Keeps model loaded in memory and reloads it when artifact at `path` changes.
+
+    If `forest_path` is given and holds a forest compiled by `src.forest`, it's preferred over
+    dill pickled model at `path`, which remains a fallback for models that can't be compiled.
+    Arrays of compiled forest are memory mapped, so loading it takes milliseconds.
+
+    File modification time is checked at most once per `check_interval` seconds and model is
+    only unpickled when content hash differs, which also serves as model version. Reloaded
+    model replaces previous one with a single reference assignment, so requests that already
+    got the previous model finish using it. If new artifact can't be loaded, e.g. while it's
+    still being written, previous model is kept."""
+
+    def __init__(
+        self, path: str, check_interval: float = 1.0, forest_path: Optional[str] = None
+    ) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self.forest_path = forest_path
+        self._loaded: Optional[LoadedModel] = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> LoadedModel:
+        if self._loaded is None or time.monotonic() - self._last_check >= self.check_interval:
+            self.refresh()
+        assert self._loaded is not None
+        return self._loaded
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._last_check = time.monotonic()
+            try:
+                if self.forest_path is not None:
+                    meta_path = os.path.join(self.forest_path, META_FILE)
+                    if is_compiled(self.forest_path):
+                        try:
+                            self._refresh_forest(meta_path)
+                            return
+                        except Exception as e:  # pylint: disable=broad-exception-caught
+                            logger.warning(
+                                f"Failed to load compiled forest {self.forest_path}, "
+                                f"falling back to {self.path}: {e}"
+                            )
+                self._refresh_dill()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                if self._loaded is None:
+                    raise
+                logger.error(f"Failed to reload model {self.path}, keeping previous one: {e}")
+
+    def _unchanged(self, path: str, mtime_ns: int) -> bool:
+        return (
+            self._loaded is not None
+            and self._loaded.path == path
+            and self._loaded.mtime_ns == mtime_ns
+        )
+
+    def _refresh_forest(self, meta_path: str) -> None:
+        mtime_ns = os.stat(meta_path).st_mtime_ns
+        if self._unchanged(meta_path, mtime_ns):
+            return
+        assert self.forest_path is not None
+        forest = load_forest(self.forest_path)
+        self._set(lambda: forest, forest.version, mtime_ns, meta_path)
+
+    def _refresh_dill(self) -> None:
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        if self._unchanged(self.path, mtime_ns):
+            return
+        with open(self.path, "rb") as f:
+            content = f.read()
+        version = model_version(content)
+        self._set(lambda: dill.loads(content), version, mtime_ns, self.path)
+
+    def _set(self, load: Callable[[], Predictor], version: str, mtime_ns: int, path: str) -> None:
+        if self._loaded is not None and self._loaded.version == version:
+            self._loaded = replace(self._loaded, mtime_ns=mtime_ns, path=path)
+            return
+        self._loaded = LoadedModel(load(), version, mtime_ns, path)
+        logger.info(f"Loaded model {path}, version {version}")
@@ -0,0 +1,44 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+from src.snapshot import META_FILE, FeatureSnapshot, load_snapshot
+
+
+class SnapshotStore:
+    """Keeps feature snapshot at `path` memory mapped and maps it again when it changes, like
+    `ModelStore` does for models. Arrays are mapped read only, so all workers share the same
+    pages of the file. Missing snapshot is not an error, `get` then returns None."""
+
+    def __init__(self, path: str, check_interval: float = 1.0) -> None:
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot: Optional[FeatureSnapshot] = None
+        self._mtime_ns = 0
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[FeatureSnapshot]:
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self.refresh()
+        return self._snapshot
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._last_check = time.monotonic()
+            try:
+                mtime_ns = os.stat(os.path.join(self.path, META_FILE)).st_mtime_ns
+                if self._snapshot is not None and mtime_ns == self._mtime_ns:
+                    return
+                self._snapshot = load_snapshot(self.path)
+                self._mtime_ns = mtime_ns
+                logger.info(
+                    f"Loaded feature snapshot {self.path}, version {self._snapshot.version}"
+                )
+            except FileNotFoundError:
+                pass
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error(f"Failed to load feature snapshot {self.path}: {e}")
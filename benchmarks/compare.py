@@ -0,0 +1,45 @@
+"""Compare two benchmark result files, e.g. of a base and a new commit, exiting with error
+when any benchmark got slower than `--threshold` times its base median time.
+
+Run using python -m benchmarks.compare base.json new.json [--threshold 1.2]
+"""
+import argparse
+import json
+import sys
+
+
+def load_results(path: str) -> dict[str, dict]:
+    with open(path, encoding="utf-8") as f:
+        return {res["name"]: res for res in json.load(f)["benchmarks"]}
+
+
+def compare(base: dict[str, dict], new: dict[str, dict], threshold: float) -> list[str]:
+    """Print time and memory ratio of benchmarks present in both results, returning names of
+    regressed benchmarks"""
+    regressions = []
+    print(f"{'benchmark':<24}{'base s':>10}{'new s':>10}{'ratio':>8}{'base MB':>10}{'new MB':>10}")
+    for name in [name for name in new if name in base]:
+        old_s, new_s = base[name]["median_s"], new[name]["median_s"]
+        ratio = new_s / old_s if old_s else float("inf")
+        flag = " <- slower" if ratio > threshold else ""
+        print(
+            f"{name:<24}{old_s:>10.3f}{new_s:>10.3f}{ratio:>8.2f}"
+            f"{base[name]['peak_mb']:>10.1f}{new[name]['peak_mb']:>10.1f}{flag}"
+        )
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+    regressions = compare(load_results(args.base), load_results(args.new), args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Benchmark suite timing and memory profiling every pipeline stage and the API handlers on
+a synthetic market, fully offline. Results are written as JSON, to compare between commits
+using `benchmarks.compare`.
+
+Run using python -m benchmarks.run [--symbols 500] [--days 15000] [--output results.json]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import subprocess
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Any, Callable, Optional
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from api import app
+from api.history_cache import PriceHistoryCache
+from api.model_store import LoadedModel
+from benchmarks.synthetic import SyntheticDownload, make_ohlcv
+from src.data import DT_FMT, ValidationMode, downcast_dtypes, ticker_pipe, validate
+from src.model import CVConfig, Dataset, ModelTrainer, make_pipeline
+from src.pipeline.calculate_features import WINDOW_LENGTHS, calculate_features
+from src.pipeline.dataset import create_dataset
+from src.pipeline.target import calculate_target
+from src.utils import load_config
+
+COLUMNS = ["Date", "Symbol", "Close"]
+# Days of price history served to the API, covering its lookback window
+API_HISTORY_DAYS = 400
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    rows_in: int
+    rows_out: int
+    wall_s: list[float]
+    median_s: float
+    peak_mb: float
+
+
+def measure(
+    name: str,
+    func: Callable[..., Any],
+    setup: Callable[[], tuple] = tuple,
+    repeat: int = 3,
+) -> BenchmarkResult:
+    """Time `repeat` calls of `func` on fresh arguments returned by `setup`, which isn't timed,
+    since many steps modify their input. Peak memory allocated during the call is measured
+    by an additional run under tracemalloc, which would otherwise distort timings."""
+    wall_s = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        started = time.perf_counter()
+        result = func(*args)
+        wall_s.append(time.perf_counter() - started)
+        del result
+
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    res = BenchmarkResult(
+        name=name,
+        rows_in=_length(args[0]) if args else 0,
+        rows_out=_length(result),
+        wall_s=wall_s,
+        median_s=statistics.median(wall_s),
+        peak_mb=(peak - baseline) / 2**20,
+    )
+    logger.info(f"{name}: median {res.median_s:.3f}s, peak {res.peak_mb:.1f} MB")
+    return res
+
+
+def _length(obj: Any) -> int:
+    return len(obj) if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray, list)) else 0
+
+
+def run_benchmarks(
+    n_symbols: int = 500,
+    n_days: int = 15_000,
+    seed: int = 0,
+    repeat: int = 3,
+    only: Optional[list[str]] = None,
+) -> list[BenchmarkResult]:
+    """Run benchmarks, optionally `only` those whose name starts with one of given prefixes"""
+    logger.info(f"Generating synthetic market of {n_symbols} symbols and {n_days} days")
+    raw = make_ohlcv(n_symbols, n_days, seed)
+    start_date = raw["Date"].min().strftime(DT_FMT)
+    end_date = (raw["Date"].max() + timedelta(days=1)).strftime(DT_FMT)
+    dates = np.sort(raw["Date"].unique())
+    train_cutoff = pd.Timestamp(dates[int(len(dates) * 0.8)]).strftime(DT_FMT)
+
+    compact = downcast_dtypes(raw.copy())
+    features = calculate_features(compact[COLUMNS].copy(), WINDOW_LENGTHS)
+    target = calculate_target(compact[COLUMNS].copy(), look_ahead_days=1)
+    dataset = create_dataset(features, target, f"sma_{max(WINDOW_LENGTHS)}", train_cutoff)
+    train_config = load_config("train")
+    trainer = ModelTrainer(train_config["features"])
+
+    benchmarks: dict[str, tuple[Callable[..., Any], Callable[[], tuple]]] = {
+        "downcast_dtypes": (downcast_dtypes, lambda: (raw.copy(),)),
+        **{
+            f"validate_{mode}": (
+                partial(validate, start_date=start_date, end_date=end_date, mode=mode),
+                lambda: (compact,),
+            )
+            for mode in ValidationMode
+        },
+        "calculate_features": (
+            partial(calculate_features, window_lengths=WINDOW_LENGTHS),
+            lambda: (compact[COLUMNS].copy(),),
+        ),
+        "calculate_target": (
+            partial(calculate_target, look_ahead_days=1),
+            lambda: (compact[COLUMNS].copy(),),
+        ),
+        "create_dataset": (
+            partial(
+                create_dataset,
+                longest_window_feature=f"sma_{max(WINDOW_LENGTHS)}",
+                train_cutoff=train_cutoff,
+            ),
+            lambda: (features, target),
+        ),
+        "model_trainer_run": (
+            lambda df: trainer.run(make_pipeline(train_config["steps"]), df),
+            lambda: (dataset,),
+        ),
+        "walk_forward": (
+            lambda df: ModelTrainer(
+                train_config["features"], cv=CVConfig(**train_config["cv"])
+            ).walk_forward(make_pipeline(train_config["steps"]), df),
+            lambda: (dataset,),
+        ),
+    }
+    results = [
+        measure(name, func, setup, repeat)
+        for name, (func, setup) in benchmarks.items()
+        if _selected(name, only)
+    ]
+    if _selected("api", only):
+        model = make_pipeline(train_config["steps"]).fit(
+            *trainer.get_dataset_xy(dataset, Dataset.TRAIN)
+        )
+        results += api_benchmarks(raw["Symbol"].iloc[0], model, seed, repeat)
+    return results
+
+
+def _selected(name: str, only: Optional[list[str]]) -> bool:
+    return not only or any(name.startswith(prefix) for prefix in only)
+
+
+def api_benchmarks(ticker: str, model: Any, seed: int, repeat: int) -> list[BenchmarkResult]:
+    """Time `/features` handler with cold and warm history cache and `/predict` handler.
+    Price history ending today is served by synthetic download through `ticker_pipe`."""
+    history = make_ohlcv(
+        n_days=API_HISTORY_DAYS, seed=seed, end_date=f"{datetime.now():%F}", symbols=[ticker]
+    )
+    fetch = partial(
+        ticker_pipe,
+        validation_mode=app.VALIDATION_MODE,
+        download=SyntheticDownload(history),
+        max_workers=1,
+    )
+    warm_cache = PriceHistoryCache(fetch)
+
+    def _features(cache: PriceHistoryCache) -> str:
+        with patch.object(app, "history_cache", cache):
+            return asyncio.run(app.get_current_features_for_ticker(ticker))
+
+    features = _features(warm_cache)
+    loaded = LoadedModel(model, "benchmark", 0)
+
+    def _predict(features: str) -> dict:
+        with patch.object(app.model_store, "get", lambda: loaded):
+            return json.loads(json.loads(asyncio.run(app.predict(features)).body))
+
+    assert "probability" in _predict(features), "Failed to predict from synthetic features"
+    return [
+        measure("api_features_cold", _features, lambda: (PriceHistoryCache(fetch),), repeat),
+        measure("api_features_warm", _features, lambda: (warm_cache,), repeat),
+        measure("api_predict", _predict, lambda: (features,), repeat),
+    ]
+
+
+def environment() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:  # pylint: disable=broad-exception-caught
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def save_results(results: list[BenchmarkResult], path: str, params: dict[str, Any]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "environment": environment(),
+                "params": params,
+                "benchmarks": [asdict(res) for res in results],
+            },
+            f,
+            indent=2,
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--symbols", type=int, default=500)
+    parser.add_argument("--days", type=int, default=15_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="*", help="Run benchmarks starting with these prefixes")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.symbols, args.days, args.seed, args.repeat, args.only)
+    params = {"symbols": args.symbols, "days": args.days, "seed": args.seed}
+    save_results(results, args.output, params)
+    logger.info(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
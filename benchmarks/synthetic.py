@@ -0,0 +1,86 @@
+import string
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+PRICE_COLUMNS = ["Adj Close", "Close", "High", "Low", "Open", "Volume"]
+
+
+def make_symbols(n_symbols: int, rng: np.random.Generator) -> list[str]:
+    """Distinct capitalized 1-5 char tickers, sorted"""
+    letters = np.array(list(string.ascii_uppercase))
+    symbols: set[str] = set()
+    while len(symbols) < n_symbols:
+        length = rng.integers(1, 6)
+        symbols.add("".join(rng.choice(letters, length)))
+    return sorted(symbols)
+
+
+def make_ohlcv(
+    n_symbols: int = 500,
+    n_days: int = 15_000,
+    seed: int = 0,
+    end_date: str = "2023-10-27",
+    symbols: Optional[list[str]] = None,
+) -> pd.DataFrame:
+    """Deterministic synthetic market shaped like `get_daily_ticker_data` output before
+    downcasting: long format sorted by Symbol and Date, with float64 prices and string Symbol.
+
+    Each symbol follows a geometric random walk over business days ending at `end_date`.
+    All but the first symbol start at a random day in the first half of the period, the way
+    later listings do, so histories have different lengths."""
+    rng = np.random.default_rng(seed)
+    symbols = symbols or make_symbols(n_symbols, rng)
+    n_symbols = len(symbols)
+    dates = pd.bdate_range(end=end_date, periods=n_days, name="Date")
+
+    starts = np.r_[0, rng.integers(0, n_days // 2, n_symbols - 1)][:n_symbols]
+    lengths = n_days - starts
+    offsets = np.cumsum(lengths) - lengths
+    n = int(lengths.sum())
+    symbol_ids = np.repeat(np.arange(n_symbols), lengths)
+    days = np.arange(n) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+
+    log_returns = rng.normal(0.0001, 0.015, n)
+    log_returns[offsets] = np.log(rng.uniform(5, 500, n_symbols))
+    segment_sums = np.r_[0.0, np.cumsum(log_returns)][offsets]
+    close = np.exp(np.cumsum(log_returns) - np.repeat(segment_sums, lengths))
+    open_ = close * np.exp(rng.normal(0, 0.005, n))
+    high = np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, n)))
+    low = np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, n)))
+    dividend_factor = np.repeat(rng.uniform(0.8, 1.0, n_symbols), lengths)
+
+    return pd.DataFrame(
+        {
+            "Date": dates[days],
+            "Symbol": np.array(symbols, dtype=object)[symbol_ids],
+            "Adj Close": close * dividend_factor,
+            "Close": close,
+            "High": high,
+            "Low": low,
+            "Open": open_,
+            "Volume": rng.lognormal(13, 1, n).round(),
+        }
+    )
+
+
+class SyntheticDownload:
+    """Offline stand-in for `download_tickers`, serving wide frames from long `history`"""
+
+    def __init__(self, history: pd.DataFrame) -> None:
+        self.history = history
+
+    def __call__(
+        self, tickers: list[str], start: str, end: Optional[str] = None, **kwargs
+    ) -> pd.DataFrame:
+        tickers = [ticker for ticker in tickers if ticker]
+        df = self.history.loc[
+            lambda x: x["Symbol"].isin(tickers)
+            & (x["Date"] >= start)
+            & ((x["Date"] < end) if end else True)
+        ]
+        columns = pd.MultiIndex.from_product([PRICE_COLUMNS, tickers])
+        return df.pivot(index="Date", columns="Symbol", values=PRICE_COLUMNS).reindex(
+            columns=columns
+        )
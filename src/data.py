@@ -1,16 +1,25 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import Optional
+from enum import StrEnum
+from typing import Any, Callable, Optional
 
 import bs4 as bs
+import numpy as np
 import pandas as pd
 import pandera as pa
 import requests
 import yfinance as yf
 from loguru import logger
+from pandera.engines import pandas_engine
+from pandera.errors import SchemaError, SchemaErrorReason
 
-from src.utils import log_io_length
+from src.instrumentation import instrument
+from src.schema import PRICE_DTYPE, SYMBOL_DTYPE
 
 DT_FMT = "%Y-%m-%d"
+PRICE_COLUMNS = ["Adj Close", "Close", "High", "Low", "Open", "Volume"]
 
 
 def scrape_tickers(url: str, limit: Optional[int] = None) -> list[str]:
@@ -25,71 +34,386 @@ def scrape_tickers(url: str, limit: Optional[int] = None) -> list[str]:
     return tickers
 
 
+def download_tickers(
+    tickers: list[str], start: str, end: Optional[str] = None, interval: str = "1d", **kwargs
+) -> pd.DataFrame:
+    """Thread-safe replacement for `yf.download`, which keeps per-call state in module
+    globals and therefore can't be run concurrently. Fetches history of each ticker in turn
+    and returns it in the same wide layout, with (field, ticker) columns indexed by Date.
+    Symbols without data have no rows, instead of failing tickers downloaded with them.
+
+    Tickers of a call are fetched one after another, so download concurrency is the number
+    of calls run in parallel, i.e. `max_workers` batches of `get_daily_ticker_data`."""
+    frames = {}
+    for ticker in tickers:
+        df = yf.Ticker(ticker).history(
+            start=start, end=end, interval=interval, auto_adjust=False, actions=False, **kwargs
+        )
+        # Unknown and delisted symbols give an empty frame without DatetimeIndex
+        frames[ticker] = df.set_axis(pd.DatetimeIndex(df.index).tz_localize(None).rename("Date"))
+    return pd.concat(frames, axis=1, sort=True).swaplevel(axis=1).sort_index(axis=1)
+
+
+def _download_batch(
+    download: Callable[..., pd.DataFrame],
+    tickers: list[str],
+    start_date: str,
+    end_date: Optional[str],
+    interval: str,
+    max_retries: int,
+    backoff: float,
+    **kwargs,
+) -> pd.DataFrame:
+    """Download a single batch of tickers and reshape it into long format, retrying with
+    exponential backoff. Prices are downcast before reshaping, so that long format frame is
+    only built in compact dtypes. `download` has to return (field, ticker) columns like
+    `download_tickers` does, also for a single ticker."""
+    attempt = 0
+    while True:
+        try:
+            return (
+                download(tickers, start=start_date, end=end_date, interval=interval, **kwargs)
+                .pipe(_downcast_floats)
+                .stack()
+                .reset_index()
+                .rename(columns={"level_1": "Symbol"})
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2**attempt
+            logger.warning(f"Batch {tickers[0]}..{tickers[-1]} failed ({e}), retry in {delay}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+@instrument()
 def get_daily_ticker_data(
     tickers: str | list[str],
     start_date: str,
     end_date: Optional[str] = None,
     interval: str = "1d",
+    batch_size: int = 100,
+    max_workers: int = 4,
+    max_retries: int = 3,
+    backoff: float = 1.0,
+    download: Optional[Callable[..., pd.DataFrame]] = None,
     **kwargs,
 ) -> pd.DataFrame:
     """Download collected ticker price data for selected dates and frequency
-    from yahoo finance https://aroussi.com/post/python-yahoo-finance"""
+    from yahoo finance https://aroussi.com/post/python-yahoo-finance
+
+    Tickers are split into batches of `batch_size`, downloaded on a pool of `max_workers`
+    threads and stacked into long format batch by batch, so a slow or failing symbol only
+    holds up its own batch. Each batch is downcast to compact dtypes as soon as it arrives,
+    so full precision frame of all tickers is never materialized. If any batch still fails
+    after `max_retries`, RuntimeError listing its tickers is raised once all batches finish,
+    instead of returning partial data. Without any rows, result is empty with the same
+    columns and dtypes. `download` can be used to plug in a different data source, e.g. for
+    tests."""
     logger.info("Collecting ticker data from yahoo finance")
-    return (
-        yf.download(tickers, start=start_date, end=end_date, interval=interval, **kwargs)
-        .stack()
-        .reset_index()
-        .rename(columns={"level_1": "Symbol"})
-        .sort_values(["Symbol", "Date"])
+    download = download or download_tickers
+    tickers = tickers.split() if isinstance(tickers, str) else tickers
+    tickers = [ticker for ticker in tickers if ticker]
+    batches = [tickers[i : i + batch_size] for i in range(0, len(tickers), batch_size)]
+
+    def _timed_batch(batch: list[str]) -> pd.DataFrame:
+        started = time.perf_counter()
+        df = _download_batch(
+            download, batch, start_date, end_date, interval, max_retries, backoff, **kwargs
+        ).pipe(downcast_dtypes)
+        logger.info(
+            f"Downloaded {len(batch)} tickers {batch[0]}..{batch[-1]} "
+            f"({len(df)} rows) in {time.perf_counter() - started:.2f}s"
+        )
+        return df
+
+    results: dict[int, pd.DataFrame] = {}
+    failed: list[str] = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_timed_batch, batch): i for i, batch in enumerate(batches)}
+        for future in as_completed(futures):
+            batch = batches[futures[future]]
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error(f"Giving up on tickers {batch}: {e}")
+                failed += batch
+
+    if failed:
+        raise RuntimeError(f"Failed to download data for tickers {sorted(failed)}")
+    dfs = [df for i, df in sorted(results.items()) if len(df)]
+    if not dfs:
+        return empty_ticker_data()
+    # Shared categories, so that concatenation keeps Symbol categorical
+    symbols = sorted(set().union(*(df["Symbol"].cat.categories for df in dfs)))
+    for df in dfs:
+        df["Symbol"] = df["Symbol"].cat.set_categories(symbols)
+    return pd.concat(dfs, ignore_index=True).sort_values(["Symbol", "Date"])
+
+
+def empty_ticker_data() -> pd.DataFrame:
+    """Frame without rows, with the columns and dtypes of `get_daily_ticker_data` output"""
+    return pd.DataFrame(
+        {
+            "Date": pd.Series(dtype="datetime64[ns]"),
+            "Symbol": pd.Series(dtype=SYMBOL_DTYPE),
+            **{column: pd.Series(dtype=PRICE_DTYPE) for column in PRICE_COLUMNS},
+        }
     )
 
 
 def downcast_dtypes(df: pd.DataFrame) -> pd.DataFrame:
     """Convert floats from 64 to 32 bytes and change Symbol from string to category,
     to save memory usage."""
-    logger.info("Downcasting data types to optimize memory usage")
+    return _downcast_floats(df).assign(Symbol=lambda x: x["Symbol"].astype(SYMBOL_DTYPE))
+
+
+def _downcast_floats(df: pd.DataFrame) -> pd.DataFrame:
     numeric_df = df.select_dtypes(include="float")
-    df[numeric_df.columns] = numeric_df.astype("float32")  # type: ignore
-    return df.assign(Symbol=lambda x: x["Symbol"].astype("category"))
+    df[numeric_df.columns] = numeric_df.astype(PRICE_DTYPE)  # type: ignore
+    return df
 
 
-@log_io_length
-def validate(df: pd.DataFrame, start_date: str, end_date: str) -> pd.DataFrame:
-    """Use pandera to perform data quality checks:
+SYMBOL_PATTERN = r"^[A-Z]{1,5}$"
+# Number of rows checked by sampled validation
+VALIDATION_SAMPLE_SIZE = 10_000
+
+
+class ValidationMode(StrEnum):
+    FULL = "full"
+    FAST = "fast"
+    SAMPLED = "sampled"
+
+
+def validation_schema(start_date: str, end_date: str) -> pa.DataFrameSchema:
+    """Pandera schema of downloaded data:
     - if required columns exist and are not null
     - are dates within expected range, yfinance uses end_date exlcusively,
         need to subtract one day
     - symbol is capitalized 1-5 char length string
     """
-    logger.info("Validating data")
     end_date = (datetime.strptime(end_date, DT_FMT) - timedelta(days=1)).strftime(DT_FMT)
     min_dt_check = pa.Check.greater_than_or_equal_to(pd.Timestamp(start_date))
     max_dt_check = pa.Check.less_than_or_equal_to(pd.Timestamp(end_date))
-    capitalized_one_to_five_chars = pa.Check.str_matches(r"^[A-Z]{1,5}$")
-    schema = pa.DataFrameSchema(
+    capitalized_one_to_five_chars = pa.Check.str_matches(SYMBOL_PATTERN)
+    return pa.DataFrameSchema(
         {
             "Date": pa.Column(pa.Timestamp, nullable=False, checks=[min_dt_check, max_dt_check]),
-            "Symbol": pa.Column(pa.String, nullable=False, checks=[capitalized_one_to_five_chars]),
-            "Close": pa.Column(pa.Float64, nullable=False, checks=[pa.Check.greater_than(0)]),
+            "Symbol": pa.Column(
+                pa.Category, nullable=False, checks=[capitalized_one_to_five_chars]
+            ),
+            "Close": pa.Column(pa.Float32, nullable=False, checks=[pa.Check.greater_than(0)]),
         }
     )
-    return schema.validate(df)
 
 
-def ticker_pipe(
-    tickers: list[str], start_date: str, end_date: Optional[str] = None, interval: str = "1d"
+@instrument()
+def validate(
+    df: pd.DataFrame,
+    start_date: str,
+    end_date: str,
+    mode: str = ValidationMode.FULL,
+    sample_size: int = VALIDATION_SAMPLE_SIZE,
 ) -> pd.DataFrame:
-    """Apply get ticker data, downcast and validation in sequence for use in both feature
-    and inference pipelines. In case of inference end_date will not be specified.
+    """Perform data quality checks of `validation_schema`, at a cost chosen by `mode`:
+    - full: pandera validation of every row
+    - fast: same rules checked by `validate_fast`
+    - sampled: pandera validation of `sample_size` randomly chosen rows
+    """
+    logger.info(f"Validating data, mode: {mode}")
+    schema = validation_schema(start_date, end_date)
+    match ValidationMode(mode):
+        case ValidationMode.FULL:
+            return schema.validate(df)
+        case ValidationMode.FAST:
+            return validate_fast(df, schema)
+        case ValidationMode.SAMPLED:
+            if len(df) <= sample_size:
+                return schema.validate(df)
+            return schema.validate(df, sample=sample_size, random_state=0)
+
+
+def validate_fast(df: pd.DataFrame, schema: pa.DataFrameSchema) -> pd.DataFrame:
+    """Check rules of `validation_schema` with vectorized numpy operations. Symbol pattern
+    is matched once per distinct symbol instead of once per row. Failures are reported by
+    raising pandera `SchemaError`, with the same message and failure cases as pandera."""
+    for name, column in schema.columns.items():
+        if name not in df.columns:
+            _raise_schema_error(
+                schema,
+                df,
+                f"column '{name}' not in dataframe\n{df.head()}",
+                pd.DataFrame({"index": [None], "failure_case": [name]}),
+                "column_in_dataframe",
+                SchemaErrorReason.COLUMN_NOT_IN_DATAFRAME,
+            )
+        series = df[name]
+        if not column.dtype.check(pandas_engine.Engine.dtype(series.dtype)):
+            _raise_schema_error(
+                schema,
+                df,
+                f"expected series '{name}' to have type {column.dtype}, got {series.dtype}",
+                pd.DataFrame({"index": [None], "failure_case": [str(series.dtype)]}),
+                f"dtype('{column.dtype}')",
+                SchemaErrorReason.WRONG_DATATYPE,
+            )
+
+        if name == "Symbol":
+            # Pattern evaluated on distinct values, then broadcast back to rows by code
+            codes, uniques = pd.factorize(series)
+            nulls = codes == -1
+            is_string = np.array([isinstance(value, str) for value in uniques], dtype=bool)
+            if not is_string.all():
+                failed = ~np.r_[is_string, True][codes]
+                failure_cases = pd.DataFrame(
+                    {"index": df.index[failed], "failure_case": series[failed].to_numpy()}
+                )
+                _raise_schema_error(
+                    schema,
+                    df,
+                    f"expected series '{name}' to have type {column.dtype}:\n"
+                    f"failure cases:\n{failure_cases}",
+                    failure_cases,
+                    f"dtype('{column.dtype}')",
+                    SchemaErrorReason.WRONG_DATATYPE,
+                )
+            pattern = re.compile(SYMBOL_PATTERN)
+            matches = np.array([pattern.match(value) is not None for value in uniques], dtype=bool)
+            passed = [np.r_[matches, False][codes]]
+        else:
+            values = series.to_numpy()
+            nulls = pd.isnull(values)
+            passed = [_compare(values, check.name, check.statistics) for check in column.checks]
+
+        if nulls.any():
+            _raise_schema_error(
+                schema,
+                df,
+                f"non-nullable series '{name}' contains null values:\n{series[nulls]}",
+                pd.DataFrame({"index": df.index[nulls], "failure_case": series[nulls].to_numpy()}),
+                "not_nullable",
+                SchemaErrorReason.SERIES_CONTAINS_NULLS,
+            )
+        for check_index, (check, check_passed) in enumerate(zip(column.checks, passed)):
+            if check_passed.all():
+                continue
+            failed = ~check_passed
+            failure_cases = pd.DataFrame(
+                {"index": df.index[failed], "failure_case": series[failed].to_numpy()}
+            )
+            _raise_schema_error(
+                schema,
+                df,
+                f"{column} failed element-wise validator {check_index}:\n{check}\n"
+                f"failure cases:\n{failure_cases}",
+                failure_cases,
+                check,
+                SchemaErrorReason.DATAFRAME_CHECK,
+                check_index,
+            )
+    return df
+
+
+def _compare(values: np.ndarray, check_name: str, statistics: dict) -> np.ndarray:
+    """Evaluate builtin pandera comparison check as numpy operation"""
+    operators = {
+        "greater_than": np.greater,
+        "greater_than_or_equal_to": np.greater_equal,
+        "less_than": np.less,
+        "less_than_or_equal_to": np.less_equal,
+    }
+    (bound,) = statistics.values()
+    if isinstance(bound, pd.Timestamp):
+        bound = bound.to_datetime64()
+    return operators[check_name](values, bound)
 
-    If tickers list contains a single ticker, add empty string, otherwise yfinance returned df
-    changes its shape."""
+
+def _raise_schema_error(
+    schema: pa.DataFrameSchema,
+    df: pd.DataFrame,
+    message: str,
+    failure_cases: pd.DataFrame,
+    check: Any,
+    reason_code: SchemaErrorReason,
+    check_index: Optional[int] = None,
+) -> None:
+    raise SchemaError(
+        schema,
+        df,
+        message,
+        failure_cases=failure_cases,
+        check=check,
+        check_index=check_index,
+        reason_code=reason_code,
+    )
+
+
+@instrument()
+def ticker_pipe(
+    tickers: list[str],
+    start_date: str,
+    end_date: Optional[str] = None,
+    interval: str = "1d",
+    validation_mode: str = ValidationMode.FULL,
+    **kwargs,
+) -> pd.DataFrame:
+    """Apply get ticker data, which downcasts it batch by batch, and validation in sequence
+    for use in both feature and inference pipelines. In case of inference end_date will not
+    be specified. Keyword arguments are passed on to `get_daily_ticker_data`."""
     if end_date is None:
         end_date = (datetime.strptime(start_date, DT_FMT) + timedelta(days=1)).strftime(DT_FMT)
 
-    tickers = tickers + [""] if len(tickers) == 1 else tickers
+    return get_daily_ticker_data(tickers, start_date, end_date, interval, **kwargs).pipe(
+        validate, start_date=start_date, end_date=end_date, mode=validation_mode
+    )
+
+
+def get_missing_date_ranges(
+    df: pd.DataFrame, tickers: list[str], start_date: str, end_date: str
+) -> dict[str, list[str]]:
+    """Work out from which date each ticker needs to be downloaded to bring previously
+    collected data up to `end_date`. Tickers without history start from `start_date`,
+    tickers that are already up to date, or whose gap has no business days, e.g. a weekend,
+    are left out. Result is grouped by range start, so that tickers sharing the same gap can
+    be fetched in a single request."""
+    last_dates = df.groupby("Symbol", observed=True)["Date"].max()
+    ranges: dict[str, list[str]] = {}
+    for ticker in tickers:
+        if ticker in last_dates.index:
+            range_start = (last_dates[ticker] + timedelta(days=1)).strftime(DT_FMT)
+        else:
+            range_start = start_date
+        if np.busday_count(range_start, end_date) > 0:
+            ranges.setdefault(range_start, []).append(ticker)
+    return ranges
+
+
+@instrument()
+def update_ticker_data(
+    df: pd.DataFrame,
+    tickers: list[str],
+    start_date: str,
+    end_date: str,
+    interval: str = "1d",
+    **kwargs,
+) -> pd.DataFrame:
+    """Incrementally extend previously collected ticker data, by downloading only missing
+    date ranges for each ticker and merging them with existing rows. Tickers that are no
+    longer in `tickers` are dropped, so result matches a full download of the same list."""
+    ranges = get_missing_date_ranges(df, tickers, start_date, end_date)
+    logger.info(f"Updating {sum(len(group) for group in ranges.values())} tickers")
+    new_dfs = [
+        ticker_pipe(group, range_start, end_date, interval, **kwargs)
+        for range_start, group in sorted(ranges.items())
+    ]
     return (
-        get_daily_ticker_data(tickers, start_date, end_date, interval)
-        .pipe(validate, start_date=start_date, end_date=end_date)
-        .pipe(downcast_dtypes)
+        pd.concat(
+            [df.loc[lambda x: x["Symbol"].isin(tickers)], *[x for x in new_dfs if len(x)]],
+            ignore_index=True,
+        )
+        .drop_duplicates(subset=["Symbol", "Date"], keep="last")
+        .sort_values(["Symbol", "Date"])
+        .reset_index(drop=True)
+        .assign(Symbol=lambda x: x["Symbol"].astype(str).astype("category"))
     )
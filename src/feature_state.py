@@ -0,0 +1,253 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from src.features import FeaturePlan, block_cumsum, segment_starts
+from src.schema import FEATURE_DTYPE
+from src.utils import is_sorted_by
+
+STATE_FORMAT_VERSION = 1
+STATE_FIELDS = ["position", "date", "inputs", "sums", "last_nan", "features", "record"]
+
+
+@dataclass
+class SymbolState:
+    """What's needed to calculate features of the next bar of a symbol without its history.
+
+    Rolling means of `calculate_features` are differences of cumulative sums restarting every
+    `block` rows (see `rolling_means`), so keeping cumulative sums of the previous and current
+    block of each intermediate series is enough to get them for a new bar, exactly as if whole
+    history was recalculated, in time independent of history length."""
+
+    # Position of last bar within history of the symbol
+    position: int
+    date: np.datetime64
+    # Plan input columns of last bar, as some series depend on previous bar
+    inputs: np.ndarray
+    # Cumulative sums of each series, over previous and current block, shape (series, 2, block)
+    sums: np.ndarray
+    # Position of last NaN of each series, -1 if there was none
+    last_nan: np.ndarray
+    # Features of last bar
+    features: np.ndarray
+    # Last bar together with its features, as JSON records served by API
+    record: str
+
+
+class FeatureStateStore:
+    """Streaming counterpart of `calculate_features` for live inference, keeping `SymbolState`
+    of each symbol, so that features of new bars are calculated in O(1) per symbol, instead of
+    downloading and recalculating whole history.
+
+    Bars are assumed to be only appended. If older history changes, e.g. because prices were
+    split adjusted, state of the symbol has to be dropped and initialized from history again.
+    States can be saved to a single file and restored, e.g. when API workers restart.
+
+    States are never modified once stored, updates replace them, so a state returned by `get`
+    stays consistent while other threads update the symbol. Least recently used symbols are
+    evicted when there are more than `capacity` of them."""
+
+    def __init__(self, plan: FeaturePlan, capacity: Optional[int] = None) -> None:
+        self.plan = plan
+        self.series = list(plan.means)
+        self.capacity = capacity
+        self._states: OrderedDict[str, SymbolState] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, symbol: str) -> Optional[SymbolState]:
+        with self._lock:
+            state = self._states.get(symbol)
+            if state is not None:
+                self._states.move_to_end(symbol)
+            return state
+
+    def drop(self, symbol: str) -> None:
+        with self._lock:
+            self._states.pop(symbol, None)
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def update(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Add bars of `df` to states of their symbols, returning the bars that are newer than
+        their symbol's state, grouped by symbol and sorted by date, with features identical to
+        `calculate_features` over all bars seen. States of unknown symbols are initialized
+        from their bars, treating them as their whole history."""
+        if not is_sorted_by(df, ["Symbol", "Date"]):
+            df = df.sort_values(["Symbol", "Date"])
+        starts = segment_starts(df["Symbol"])
+        lengths = np.diff(np.r_[starts, len(df)])
+        frames = []
+        with self._lock:
+            states = [self._states.get(str(symbol)) for symbol in df["Symbol"].iloc[starts]]
+            known = np.repeat(np.array([state is not None for state in states], bool), lengths)
+            last_dates = np.repeat(
+                np.array(
+                    [state.date if state is not None else None for state in states],
+                    dtype="datetime64[ns]",
+                ),
+                lengths,
+            )
+            new = known & (df["Date"].to_numpy(dtype="datetime64[ns]") > last_dates)
+            if not known.all():
+                frames.append(self._initialize(df.loc[~known].reset_index(drop=True)))
+            if new.any():
+                frames.append(self._append(df.loc[new].reset_index(drop=True)))
+            self._evict()
+        if not frames:
+            return df.iloc[:0].assign(**{column: np.float32() for column in self.plan.features})
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+    def _initialize(self, df: pd.DataFrame) -> pd.DataFrame:
+        plan = self.plan
+        n = len(df)
+        starts = segment_starts(df["Symbol"])
+        lengths = np.diff(np.r_[starts, n])
+        ends = starts + lengths - 1
+        positions = np.arange(n) - np.repeat(starts, lengths)
+        values = plan.series(df, starts)
+        for column, feature_values in plan.evaluate(values, starts).items():
+            df[column] = feature_values
+
+        # Same cumulative sums as `stacked_rolling_means` computes
+        stacked = np.vstack([values[name] for name in self.series] or [np.empty((0, n))])
+        nans = np.isnan(stacked)
+        sums, cols = block_cumsum(
+            np.where(nans, 0.0, stacked), np.flatnonzero(positions % plan.block == 0)
+        )
+        last_nans = np.maximum.reduceat(np.where(nans, positions, -1), starts, axis=1)
+        inputs = np.column_stack([values[column][ends] for column in plan.columns])
+        features = df[list(plan.features)].to_numpy(dtype=np.float32)[ends]
+        dates = df["Date"].to_numpy(dtype="datetime64[ns]")
+
+        for i, end in enumerate(ends):
+            block_sums = np.zeros((len(self.series), 2, plan.block))
+            current = end - cols[end]
+            block_sums[:, 1, : cols[end] + 1] = sums[:, current : end + 1]
+            if positions[current] >= plan.block:
+                block_sums[:, 0] = sums[:, current - plan.block : current]
+            self._states[str(df["Symbol"].iat[end])] = SymbolState(
+                position=int(positions[end]),
+                date=dates[end],
+                inputs=inputs[i],
+                sums=block_sums,
+                last_nan=last_nans[:, i],
+                features=features[i],
+                record=df.iloc[[end]].to_json(orient="records"),
+            )
+        return df
+
+    def _append(self, bars: pd.DataFrame) -> pd.DataFrame:
+        starts = segment_starts(bars["Symbol"])
+        ends = np.r_[starts[1:], len(bars)] - 1
+        inputs = np.column_stack(
+            [bars[column].to_numpy(dtype="float64") for column in self.plan.columns]
+        )
+        dates = bars["Date"].to_numpy(dtype="datetime64[ns]")
+        features = np.empty((len(bars), len(self.plan.features)), dtype=FEATURE_DTYPE)
+        symbols = [str(symbol) for symbol in bars["Symbol"].iloc[starts]]
+        # Updated on copies, which replace stored states once complete
+        states = [
+            replace(state, sums=state.sums.copy(), last_nan=state.last_nan.copy())
+            for state in map(self._states.__getitem__, symbols)
+        ]
+        for state, start, end in zip(states, starts, ends):
+            for row in range(start, end + 1):
+                features[row] = self._append_bar(state, inputs[row])
+            state.date = dates[end]
+        bars = pd.concat([bars, pd.DataFrame(features, columns=list(self.plan.features))], axis=1)
+        for symbol, state, end in zip(symbols, states, ends):
+            state.record = bars.iloc[[end]].to_json(orient="records")
+            self._states[symbol] = state
+            self._states.move_to_end(symbol)
+        return bars
+
+    def _evict(self) -> None:
+        while self.capacity is not None and len(self._states) > self.capacity:
+            self._states.popitem(last=False)
+
+    def _append_bar(self, state: SymbolState, bar: np.ndarray) -> np.ndarray:
+        plan, block = self.plan, self.plan.block
+        # Series of the new bar, with the previous bar in the same segment
+        inputs = {
+            column: np.array([previous, current])
+            for column, previous, current in zip(plan.columns, state.inputs, bar)
+        }
+        values = {
+            name: series[1:] for name, series in plan.derive(inputs, np.zeros(1, int)).items()
+        }
+        current = np.array([values[name][0] for name in self.series])
+        nans = np.isnan(current)
+
+        position = state.position + 1
+        col = position % block
+        if col == 0:
+            state.sums[:, 0] = state.sums[:, 1]
+            state.sums[:, 1, 0] = np.where(nans, 0.0, current)
+        else:
+            state.sums[:, 1, col] = state.sums[:, 1, col - 1] + np.where(nans, 0.0, current)
+        state.last_nan[nans] = position
+
+        means = {}
+        for i, name in enumerate(self.series):
+            previous_sums, sums = state.sums[i]
+            for window in plan.means[name]:
+                if position < window - 1 or state.last_nan[i] > position - window:
+                    mean = np.nan
+                elif col >= window:
+                    mean = (sums[col] - sums[col - window]) / window
+                else:
+                    lagged = previous_sums[col - window + block]
+                    mean = ((previous_sums[block - 1] - lagged) + sums[col]) / window
+                means[name, window] = np.array([mean])
+
+        features = plan.compute(values, means)
+        state.position = position
+        state.inputs = bar
+        state.features = np.array([features[column][0] for column in plan.features])
+        return state.features
+
+    def _spec(self) -> str:
+        return json.dumps(
+            {
+                "format_version": STATE_FORMAT_VERSION,
+                "features": self.plan.features,
+                "means": self.plan.means,
+                "columns": self.plan.columns,
+                "block": self.plan.block,
+            }
+        )
+
+    def save(self, path: str) -> None:
+        """Save states of all symbols into a single .npz file at `path`, replacing it at once,
+        least recently used first"""
+        with self._lock:
+            states = list(self._states.values())
+            arrays = {
+                name: np.array([getattr(state, name) for state in states]) for name in STATE_FIELDS
+            }
+            arrays.update(spec=np.array(self._spec()), symbols=np.array(list(self._states)))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def restore(self, path: str) -> None:
+        """Replace states by those saved at `path`, which have to be saved for the same plan"""
+        with np.load(path) as saved:
+            if str(saved["spec"]) != self._spec():
+                raise ValueError(f"Feature states {path} were saved for a different plan")
+            states = OrderedDict(
+                (str(symbol), SymbolState(*fields))
+                for symbol, *fields in zip(*(saved[name] for name in ["symbols", *STATE_FIELDS]))
+            )
+        with self._lock:
+            self._states = states
+            self._evict()
@@ -1,9 +1,13 @@
-from typing import List
+from dataclasses import dataclass
+from typing import Callable, List, Optional
 
+import numpy as np
 import pandas as pd
 from loguru import logger
 
-from src.utils import log_io_length
+from src.instrumentation import instrument
+from src.schema import FEATURE_DTYPE
+from src.utils import is_sorted_by
 
 
 def moving_avg(df: pd.DataFrame, index: str | List[str], value_col: str, window: int) -> pd.Series:
@@ -17,13 +21,373 @@ def moving_avg(df: pd.DataFrame, index: str | List[str], value_col: str, window:
     )
 
 
-@log_io_length
-def calculate_features(df: pd.DataFrame, window_lengths: List[int]) -> pd.DataFrame:
+def segment_starts(keys: pd.Series) -> np.ndarray:
+    """Offsets of rows where a new segment (e.g. symbol) begins, for keys sorted so that
+    equal values are contiguous"""
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        values = keys.cat.codes.to_numpy()
+    else:
+        values = keys.to_numpy()
+    return np.flatnonzero(np.r_[len(values) > 0, values[1:] != values[:-1]])
+
+
+def block_cumsum(values: np.ndarray, block_starts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Cumulative sum restarting at every block start, returned together with each row's
+    position within its block. Blocks are laid out as rows of a zero padded 2D array, so that
+    all cumulative sums are computed by a single sequential `np.cumsum` call and every sum
+    depends only on values from its own block. `values` can also be a 2D array with one
+    series per row, all of which are summed in the same call."""
+    stacked = np.atleast_2d(values)
+    n = stacked.shape[1]
+    block_lengths = np.diff(np.r_[block_starts, n])
+    block_ids = np.repeat(np.arange(len(block_starts)), block_lengths)
+    cols = np.arange(n) - block_starts[block_ids]
+    width = block_lengths.max(initial=0)
+    flat_index = block_ids * width + cols
+    padded = np.zeros((len(stacked), len(block_starts) * width))
+    padded[:, flat_index] = stacked
+    sums = np.cumsum(padded.reshape(len(stacked), len(block_starts), width), axis=2)
+    sums = sums.reshape(len(stacked), -1)[:, flat_index]
+    return sums.reshape(values.shape), cols
+
+
+def rolling_means(
+    values: np.ndarray,
+    starts: np.ndarray,
+    windows: List[int],
+    first_positions: Optional[np.ndarray] = None,
+) -> dict[int, np.ndarray]:
+    """Rolling means for all `windows` of `values` consisting of contiguous segments beginning
+    at `starts`, computed in one pass, equivalent to pandas `groupby().rolling().mean()`.
+
+    Segments are cut into blocks of `max(windows)` rows and cumulative sums restart at every
+    block, so any window spans at most two blocks and its sum is taken either from one block,
+    or as the tail of the previous block plus the head of the current one. Values are never
+    summed across a segment boundary and precision does not degrade over long histories.
+    Windows containing NaN or reaching before segment start are NaN.
+
+    `first_positions` allows segments to hold only the tail of a longer history, by giving
+    the position of each segment's first row within that history. Since block layout depends
+    on these positions, results are identical to computing over the full history, as long as
+    tails start at a block boundary, i.e. a multiple of `max(windows)`."""
+    return stacked_rolling_means(values[None], starts, [windows], max(windows), first_positions)[0]
+
+
+def stacked_rolling_means(
+    values: np.ndarray,
+    starts: np.ndarray,
+    windows: List[List[int]],
+    block: int,
+    first_positions: Optional[np.ndarray] = None,
+) -> List[dict[int, np.ndarray]]:
+    """`rolling_means` of several series stacked as rows of 2D `values`, each of them over its
+    own `windows`, sharing segment layout and a single cumulative sum of all series. Blocks are
+    `block` rows long, which has to be at least the longest window."""
+    n = values.shape[1]
+    assert block >= max((max(w) for w in windows if w), default=1), "Block shorter than window!"
+    segment_ids = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, n]))
+    available = np.arange(n) - starts[segment_ids]
+    if first_positions is None:
+        first_positions = np.zeros(len(starts), dtype=int)
+    assert np.all(first_positions % block == 0), "Segments must start at a block boundary!"
+    positions = available + first_positions[segment_ids]
+    block_starts = np.flatnonzero((positions % block == 0) | (available == 0))
+
+    nans = np.isnan(values)
+    all_sums, cols = block_cumsum(np.where(nans, 0.0, values), block_starts)
+
+    results = []
+    for sums, series_nans, series_windows in zip(all_sums, nans, windows):
+        # shifted by one, so that index `i` holds sum up to row `i - 1` and index 0 holds zero
+        prev_sums = np.r_[0.0, sums]
+        prev_block_totals = prev_sums[np.arange(n) - cols]
+        nan_counts = np.r_[0, np.cumsum(series_nans)]
+
+        means = {}
+        for window in series_windows:
+            lagged = np.r_[np.zeros(window - 1), prev_sums[: max(n - window + 1, 0)]][:n]
+            window_sums = np.where(
+                cols >= window, sums - lagged, (prev_block_totals - lagged) + sums
+            )
+            window_sums /= window
+            window_sums[available < window - 1] = np.nan
+            if nan_counts[-1]:
+                lagged_counts = np.r_[np.zeros(window - 1), nan_counts[: max(n - window + 1, 0)]]
+                window_sums[nan_counts[1:] > lagged_counts[:n]] = np.nan
+            means[window] = window_sums
+        results.append(means)
+    return results
+
+
+def _previous(values: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Value of previous row of the same segment, NaN for first rows of segments"""
+    previous = np.r_[np.nan, values[:-1]]
+    previous[starts[starts < len(values)]] = np.nan
+    return previous
+
+
+# Intermediate series computed from input columns, shared by all features using them, given
+# input columns as float64 arrays, segment starts and already computed series
+SERIES: dict[str, Callable[[dict[str, np.ndarray], np.ndarray], np.ndarray]] = {
+    "close": lambda x, starts: x["Close"],
+    "volume": lambda x, starts: x["Volume"],
+    "change": lambda x, starts: x["Close"] - _previous(x["Close"], starts),
+    "return": lambda x, starts: x["Close"] / _previous(x["Close"], starts) - 1,
+    "return_sq": lambda x, starts: x["return"] ** 2,
+    "gain": lambda x, starts: np.maximum(x["change"], 0),
+    "loss": lambda x, starts: np.maximum(-x["change"], 0),
+}
+SERIES_DEPENDENCIES = {"return_sq": ["return"], "gain": ["change"], "loss": ["change"]}
+
+
+@dataclass(frozen=True)
+class FeatureFamily:
+    """Features `{name}_{window}` computed from rolling means of intermediate `series` of
+    input `columns`, with windows of at least `min_window` rows"""
+
+    columns: tuple[str, ...]
+    series: tuple[str, ...]
+    compute: Callable[[dict[str, np.ndarray], dict[tuple[str, int], np.ndarray], int], np.ndarray]
+    min_window: int = 1
+
+
+FEATURE_FAMILIES: dict[str, FeatureFamily] = {}
+
+
+def register_feature(
+    name: str, columns: List[str], series: List[str], min_window: int = 1
+) -> Callable:
+    """Decorator registering function computing feature family `name` of given window, from
+    intermediate series and their rolling means keyed by series name and window"""
+
+    def decorator(compute: Callable) -> Callable:
+        FEATURE_FAMILIES[name] = FeatureFamily(tuple(columns), tuple(series), compute, min_window)
+        return compute
+
+    return decorator
+
+
+@register_feature("sma", columns=["Close"], series=["close"])
+def _sma(values: dict[str, np.ndarray], means: dict, window: int) -> np.ndarray:
+    """Close price divided by its moving average"""
+    return values["close"] / means["close", window]
+
+
+@register_feature("volatility", columns=["Close"], series=["return", "return_sq"], min_window=2)
+def _volatility(values: dict[str, np.ndarray], means: dict, window: int) -> np.ndarray:
+    """Sample standard deviation of daily returns"""
+    variance = (means["return_sq", window] - means["return", window] ** 2) * (window / (window - 1))
+    return np.sqrt(np.maximum(variance, 0))
+
+
+@register_feature("rsi", columns=["Close"], series=["gain", "loss"])
+def _rsi(values: dict[str, np.ndarray], means: dict, window: int) -> np.ndarray:
+    """Relative strength index, with simple moving averages of gains and losses"""
+    gains = means["gain", window]
+    return 100 * gains / (gains + means["loss", window])
+
+
+@register_feature("volume_ratio", columns=["Volume"], series=["volume"])
+def _volume_ratio(values: dict[str, np.ndarray], means: dict, window: int) -> np.ndarray:
+    """Volume divided by its moving average"""
+    return values["volume"] / means["volume", window]
+
+
+@dataclass(frozen=True)
+class FeaturePlan:
+    """Computation of features of configured families and windows. Intermediate series are
+    computed once and rolling means of all of them come from one shared cumulative sum, so all
+    features are evaluated in a single pass over data sorted by symbol and date."""
+
+    # Family and window of each output column
+    features: dict[str, tuple[str, int]]
+    # Windows of rolling means needed for each intermediate series
+    means: dict[str, List[int]]
+    # Input columns, besides Date and Symbol
+    columns: List[str]
+    # Length of blocks of cumulative sums, see `rolling_means`
+    block: int
+
+    @classmethod
+    def from_spec(
+        cls, window_lengths: Optional[List[int]] = None, features: Optional[dict] = None
+    ) -> "FeaturePlan":
+        """Plan for features given as windows by family name, `window_lengths` being
+        a shorthand for windows of `sma` family"""
+        spec: dict[str, List[int]] = {"sma": list(window_lengths or [])}
+        for name, windows in (features or {}).items():
+            spec[name] = list(dict.fromkeys(spec.get(name, []) + list(windows)))
+        planned: dict[str, tuple[str, int]] = {}
+        means: dict[str, List[int]] = {}
+        columns: List[str] = []
+        for name, windows in spec.items():
+            if name not in FEATURE_FAMILIES:
+                raise ValueError(f"Unknown feature {name}, available: {list(FEATURE_FAMILIES)}")
+            family = FEATURE_FAMILIES[name]
+            for window in windows:
+                if window < family.min_window:
+                    raise ValueError(f"Feature {name} needs window of at least {family.min_window}")
+                planned[f"{name}_{window}"] = (name, window)
+                for series in family.series:
+                    means.setdefault(series, [])
+                    if window not in means[series]:
+                        means[series].append(window)
+            columns += [col for col in family.columns if windows and col not in columns]
+        block = max((max(windows) for windows in means.values()), default=1)
+        return cls(planned, means, columns, block)
+
+    def series(self, df: pd.DataFrame, starts: np.ndarray) -> dict[str, np.ndarray]:
+        """Intermediate series needed by the plan, for rows of `df` sorted by symbol and date"""
+        values = {column: df[column].to_numpy(dtype="float64") for column in self.columns}
+        return self.derive(values, starts)
+
+    def derive(self, values: dict[str, np.ndarray], starts: np.ndarray) -> dict[str, np.ndarray]:
+        """Intermediate series needed by the plan, added to float64 arrays of input columns"""
+        values = dict(values)
+
+        def _compute(name: str) -> None:
+            for dependency in SERIES_DEPENDENCIES.get(name, []):
+                if dependency not in values:
+                    _compute(dependency)
+            values[name] = SERIES[name](values, starts)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for name in self.means:
+                if name not in values:
+                    _compute(name)
+        return values
+
+    def evaluate(
+        self,
+        values: dict[str, np.ndarray],
+        starts: np.ndarray,
+        first_positions: Optional[np.ndarray] = None,
+    ) -> dict[str, np.ndarray]:
+        """Features of all rows of intermediate series `values`, whose segments start at
+        `starts`. See `rolling_means` for `first_positions`."""
+        names = list(self.means)
+        if not names:
+            return {}
+        stacked = np.vstack([values[name] for name in names])
+        all_means = stacked_rolling_means(
+            stacked, starts, [self.means[name] for name in names], self.block, first_positions
+        )
+        means = {
+            (name, window): series_means[window]
+            for name, series_means in zip(names, all_means)
+            for window in self.means[name]
+        }
+        return self.compute(values, means)
+
+    def compute(
+        self, values: dict[str, np.ndarray], means: dict[tuple[str, int], np.ndarray]
+    ) -> dict[str, np.ndarray]:
+        """Features from intermediate series and their rolling means by series and window"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return {
+                column: FEATURE_FAMILIES[name].compute(values, means, window).astype(FEATURE_DTYPE)
+                for column, (name, window) in self.features.items()
+            }
+
+
+@instrument()
+def calculate_features(
+    df: pd.DataFrame,
+    window_lengths: Optional[List[int]] = None,
+    features: Optional[dict[str, List[int]]] = None,
+) -> pd.DataFrame:
+    """Sort by symbol and date and add features planned by `FeaturePlan.from_spec`, e.g.
+    `sma_{window}` dividing close price by its moving average over each of `window_lengths`"""
     logger.info("Calculating features")
     input_rows = len(df)
-    df.sort_values(by=["Symbol", "Date"], inplace=True)
-    for window in window_lengths:
-        feat = f"sma_{str(window)}"
-        df[feat] = moving_avg(df, "Symbol", "Close", window)
+    if not is_sorted_by(df, ["Symbol", "Date"]):
+        df.sort_values(by=["Symbol", "Date"], inplace=True)
+    plan = FeaturePlan.from_spec(window_lengths, features)
+    if plan.features:
+        starts = segment_starts(df["Symbol"])
+        for column, values in plan.evaluate(plan.series(df, starts), starts).items():
+            df[column] = values
+    assert input_rows == len(df), "Number of rows changed!"
+    return df
+
+
+def _segment_rows(offsets: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """Row indices `offsets[k] + lower[k] .. offsets[k] + upper[k]` of all segments k"""
+    lengths = np.maximum(upper - lower, 0)
+    ids = np.repeat(np.arange(len(offsets)), lengths)
+    return (
+        offsets[ids]
+        + lower[ids]
+        + np.arange(lengths.sum())
+        - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    )
+
+
+@instrument()
+def update_features(
+    df_prev: pd.DataFrame,
+    df: pd.DataFrame,
+    window_lengths: Optional[List[int]] = None,
+    features: Optional[dict[str, List[int]]] = None,
+) -> pd.DataFrame:
+    """Incremental version of `calculate_features`, producing identical result for `df`, but
+    reusing features from `df_prev`, its output for an earlier version of the same data.
+
+    Only rows added since, together with a tail of up to two blocks of history per symbol
+    (see `rolling_means`) are recalculated. `df_prev` is expected to be sorted, as returned by
+    `calculate_features`. Symbols whose row count or tail rows no longer match, e.g. because
+    prices were split adjusted, are recalculated from scratch."""
+    logger.info("Updating features")
+    input_rows = len(df)
+    if not is_sorted_by(df, ["Symbol", "Date"]):
+        df.sort_values(by=["Symbol", "Date"], inplace=True)
+    plan = FeaturePlan.from_spec(window_lengths, features)
+    if not plan.features:
+        return df
+    block = plan.block
+
+    starts = segment_starts(df["Symbol"])
+    counts = np.diff(np.r_[starts, len(df)])
+    symbols = df["Symbol"].iloc[starts].astype(str).to_numpy()
+    prev_starts = segment_starts(df_prev["Symbol"])
+    prev_segments = pd.DataFrame(
+        {"offset": prev_starts, "count": np.diff(np.r_[prev_starts, len(df_prev)])},
+        index=df_prev["Symbol"].iloc[prev_starts].astype(str).to_numpy(),
+    ).reindex(symbols, fill_value=0)
+    prev_offsets = prev_segments["offset"].to_numpy()
+    seen = prev_segments["count"].to_numpy()
+    seen[seen > counts] = 0
+    tail_starts = np.maximum(seen - block, 0) // block * block
+
+    # Previously seen tail has to match current data, otherwise recalculate whole symbol
+    check_rows = _segment_rows(starts, tail_starts, seen)
+    prev_check_rows = _segment_rows(prev_offsets, tail_starts, seen)
+    mismatch = df["Date"].to_numpy()[check_rows] != df_prev["Date"].to_numpy()[prev_check_rows]
+    for column in plan.columns:
+        check_values = df[column].to_numpy(dtype="float64")[check_rows]
+        prev_check_values = df_prev[column].to_numpy(dtype="float64")[prev_check_rows]
+        mismatch |= (check_values != prev_check_values) & ~(
+            np.isnan(check_values) & np.isnan(prev_check_values)
+        )
+    changed = np.unique(np.searchsorted(starts, check_rows[mismatch], side="right") - 1)
+    logger.info(f"Recalculating {len(changed)} symbols with changed history")
+    seen[changed], tail_starts[changed] = 0, 0
+
+    work_rows = _segment_rows(starts, tail_starts, counts * (counts > seen))
+    work_lengths = np.where(counts > seen, counts - tail_starts, 0)
+    work_starts = (np.cumsum(work_lengths) - work_lengths)[work_lengths > 0]
+    new_mask = work_rows - np.repeat(starts, work_lengths) >= np.repeat(seen, work_lengths)
+    logger.info(f"Calculating features for {new_mask.sum()} new rows")
+
+    # Series may depend on previous rows, so they are computed over all rows
+    values = {name: series[work_rows] for name, series in plan.series(df, starts).items()}
+    new_features = plan.evaluate(values, work_starts, tail_starts[work_lengths > 0])
+    old_rows = _segment_rows(starts, np.zeros_like(seen), seen)
+    prev_rows = _segment_rows(prev_offsets, np.zeros_like(seen), seen)
+    for feat, new_values in new_features.items():
+        feat_values = np.empty(len(df), dtype=FEATURE_DTYPE)
+        feat_values[old_rows] = df_prev[feat].to_numpy()[prev_rows]
+        feat_values[work_rows[new_mask]] = new_values[new_mask]
+        df[feat] = feat_values
     assert input_rows == len(df), "Number of rows changed!"
     return df
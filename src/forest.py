@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+from src.model import ColumnSelector
+
+FOREST_FORMAT_VERSION = 1
+ARRAYS = ["feature", "threshold", "left", "right", "value", "roots"]
+META_FILE = "meta.json"
+# Written instead of forest arrays when model can't be compiled, so that directory still exists
+NOT_COMPILED_FILE = "not_compiled.txt"
+
+
+@dataclass(frozen=True)
+class CompiledForest:
+    """Random forest flattened into node arrays of all trees, predicting with vectorized numpy
+    operations instead of sklearn estimators. It's only used for inference, not fitted.
+
+    Leaves point to themselves and have infinite threshold, so samples are advanced through
+    all trees at once, until they stop moving. `value` holds class probabilities of each
+    leaf, which are averaged over trees as sklearn does."""
+
+    columns: list[str]
+    classes: np.ndarray
+    depth: int
+    version: str
+    feature: np.ndarray
+    threshold: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    value: np.ndarray
+    roots: np.ndarray
+
+    def predict_proba(self, X: pd.DataFrame | np.ndarray) -> np.ndarray:
+        # sklearn trees compare float32 features with float64 thresholds
+        if isinstance(X, pd.DataFrame):
+            X = X[self.columns].to_numpy(dtype=np.float32)
+        X = np.asarray(X, dtype=np.float32)
+        # NaN would go right at every split, sklearn forest rejects it instead
+        if not np.isfinite(X).all():
+            raise ValueError("Input X contains NaN or infinity")
+        n_samples, n_trees = len(X), len(self.roots)
+        nodes = np.tile(np.asarray(self.roots), n_samples)
+        samples = np.repeat(np.arange(n_samples), n_trees)
+        # Only (sample, tree) pairs that moved in previous step can still move
+        active = np.arange(len(nodes))
+        for _ in range(self.depth):
+            current = nodes[active]
+            go_left = X[samples[active], self.feature[current]] <= self.threshold[current]
+            following = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = following
+            active = active[following != current]
+            if not len(active):
+                break
+        return self.value[nodes].reshape(n_samples, n_trees, -1).mean(axis=1)
+
+    def predict(self, X: pd.DataFrame | np.ndarray) -> np.ndarray:
+        return self.classes[self.predict_proba(X).argmax(axis=1)]
+
+
+def compile_forest(model: Any) -> CompiledForest:
+    """Compile fitted `RandomForestClassifier`, either on its own or as the last step of
+    a pipeline whose other steps are `ColumnSelector`s. Other models raise ValueError."""
+    columns: Optional[list[str]] = None
+    if isinstance(model, Pipeline):
+        *selectors, (_, model) = model.steps
+        for _, selector in selectors:
+            if not isinstance(selector, ColumnSelector):
+                raise ValueError(f"Can't compile pipeline step {selector}")
+            columns = list(selector.columns)
+    if not isinstance(model, RandomForestClassifier):
+        raise ValueError(f"Can't compile model {model}, only random forest is supported")
+    if model.n_outputs_ != 1:
+        raise ValueError("Can't compile multi-output random forest")
+    if columns is None:
+        columns = [str(column) for column in getattr(model, "feature_names_in_", [])]
+        columns = columns or [str(i) for i in range(model.n_features_in_)]
+
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    sizes = np.array([tree.node_count for tree in trees])
+    offsets = np.cumsum(sizes) - sizes
+    arrays: dict[str, list[np.ndarray]] = {name: [] for name in ARRAYS[:-1]}
+    for tree, offset in zip(trees, offsets):
+        nodes = np.arange(tree.node_count)
+        leaf = tree.children_left == -1
+        arrays["feature"].append(np.where(leaf, 0, tree.feature).astype(np.int32))
+        arrays["threshold"].append(np.where(leaf, np.inf, tree.threshold))
+        arrays["left"].append((np.where(leaf, nodes, tree.children_left) + offset).astype(np.int32))
+        arrays["right"].append(
+            (np.where(leaf, nodes, tree.children_right) + offset).astype(np.int32)
+        )
+        counts = tree.value[:, 0, :]
+        totals = counts.sum(axis=1, keepdims=True)
+        arrays["value"].append(counts / np.where(totals == 0, 1, totals))
+
+    flat = {name: np.concatenate(values) for name, values in arrays.items()}
+    flat["roots"] = offsets.astype(np.int32)
+    return CompiledForest(
+        columns=columns,
+        classes=np.asarray(model.classes_),
+        depth=max(tree.max_depth for tree in trees),
+        version=_content_hash(flat),
+        **flat,
+    )
+
+
+def _content_hash(arrays: dict[str, np.ndarray]) -> str:
+    digest = hashlib.sha256()
+    for name in ARRAYS:
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def save_forest(forest: CompiledForest, path: str) -> None:
+    """Save node arrays as .npy files into `path` directory, named by forest version, so that
+    arrays memory mapped by readers are never overwritten. Metadata file pointing to them is
+    replaced last and arrays of other versions are removed afterwards, together with marker of
+    model that wasn't compiled."""
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(path, _array_file(name, forest.version)), getattr(forest, name))
+    meta = {
+        "format_version": FOREST_FORMAT_VERSION,
+        "version": forest.version,
+        "columns": forest.columns,
+        "classes": forest.classes.tolist(),
+        "depth": forest.depth,
+    }
+    tmp_path = os.path.join(path, f"{META_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+    current = {_array_file(name, forest.version) for name in ARRAYS}
+    for file in os.listdir(path):
+        if (file.endswith(".npy") and file not in current) or file == NOT_COMPILED_FILE:
+            os.remove(os.path.join(path, file))
+
+
+def save_not_compiled(path: str, reason: str) -> None:
+    """Replace compiled forest at `path` by a marker saying why model wasn't compiled. Readers
+    only load forest with metadata file, so they fall back to the pickled model."""
+    os.makedirs(path, exist_ok=True)
+    for file in os.listdir(path):
+        if file == META_FILE or file.endswith(".npy"):
+            os.remove(os.path.join(path, file))
+    with open(os.path.join(path, NOT_COMPILED_FILE), "w", encoding="utf-8") as f:
+        f.write(f"{reason}\n")
+
+
+def is_compiled(path: str) -> bool:
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+def load_forest(path: str, mmap: bool = True) -> CompiledForest:
+    """Load forest saved by `save_forest`, memory mapping its arrays by default"""
+    with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["format_version"] != FOREST_FORMAT_VERSION:
+        raise ValueError(f"Unsupported forest format version {meta['format_version']}")
+    arrays = {
+        name: np.load(
+            os.path.join(path, _array_file(name, meta["version"])),
+            mmap_mode="r" if mmap else None,
+        )
+        for name in ARRAYS
+    }
+    return CompiledForest(
+        columns=meta["columns"],
+        classes=np.array(meta["classes"]),
+        depth=meta["depth"],
+        version=meta["version"],
+        **arrays,
+    )
+
+
+def _array_file(name: str, version: str) -> str:
+    return f"{name}-{version}.npy"
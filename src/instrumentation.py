@@ -0,0 +1,232 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from functools import wraps
+from typing import Any, Callable, Iterator, Optional
+
+import pandas as pd
+from loguru import logger
+
+# Directory of per-stage metrics files tracked by DVC
+METRICS_DIR = "metrics"
+# Set to a directory to dump cProfile stats of instrumented steps, viewable e.g. by snakeviz
+PROFILE_DIR_ENV = "FISHSTICK_PROFILE_DIR"
+# Comma separated names of steps to profile, all of them if not set
+PROFILE_STEPS_ENV = "FISHSTICK_PROFILE_STEPS"
+
+
+@dataclass
+class StepMetrics:
+    calls: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_mb: float = 0.0
+    rows_in: int = 0
+    rows_out: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+
+
+class ActiveStep:
+    """Step being measured, to which rows and bytes processed can be reported"""
+
+    def __init__(self, name: str, rows_in: Optional[int] = None) -> None:
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out: Optional[int] = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_rss = 0
+
+
+_metrics: dict[str, StepMetrics] = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _active_steps() -> list[ActiveStep]:
+    if not hasattr(_local, "steps"):
+        _local.steps = []
+    return _local.steps
+
+
+def _peak_rss() -> int:
+    """Resident set size high water mark of the process, in bytes"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _reset_peak_rss() -> None:
+    """Reset high water mark to current RSS where supported (Linux), otherwise peak of
+    a step is the peak of the process so far"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def record_io(bytes_read: int = 0, bytes_written: int = 0) -> None:
+    """Attribute bytes read or written to the innermost active step, if any"""
+    steps = _active_steps()
+    if steps:
+        steps[-1].bytes_read += bytes_read
+        steps[-1].bytes_written += bytes_written
+
+
+@contextmanager
+def step(name: str, rows_in: Optional[int] = None) -> Iterator[ActiveStep]:
+    """Measure wall time, CPU time and peak RSS of a block, together with rows and bytes
+    reported to the yielded step, and add them to metrics of step `name`. Steps can be
+    nested, peak RSS of a step includes peaks of steps nested in it.
+
+    Peak RSS is a process-wide high water mark, reset at the start of each step, so it's only
+    measured in the thread running a stage of `instrument_stage`. Steps run elsewhere, e.g. by
+    API request threads, would reset each other's peaks, so they report 0.
+
+    If `FISHSTICK_PROFILE_DIR` environment variable is set, block is also profiled with
+    cProfile and stats are written to `{name}.prof` file in that directory."""
+    steps = _active_steps()
+    track_peak_rss = getattr(_local, "track_peak_rss", False)
+    if track_peak_rss:
+        # Credit peak so far to enclosing step, before resetting high water mark for this one
+        if steps:
+            steps[-1].peak_rss = max(steps[-1].peak_rss, _peak_rss())
+        _reset_peak_rss()
+    active = ActiveStep(name, rows_in)
+    steps.append(active)
+    profiler = _start_profiler(name)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield active
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if profiler is not None:
+            _stop_profiler(profiler, name)
+        steps.pop()
+        if track_peak_rss:
+            active.peak_rss = max(active.peak_rss, _peak_rss())
+        if steps:
+            steps[-1].peak_rss = max(steps[-1].peak_rss, active.peak_rss)
+        _add_metrics(active, wall, cpu)
+
+
+def _add_metrics(active: ActiveStep, wall: float, cpu: float) -> None:
+    with _lock:
+        metrics = _metrics.setdefault(active.name, StepMetrics())
+        metrics.calls += 1
+        metrics.wall_s += wall
+        metrics.cpu_s += cpu
+        metrics.peak_rss_mb = max(metrics.peak_rss_mb, active.peak_rss / 2**20)
+        metrics.rows_in += active.rows_in or 0
+        metrics.rows_out += active.rows_out or 0
+        metrics.bytes_read += active.bytes_read
+        metrics.bytes_written += active.bytes_written
+    logger.info(
+        f"Step {active.name}: {wall:.2f}s wall, {cpu:.2f}s CPU, "
+        f"peak RSS {active.peak_rss / 2**20:.0f} MB"
+    )
+
+
+def _start_profiler(name: str) -> Optional[cProfile.Profile]:
+    profile_steps = os.getenv(PROFILE_STEPS_ENV)
+    if not os.getenv(PROFILE_DIR_ENV) or getattr(_local, "profiling", False):
+        return None
+    if profile_steps and name not in profile_steps.split(","):
+        return None
+    _local.profiling = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler: cProfile.Profile, name: str) -> None:
+    profiler.disable()
+    _local.profiling = False
+    profile_dir = os.environ[PROFILE_DIR_ENV]
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{name}.prof")
+    profiler.dump_stats(path)
+    logger.info(f"Profile of step {name} written to {path}")
+
+
+def _length(obj: Any) -> Optional[int]:
+    return len(obj) if isinstance(obj, (pd.DataFrame, pd.Series)) else None
+
+
+def instrument(name: Optional[str] = None) -> Callable:
+    """Decorator measuring each call of a function as `step`, named after the function by
+    default. Rows in and out are lengths of the first DataFrame argument and of the result,
+    which are also logged."""
+
+    def decorator(func: Callable) -> Callable:
+        step_name = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            lengths = map(_length, [*args, *kwargs.values()])
+            rows_in = next((length for length in lengths if length is not None), None)
+            if rows_in is not None:
+                logger.info(f"Input length: {rows_in}")
+            with step(step_name, rows_in) as active:
+                result = func(*args, **kwargs)
+                active.rows_out = _length(result)
+            if active.rows_out is not None:
+                logger.info(f"Output length: {active.rows_out}")
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def get_metrics() -> dict[str, dict[str, Any]]:
+    with _lock:
+        return {name: asdict(metrics) for name, metrics in _metrics.items()}
+
+
+def reset_metrics() -> None:
+    with _lock:
+        _metrics.clear()
+
+
+def save_metrics(path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(get_metrics(), f, indent=2)
+
+
+def instrument_stage(name: str) -> Callable:
+    """Decorator for pipeline stage entrypoints, measuring the whole stage together with
+    instrumented steps it runs and writing their metrics to `metrics/{name}.json`. Peak RSS
+    of steps is only measured within a stage."""
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            reset_metrics()
+            _local.track_peak_rss = True
+            try:
+                with step(name):
+                    result = func(*args, **kwargs)
+            finally:
+                _local.track_peak_rss = False
+            save_metrics(os.path.join(METRICS_DIR, f"{name}.json"))
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,98 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from src.instrumentation import record_io
+from src.schema import FEATURE_DTYPE, TARGET_DTYPE
+
+MATRIX_FORMAT_VERSION = 1
+MATRIX_ARRAYS = ["X", "y", "dates"]
+META_FILE = "meta.json"
+
+
+@dataclass(frozen=True)
+class FeatureMatrix:
+    """Features, target and dates of dataset rows as plain numpy arrays, which can be saved to
+    .npy files and memory mapped by other processes instead of pickling a DataFrame to them.
+
+    Features are a C-contiguous float32 array with `columns` in order of the model's
+    `ColumnSelector`. `splits` maps names of datasets to ranges of their rows, which can be
+    taken as views without copying."""
+
+    X: np.ndarray
+    y: np.ndarray
+    dates: np.ndarray
+    columns: list[str]
+    target_col: str = "target"
+    splits: dict[str, tuple[int, int]] = field(default_factory=dict)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pd.DataFrame,
+        features: list[str],
+        target_col: str = "target",
+        split_col: Optional[str] = None,
+    ) -> "FeatureMatrix":
+        """Matrix of `features` and target of `df` rows. With `split_col`, rows where it's true
+        are placed first, followed by the others, as `train` and `test` splits."""
+        splits: dict[str, tuple[int, int]] = {}
+        if split_col is not None:
+            is_train = df[split_col].to_numpy(dtype=bool)
+            n_train = int(is_train.sum())
+            if not is_train[:n_train].all():
+                df = df.take(np.argsort(~is_train, kind="stable"))
+            splits = {"train": (0, n_train), "test": (n_train, len(df))}
+        return cls(
+            X=np.ascontiguousarray(df[features].to_numpy(dtype=FEATURE_DTYPE)),
+            y=df[target_col].to_numpy(dtype=TARGET_DTYPE),
+            dates=df["Date"].to_numpy(dtype="datetime64[ns]"),
+            columns=list(features),
+            target_col=target_col,
+            splits=splits,
+        )
+
+    def frame(self, rows: np.ndarray | slice) -> tuple[pd.DataFrame, np.ndarray]:
+        """Features of `rows` as a DataFrame, as models expect them, and their target. Slice of
+        rows gives views of the arrays, array of rows copies them."""
+        return pd.DataFrame(self.X[rows], columns=self.columns, copy=False), self.y[rows]
+
+    def split(self, name: str) -> tuple[pd.DataFrame, np.ndarray]:
+        start, end = self.splits[name]
+        return self.frame(slice(start, end))
+
+
+def save_matrix(matrix: FeatureMatrix, path: str) -> None:
+    os.makedirs(path, exist_ok=True)
+    for name in MATRIX_ARRAYS:
+        file_path = os.path.join(path, f"{name}.npy")
+        np.save(file_path, getattr(matrix, name))
+        record_io(bytes_written=os.path.getsize(file_path))
+    meta = {
+        "format_version": MATRIX_FORMAT_VERSION,
+        "columns": matrix.columns,
+        "target_col": matrix.target_col,
+        "splits": matrix.splits,
+    }
+    with open(os.path.join(path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def load_matrix(path: str, mmap: bool = True) -> FeatureMatrix:
+    """Load matrix saved by `save_matrix`, memory mapping its arrays by default"""
+    with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["format_version"] != MATRIX_FORMAT_VERSION:
+        raise ValueError(f"Unsupported matrix format version {meta['format_version']}")
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+        for name in MATRIX_ARRAYS
+    }
+    splits = {name: (start, end) for name, (start, end) in meta["splits"].items()}
+    return FeatureMatrix(
+        columns=meta["columns"], target_col=meta["target_col"], splits=splits, **arrays
+    )
@@ -1,6 +1,10 @@
+import hashlib
 import json
-from dataclasses import dataclass
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
 from enum import StrEnum
+from functools import partial
 from typing import List, Optional, Protocol
 
 import dill
@@ -12,11 +16,12 @@ from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.metrics import auc, roc_curve
 from sklearn.pipeline import Pipeline
 
+from src.instrumentation import instrument
+from src.matrix import FeatureMatrix, load_matrix, save_matrix
+from src.schema import SPLIT_COLUMN
 
-class Model(Protocol):
-    def fit(self, X: pd.DataFrame, y: pd.Series) -> "Model":
-        ...
 
+class Predictor(Protocol):
     def predict(self, X: pd.DataFrame) -> np.ndarray:
         ...
 
@@ -24,14 +29,101 @@ class Model(Protocol):
         ...
 
 
+class Model(Predictor, Protocol):
+    def fit(self, X: pd.DataFrame, y: pd.Series) -> "Model":
+        ...
+
+
+@dataclass
+class FoldMetrics:
+    train_start: str
+    train_end: str
+    test_start: str
+    test_end: str
+    train_rows: int
+    test_rows: int
+    train_score: float
+    test_score: float
+
+
 @dataclass
 class Metrics:
     train_score: float
     test_score: float
+    cv_test_score_mean: Optional[float] = None
+    cv_test_score_std: Optional[float] = None
+    folds: list[FoldMetrics] = field(default_factory=list)
 
     def save(self, path: str) -> None:
         with open(path, "w", encoding="utf-8") as f:
-            json.dump(self.__dict__, f)
+            json.dump(asdict(self), f)
+
+
+class WindowType(StrEnum):
+    EXPANDING = "expanding"
+    SLIDING = "sliding"
+
+
+@dataclass
+class CVConfig:
+    # Number of walk-forward folds evaluated on training data, 0 disables cross-validation
+    n_folds: int = 0
+    window: str = WindowType.EXPANDING
+    # Number of periods, each as long as a test period, to train on with sliding window
+    train_periods: int = 1
+    # Number of days target looks ahead, as `look_ahead_days` of target stage
+    look_ahead_days: int = 1
+    # Number of dates left out between train and test period, to keep targets looking
+    # ahead from leaking test prices into training, `look_ahead_days` if not set
+    gap: Optional[int] = None
+    max_workers: int = 1
+
+    def __post_init__(self) -> None:
+        if self.gap is None:
+            self.gap = self.look_ahead_days
+        if self.gap < self.look_ahead_days:
+            raise ValueError(
+                f"Gap of {self.gap} dates leaks targets looking {self.look_ahead_days} days "
+                "ahead into training"
+            )
+
+
+@dataclass(frozen=True)
+class Fold:
+    """Inclusive date ranges of a walk-forward fold"""
+
+    train_start: np.datetime64
+    train_end: np.datetime64
+    test_start: np.datetime64
+    test_end: np.datetime64
+
+
+def walk_forward_folds(dates: np.ndarray, config: CVConfig) -> list[Fold]:
+    """Split unique `dates` into `n_folds + 1` consecutive periods with equal number of
+    dates. Each fold tests on one of the periods after the first, training on all periods
+    before it with expanding window, or on `train_periods` periods before it with sliding
+    window. Last `gap` dates before test period are not trained on."""
+    unique = np.unique(dates)
+    if len(unique) < config.n_folds + 1:
+        raise ValueError(f"Can't split {len(unique)} dates into {config.n_folds} folds")
+    bounds = np.linspace(0, len(unique), config.n_folds + 2).astype(int)
+    folds = []
+    for k in range(1, config.n_folds + 1):
+        train_start = 0
+        if config.window == WindowType.SLIDING:
+            train_start = bounds[max(k - config.train_periods, 0)]
+        train_end = bounds[k] - config.gap
+        if train_end <= train_start:
+            raise ValueError(f"No dates to train on in fold {k} with gap of {config.gap} dates")
+        folds.append(
+            Fold(
+                unique[train_start],
+                unique[train_end - 1],
+                unique[bounds[k]],
+                unique[bounds[k + 1] - 1],
+            )
+        )
+    return folds
 
 
 class Dataset(StrEnum):
@@ -49,41 +141,132 @@ def load_model(path: str) -> Model:
         return dill.load(f)
 
 
+def model_version(content: bytes) -> str:
+    """Version of model pickled by `save_model`, as hash of its content"""
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def score(model: Model, X: pd.DataFrame, y: pd.Series | np.ndarray) -> float:
+    preds = model.predict(X)
+    fpr, tpr, _ = roc_curve(y, preds)
+    return float(auc(fpr, tpr))
+
+
+def _evaluate_fold(model: Model, matrix_path: str, fold: Fold) -> FoldMetrics:
+    matrix = load_matrix(matrix_path)
+    train_rows = np.flatnonzero(
+        (matrix.dates >= fold.train_start) & (matrix.dates <= fold.train_end)
+    )
+    test_rows = np.flatnonzero((matrix.dates >= fold.test_start) & (matrix.dates <= fold.test_end))
+    x_train, y_train = matrix.frame(train_rows)
+    x_test, y_test = matrix.frame(test_rows)
+    model = model.fit(x_train, y_train)
+    return FoldMetrics(
+        train_start=str(fold.train_start.astype("datetime64[D]")),
+        train_end=str(fold.train_end.astype("datetime64[D]")),
+        test_start=str(fold.test_start.astype("datetime64[D]")),
+        test_end=str(fold.test_end.astype("datetime64[D]")),
+        train_rows=len(train_rows),
+        test_rows=len(test_rows),
+        train_score=score(model, x_train, y_train),
+        test_score=score(model, x_test, y_test),
+    )
+
+
 class ModelTrainer:
     model: Model
     metrics: Metrics
 
-    def __init__(self, features: List[str], target_col: str = "target") -> None:
+    def __init__(
+        self, features: List[str], target_col: str = "target", cv: Optional[CVConfig] = None
+    ) -> None:
         self.features = features
         self.target_col = target_col
+        self.cv = cv or CVConfig()
 
+    @instrument()
     def run(self, model: Model, df: pd.DataFrame) -> None:
+        folds = self.walk_forward(model, df) if self.cv.n_folds else []
+
         logger.info("Training model")
         x_train, y_train = self.get_dataset_xy(df, Dataset.TRAIN)
         x_test, y_test = self.get_dataset_xy(df, Dataset.TEST)
+        self._fit(model, (x_train, y_train), (x_test, y_test), folds)
+
+    @instrument()
+    def run_matrix(self, model: Model, matrix_path: str) -> None:
+        """Same as `run`, on memory mapped `FeatureMatrix` saved by dataset stage. Model is
+        trained and scored on views of train and test rows, so features are only copied if
+        the model selects other columns than the matrix holds, or needs them in other layout."""
+        matrix = load_matrix(matrix_path)
+        if matrix.target_col != self.target_col:
+            raise ValueError(f"Matrix holds target {matrix.target_col}, not {self.target_col}")
+        if matrix.columns != self.features:
+            raise ValueError(f"Matrix holds features {matrix.columns}, not {self.features}")
+        folds = []
+        if self.cv.n_folds:
+            start, end = matrix.splits[Dataset.TRAIN]
+            folds = self._walk_forward(model, matrix_path, matrix.dates[start:end])
 
         logger.info("Training model")
-        self.model = model.fit(x_train, y_train)
+        self._fit(model, matrix.split(Dataset.TRAIN), matrix.split(Dataset.TEST), folds)
 
+    def _fit(
+        self,
+        model: Model,
+        train: tuple[pd.DataFrame, pd.Series | np.ndarray],
+        test: tuple[pd.DataFrame, pd.Series | np.ndarray],
+        folds: list[FoldMetrics],
+    ) -> None:
+        self.model = model.fit(*train)
+
+        fold_scores = [fold.test_score for fold in folds]
         self.metrics = Metrics(
-            train_score=self.score_model(x_train, y_train),
-            test_score=self.score_model(x_test, y_test),
+            train_score=self.score_model(*train),
+            test_score=self.score_model(*test),
+            cv_test_score_mean=float(np.mean(fold_scores)) if folds else None,
+            cv_test_score_std=float(np.std(fold_scores)) if folds else None,
+            folds=folds,
         )
         logger.info(f"Model metrics: {self.metrics}")
 
+    @instrument()
+    def walk_forward(self, model: Model, df: pd.DataFrame) -> list[FoldMetrics]:
+        """Evaluate unfitted `model` on walk-forward folds of training data. Folds run in
+        parallel on a process pool, with workers memory mapping one copy of the features saved
+        to a temporary directory, instead of receiving the data pickled. Models using all cores
+        themselves, e.g. with `n_jobs=-1`, compete for them with other workers."""
+        df = df.loc[df[SPLIT_COLUMN]]
+        with tempfile.TemporaryDirectory() as matrix_path:
+            save_matrix(FeatureMatrix.from_frame(df, self.features, self.target_col), matrix_path)
+            dates = df["Date"].to_numpy()
+            del df
+            return self._walk_forward(model, matrix_path, dates)
+
+    def _walk_forward(
+        self, model: Model, matrix_path: str, train_dates: np.ndarray
+    ) -> list[FoldMetrics]:
+        folds = walk_forward_folds(train_dates, self.cv)
+        logger.info(f"Evaluating {len(folds)} walk-forward folds")
+        with ProcessPoolExecutor(max_workers=self.cv.max_workers) as executor:
+            results = list(executor.map(partial(_evaluate_fold, model, matrix_path), folds))
+        for i, result in enumerate(results):
+            logger.info(f"Fold {i}: {result}")
+        return results
+
+    @instrument()
     def get_dataset_xy(
         self,
         df: pd.DataFrame,
         dataset: Dataset,
     ) -> tuple[pd.DataFrame, pd.Series]:
         logger.info("Splitting into train/test")
-        df = df.loc[lambda x: x["dataset"] == dataset]  # type: ignore
+        df = df.loc[df[SPLIT_COLUMN] == (dataset == Dataset.TRAIN)]
         return df[self.features], df[self.target_col]
 
-    def score_model(self, X: pd.DataFrame, y: pd.Series) -> float:
-        preds = self.model.predict(X)
-        fpr, tpr, _ = roc_curve(y, preds)
-        return float(auc(fpr, tpr))
+    @instrument()
+    def score_model(self, X: pd.DataFrame, y: pd.Series | np.ndarray) -> float:
+        return score(self.model, X, y)
 
 
 def make_pipeline(steps_config: dict) -> Model:
@@ -108,4 +291,7 @@ class ColumnSelector(BaseEstimator, TransformerMixin):
         return self
 
     def transform(self, X: pd.DataFrame, y: Optional[pd.Series] = None) -> pd.DataFrame:
+        # Selecting columns copies them, even if they are already in the right order
+        if list(X.columns) == list(self.columns):
+            return X
         return X[self.columns]
@@ -0,0 +1,121 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+
+from src.instrumentation import record_io
+from src.utils import PARQUET_ROW_GROUP_SIZE, parquet_write_options
+
+# Rough allowance for copies made while processing a partition, e.g. by sorting
+PROCESSING_OVERHEAD = 3
+
+
+def partition_symbols(row_counts: pd.Series, max_rows: int) -> List[List[str]]:
+    """Group consecutive symbols into partitions of at most `max_rows` rows. Symbol with more
+    rows than that can't be split and is placed into a partition of its own."""
+    partitions: List[List[str]] = []
+    current: List[str] = []
+    rows = 0
+    for symbol, count in row_counts.items():
+        if current and rows + count > max_rows:
+            partitions.append(current)
+            current, rows = [], 0
+        if count > max_rows:
+            logger.warning(f"Symbol {symbol} with {count} rows exceeds partition size")
+        current.append(str(symbol))
+        rows += count
+    if current:
+        partitions.append(current)
+    return partitions
+
+
+def _process_partition(
+    func: Callable[..., pd.DataFrame],
+    path: str,
+    columns: List[str],
+    symbols: List[str],
+    categories: pd.Index,
+    kwargs: dict[str, Any],
+) -> pd.DataFrame:
+    df = pd.read_parquet(path, columns=columns, filters=[("Symbol", "in", symbols)])
+    df = func(df, **kwargs)
+    # Same dictionary in every partition, so that all of them share one parquet schema
+    return df.assign(Symbol=lambda x: pd.Categorical(x["Symbol"], categories=categories))
+
+
+def run_partitioned(
+    func: Callable[..., pd.DataFrame],
+    input_path: str,
+    output_path: str,
+    columns: List[str],
+    memory_budget_mb: float,
+    max_workers: int = 1,
+    **kwargs,
+) -> None:
+    """Out-of-core alternative to reading `input_path` into a single frame and applying
+    `func` to it, for functions operating on each symbol independently.
+
+    Symbols are grouped into partitions sized to fit `memory_budget_mb`, considering that up
+    to `max_workers` partitions are processed in parallel on a process pool, and each of them
+    may be held once more while waiting to be written. Workers read their partition using
+    a parquet filter and results are appended to `output_path` in symbol order, as soon as
+    they are available. Output has the same rows and dtypes as processing all data at once.
+
+    Parquet filter still loads whole row groups, so the budget can only be kept if they're
+    small enough, as in files written by `write_parquet`. Larger ones are warned about."""
+    symbol = pd.read_parquet(input_path, columns=["Symbol"])["Symbol"].astype("category")
+    row_counts = symbol.value_counts(sort=False).sort_index()
+    categories = symbol.cat.categories
+    del symbol
+
+    sample = _process_partition(
+        func, input_path, columns, [str(row_counts.index[0])], categories, kwargs
+    )
+    row_bytes = PROCESSING_OVERHEAD * sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    max_rows = int(memory_budget_mb * 2**20 / (2 * max_workers * row_bytes))
+    partitions = partition_symbols(row_counts[row_counts > 0], max(max_rows, 1))
+    metadata = pq.read_metadata(input_path)
+    row_group_rows = max(metadata.row_group(i).num_rows for i in range(metadata.num_row_groups))
+    if row_group_rows > max_rows:
+        logger.warning(
+            f"Row groups of {input_path} have up to {row_group_rows} rows, more than "
+            f"{max_rows} rows fitting memory budget, which will be exceeded. Write it in "
+            "smaller row groups, e.g. using `write_parquet`."
+        )
+    logger.info(
+        f"Processing {row_counts.sum()} rows in {len(partitions)} partitions "
+        f"of up to {max_rows} rows, using {max_workers} workers"
+    )
+
+    writer = None
+
+    def _write(df: pd.DataFrame) -> None:
+        nonlocal writer
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        writer = writer or pq.ParquetWriter(
+            output_path, table.schema, **parquet_write_options(table.schema)
+        )
+        writer.write_table(table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending: deque = deque()
+            for symbols in partitions:
+                pending.append(
+                    executor.submit(
+                        _process_partition, func, input_path, columns, symbols, categories, kwargs
+                    )
+                )
+                if len(pending) == max_workers:
+                    _write(pending.popleft().result())
+            while pending:
+                _write(pending.popleft().result())
+    finally:
+        if writer is not None:
+            writer.close()
+            record_io(bytes_written=os.path.getsize(output_path))
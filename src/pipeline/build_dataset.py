@@ -0,0 +1,76 @@
+from dataclasses import dataclass
+
+import hydra
+import pandas as pd
+from loguru import logger
+from omegaconf import DictConfig
+
+from src.features import FeaturePlan, calculate_features
+from src.instrumentation import instrument_stage
+from src.pipeline.calculate_features import FeatureConfig
+from src.pipeline.dataset import DatasetConfig, create_dataset, write_matrix
+from src.pipeline.target import TargetConfig, calculate_target
+from src.utils import parse_dict_config, read_parquet, write_parquet
+
+
+@dataclass
+class BuildDatasetConfig:
+    input_path: str
+    output_path: str
+    features: FeatureConfig
+    target: TargetConfig
+    dataset: DatasetConfig
+
+
+def build_dataset(
+    df: pd.DataFrame, features: FeatureConfig, target: TargetConfig, dataset: DatasetConfig
+) -> pd.DataFrame:
+    """Run features, target and dataset steps on raw data in memory. Data is sorted once up
+    front, so neither step sorts it again and target can be attached without a join."""
+    df = df.sort_values(["Symbol", "Date"], ignore_index=True)
+    df_target = calculate_target(df[target.columns], target.look_ahead_days)
+    plan = FeaturePlan.from_spec(features.window_lengths, features.features)
+    df_features = calculate_features(
+        df[list(dict.fromkeys(features.columns + plan.columns))],
+        features.window_lengths,
+        features.features,
+    )
+    return create_dataset(
+        df_features,
+        df_target,
+        dataset.longest_window_feature,
+        dataset.train_cutoff,
+        dataset.target_cols,
+    )
+
+
+@hydra.main(config_path="../../config", config_name="build_dataset", version_base=None)
+@instrument_stage("build_dataset")
+def main(config_: DictConfig) -> None:
+    """Fused alternative to running features, target and dataset stages one by one, reading
+    raw data once and writing only the final dataset"""
+    config: BuildDatasetConfig = parse_dict_config(BuildDatasetConfig, config_)
+    logger.info(f"Starting fused dataset build step, using config: \n{config}")
+
+    logger.info("Reading data")
+    plan = FeaturePlan.from_spec(config.features.window_lengths, config.features.features)
+    columns = list(dict.fromkeys(config.features.columns + plan.columns + config.target.columns))
+    df = read_parquet(config.input_path, columns=columns)
+
+    df = build_dataset(df, config.features, config.target, config.dataset)
+
+    logger.info("Writing result")
+    write_parquet(df, config.output_path)
+    if config.dataset.matrix_path is not None:
+        write_matrix(
+            df,
+            config.dataset.matrix_path,
+            config.dataset.matrix_columns,
+            config.dataset.matrix_target,
+        )
+
+    logger.info("Done!")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=E1120:no-value-for-parameter
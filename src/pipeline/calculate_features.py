@@ -1,13 +1,16 @@
+import os
 from dataclasses import dataclass, field
-from typing import List
+from typing import Any, List, Optional
 
 import hydra
 import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
 
-from src.features import calculate_features
-from src.utils import parse_dict_config
+from src.features import FeaturePlan, calculate_features, update_features
+from src.instrumentation import instrument_stage
+from src.partition import run_partitioned
+from src.utils import load_config, parse_dict_config, read_parquet, write_parquet
 
 WINDOW_LENGTHS = [50, 100, 200]
 
@@ -18,22 +21,69 @@ class FeatureConfig:
     output_path: str
     columns: List[str]
     window_lengths: List[int] = field(default_factory=lambda: WINDOW_LENGTHS)
+    # Windows of other feature families by name, see `src.features.FEATURE_FAMILIES`
+    features: dict[str, List[int]] = field(default_factory=dict)
+    incremental: bool = False
+    memory_budget_mb: Optional[float] = None
+    max_workers: int = 1
+
+
+def load_feature_spec() -> dict[str, Any]:
+    """Features configured for the features stage, as keyword arguments of
+    `calculate_features`, so that other consumers compute exactly the same features"""
+    config = load_config("features")
+    return {"window_lengths": config["window_lengths"], "features": config["features"]}
 
 
 @hydra.main(config_path="../../config", config_name="features", version_base=None)
+@instrument_stage("features")
 def main(config_: DictConfig) -> None:
     config: FeatureConfig = parse_dict_config(FeatureConfig, config_)
     logger.info(f"Starting feature creation step, using config: \n{config}")
+    run(config)
+    logger.info("Done!")
 
-    logger.info("Reading data")
-    df = pd.read_parquet(config.input_path, columns=config.columns)
 
-    df = calculate_features(df, window_lengths=config.window_lengths)
+def run(config: FeatureConfig, df: Optional[pd.DataFrame] = None) -> Optional[pd.DataFrame]:
+    """Calculate features of raw data and write them to output path. Raw data is read from
+    input path, unless it's given as `df`. Returns the features, unless they were processed
+    out-of-core in partitions, which always read input path."""
+    plan = FeaturePlan.from_spec(config.window_lengths, config.features)
+    columns = list(dict.fromkeys(config.columns + plan.columns))
+    if config.memory_budget_mb is not None and config.incremental:
+        logger.warning("Memory budget is ignored in incremental mode, processing all data at once")
+    if config.memory_budget_mb is not None and not config.incremental:
+        run_partitioned(
+            calculate_features,
+            config.input_path,
+            config.output_path,
+            columns,
+            config.memory_budget_mb,
+            config.max_workers,
+            window_lengths=config.window_lengths,
+            features=config.features,
+        )
+        return None
 
-    logger.info("Writing result")
-    df.to_parquet(config.output_path, index=False)
+    if df is None:
+        logger.info("Reading data")
+        df = read_parquet(config.input_path, columns=columns)
+    else:
+        df = df[columns]
 
-    logger.info("Done!")
+    df_prev = None
+    if config.incremental and os.path.exists(config.output_path):
+        logger.info("Reading previous results")
+        df_prev = read_parquet(config.output_path)
+
+    if df_prev is not None and set(plan.features).issubset(df_prev.columns):
+        df = update_features(df_prev, df, config.window_lengths, config.features)
+    else:
+        df = calculate_features(df, config.window_lengths, config.features)
+
+    logger.info("Writing result")
+    write_parquet(df, config.output_path)
+    return df
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import List, Optional
 
 import hydra
 import numpy as np
@@ -6,7 +7,10 @@ import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
 
-from src.utils import log_io_length, parse_dict_config
+from src.instrumentation import instrument, instrument_stage
+from src.matrix import FeatureMatrix, save_matrix
+from src.schema import SPLIT_COLUMN, TARGET_DTYPE
+from src.utils import parse_dict_config, read_parquet, write_parquet
 
 
 @dataclass
@@ -16,52 +20,119 @@ class DatasetConfig:
     longest_window_feature: str
     train_cutoff: str
     output_path: str
-
-
-@log_io_length
+    # Target columns to keep, all of them by default
+    target_cols: Optional[List[str]] = None
+    # Directory to also save dataset as memory mappable `FeatureMatrix` of `matrix_columns`
+    # and `matrix_target`
+    matrix_path: Optional[str] = None
+    matrix_columns: list[str] = field(default_factory=list)
+    matrix_target: str = "target"
+
+
+def keys_aligned(left: pd.DataFrame, right: pd.DataFrame, keys: List[str]) -> bool:
+    """Check whether both frames hold identical key values in the same row order. Categorical
+    keys sharing categories are compared by their codes, avoiding materializing strings."""
+    for key in keys:
+        left_key, right_key = left[key], right[key]
+        if (
+            isinstance(left_key.dtype, pd.CategoricalDtype)
+            and isinstance(right_key.dtype, pd.CategoricalDtype)
+            and left_key.cat.categories.equals(right_key.cat.categories)
+        ):
+            left_key, right_key = left_key.cat.codes, right_key.cat.codes
+        if not np.array_equal(left_key.to_numpy(), right_key.to_numpy()):
+            return False
+    return True
+
+
+@instrument()
 def create_dataset(
     df_features: pd.DataFrame,
     df_target: pd.DataFrame,
     longest_window_feature: str,
     train_cutoff: str,
+    target_cols: Optional[List[str]] = None,
 ) -> pd.DataFrame:
     """Join target with features, filter out rows where either target or longest
-    window feature is not available and indicate train/test split based on point
-    in time. Convert target to binary integer for compatibility with sklearn's
-    classifiers"""
+    window feature is not available and flag rows before `train_cutoff` as train set in
+    boolean `is_train` column. Convert target to binary integer for compatibility with
+    sklearn's classifiers.
+
+    All target columns, e.g. of multiple horizons, are joined unless `target_cols` are given.
+    Rows are kept only where every joined target is available.
+
+    Both inputs usually come sorted by symbol and date from the same raw data, in which case
+    target is attached column-wise, skipping the hash join."""
     logger.info("Creating dataset")
 
     msg = "Raw target and features should contain same number of rows!"
     assert len(df_features) == len(df_target), msg
 
+    if target_cols is None:
+        target_cols = [col for col in df_target.columns if col.split("_")[0] == "target"]
+
     join_columns = ["Date", "Symbol"]
-    return (
-        df_features.merge(df_target[join_columns + ["target"]], on=join_columns, how="inner")
-        .loc[lambda x: ~(x["target"].isnull() | x[longest_window_feature].isnull())]
-        .assign(
-            dataset=lambda x: np.where(x["Date"] < train_cutoff, "train", "test"),
-            target=lambda x: x["target"].astype("int32"),
-        )
+    if keys_aligned(df_features, df_target, join_columns):
+        logger.info("Inputs are aligned, attaching target without join")
+        df = df_features.copy(deep=False)
+        for col in target_cols:
+            df[col] = df_target[col].to_numpy()
+        df.index = pd.RangeIndex(len(df))
+    else:
+        df = df_features.merge(df_target[join_columns + target_cols], on=join_columns, how="inner")
+
+    missing = df[longest_window_feature].isnull() | df[target_cols].isnull().any(axis=1)
+    return df.loc[~missing].assign(
+        **{SPLIT_COLUMN: lambda x: x["Date"] < train_cutoff},
+        **{col: lambda x, col=col: x[col].astype(TARGET_DTYPE) for col in target_cols},
     )
 
 
+@instrument()
+def write_matrix(
+    df: pd.DataFrame, path: str, columns: List[str], target_col: str = "target"
+) -> None:
+    """Save dataset as `FeatureMatrix` with contiguous train and test rows, for training on
+    memory mapped arrays"""
+    save_matrix(FeatureMatrix.from_frame(df, columns, target_col, split_col=SPLIT_COLUMN), path)
+
+
 @hydra.main(config_path="../../config", config_name="dataset", version_base=None)
+@instrument_stage("dataset")
 def main(config_: DictConfig) -> None:
     config: DatasetConfig = parse_dict_config(DatasetConfig, config_)
     logger.info(f"Starting dataset creation step, using config: \n{config}")
+    run(config)
+    logger.info("Done!")
+
 
-    logger.info("Reading inputs")
-    df_features = pd.read_parquet(config.features_path)
-    df_target = pd.read_parquet(config.target_path)
+def run(
+    config: DatasetConfig,
+    df_features: Optional[pd.DataFrame] = None,
+    df_target: Optional[pd.DataFrame] = None,
+) -> pd.DataFrame:
+    """Create dataset of features and target and write it to output path, also as matrix if
+    configured. Inputs not given are read from their paths. Returns the dataset."""
+    if df_features is None:
+        logger.info("Reading features")
+        df_features = read_parquet(config.features_path)
+    if df_target is None:
+        logger.info("Reading target")
+        df_target = read_parquet(config.target_path)
 
     df_res = create_dataset(
-        df_features, df_target, config.longest_window_feature, config.train_cutoff
+        df_features,
+        df_target,
+        config.longest_window_feature,
+        config.train_cutoff,
+        config.target_cols,
     )
 
     logger.info("Writing result")
-    df_res.to_parquet(config.output_path, index=False)
-
-    logger.info("Done!")
+    write_parquet(df_res, config.output_path)
+    if config.matrix_path is not None:
+        write_matrix(df_res, config.matrix_path, config.matrix_columns, config.matrix_target)
+    return df_res
 
 
 if __name__ == "__main__":
@@ -1,12 +1,15 @@
+import os
 from dataclasses import dataclass
 from typing import Optional
 
 import hydra
+import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
 
-from src.data import scrape_tickers, ticker_pipe
-from src.utils import parse_dict_config
+from src.data import ValidationMode, scrape_tickers, ticker_pipe, update_ticker_data
+from src.instrumentation import instrument_stage
+from src.utils import parse_dict_config, read_parquet, write_parquet
 
 
 @dataclass
@@ -20,6 +23,9 @@ class YahooFinanceConfig:
     start_date: str
     end_date: str
     interval: str
+    batch_size: int = 100
+    max_workers: int = 4
+    max_retries: int = 3
 
 
 @dataclass
@@ -27,28 +33,56 @@ class GetDataConfig:
     ticker_config: TickerScrapeConfig
     yahoo_config: YahooFinanceConfig
     output_path: str
+    incremental: bool = False
+    validation_mode: str = ValidationMode.FULL
 
 
 @hydra.main(config_path="../../config", config_name="get_data", version_base=None)
+@instrument_stage("get_data")
 def main(config_: DictConfig) -> None:
-    """Scrapes current stock tickers from wiki,
-    then gets their price data from yahoo finance and stores in a
-    parquet file."""
     config: GetDataConfig = parse_dict_config(GetDataConfig, config_)
     logger.info(f"Starting get data step, using config: \n{config}")
+    run(config)
+    logger.info("Done!")
+
+
+def run(config: GetDataConfig) -> pd.DataFrame:
+    """Scrapes current stock tickers from wiki,
+    then gets their price data from yahoo finance and stores in a
+    parquet file. In incremental mode, previous output is extended
+    with missing dates only, instead of downloading the full history.
+    Returns the data written."""
+    download_config = {
+        "batch_size": config.yahoo_config.batch_size,
+        "max_workers": config.yahoo_config.max_workers,
+        "max_retries": config.yahoo_config.max_retries,
+        "validation_mode": config.validation_mode,
+    }
     tickers = scrape_tickers(
         config.ticker_config.url,
         config.ticker_config.ticker_limit,
     )
-    df = ticker_pipe(
-        tickers,
-        config.yahoo_config.start_date,
-        config.yahoo_config.end_date,
-        config.yahoo_config.interval,
-    )
+    if config.incremental and os.path.exists(config.output_path):
+        logger.info("Reading previous results")
+        df = update_ticker_data(
+            read_parquet(config.output_path),
+            tickers,
+            config.yahoo_config.start_date,
+            config.yahoo_config.end_date,
+            config.yahoo_config.interval,
+            **download_config,
+        )
+    else:
+        df = ticker_pipe(
+            tickers,
+            config.yahoo_config.start_date,
+            config.yahoo_config.end_date,
+            config.yahoo_config.interval,
+            **download_config,
+        )
     logger.info("Writing results")
-    df.to_parquet(config.output_path, index=False)
-    logger.info("Done!")
+    write_parquet(df, config.output_path)
+    return df
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""Run pipeline stages in a single process, handing DataFrames from one stage to the next in
+memory, instead of each stage starting its own interpreter and reading what the previous one
+wrote. Stage configs are composed with the overrides of their DVC commands, so every stage
+still writes the same outputs to the paths DVC tracks, which `dvc commit` then records.
+
+Run using python -m src.pipeline.run_all [--stages features,target,...] [stage.key=value ...]
+"""
+import argparse
+from typing import Any, Callable, Optional
+
+import pandas as pd
+from loguru import logger
+from omegaconf import OmegaConf
+
+from src.instrumentation import instrument_stage
+from src.pipeline import calculate_features, dataset, get_data, target, train
+from src.utils import load_config, parse_dict_config
+
+STAGES = ["get_data", "features", "target", "dataset", "train"]
+# Config dataclass and `run` function of each stage, with config of the same name
+STAGE_RUNNERS: dict[str, tuple[Any, Callable]] = {
+    "get_data": (get_data.GetDataConfig, get_data.run),
+    "features": (calculate_features.FeatureConfig, calculate_features.run),
+    "target": (target.TargetConfig, target.run),
+    "dataset": (dataset.DatasetConfig, dataset.run),
+    "train": (train.TrainConfig, train.run),
+}
+# Stage producing each DataFrame argument of `run` of a stage
+STAGE_INPUTS: dict[str, dict[str, str]] = {
+    "get_data": {},
+    "features": {"df": "get_data"},
+    "target": {"df": "get_data"},
+    "dataset": {"df_features": "features", "df_target": "target"},
+    "train": {"df": "dataset"},
+}
+
+
+def dvc_overrides(stage: str, dvc_path: str = "dvc.yaml") -> list[str]:
+    """Hydra overrides given to `stage` by its command in `dvc_path`"""
+    cmd = OmegaConf.load(dvc_path)["stages"][stage]["cmd"]
+    return [arg for arg in cmd.split() if "=" in arg]
+
+
+def load_stage_config(
+    stage: str, overrides: Optional[list[str]] = None, dvc_path: str = "dvc.yaml"
+) -> Any:
+    config_class, _ = STAGE_RUNNERS[stage]
+    config = load_config(stage, overrides=dvc_overrides(stage, dvc_path) + (overrides or []))
+    return parse_dict_config(config_class, OmegaConf.create(config))
+
+
+def run_all(
+    stages: Optional[list[str]] = None,
+    overrides: Optional[dict[str, list[str]]] = None,
+    dvc_path: str = "dvc.yaml",
+) -> None:
+    """Run `stages`, all of them by default, in pipeline order. Output of a stage is passed to
+    the stages consuming it, stages whose inputs weren't run read them from their paths.
+    Metrics of each stage are written as if it was run on its own."""
+    stages = [stage for stage in STAGES if stage in (stages or STAGES)]
+    frames: dict[str, pd.DataFrame] = {}
+    for i, stage in enumerate(stages):
+        config = load_stage_config(stage, (overrides or {}).get(stage), dvc_path)
+        logger.info(f"Running stage {stage}, using config: \n{config}")
+        _, run = STAGE_RUNNERS[stage]
+        if stage == "train" and config.matrix_path is not None:
+            # Trained on memory mapped matrix written by dataset stage instead
+            frames.pop("dataset", None)
+        kwargs = {name: frames.get(source) for name, source in STAGE_INPUTS[stage].items()}
+        result = instrument_stage(stage)(run)(config, **kwargs)
+        if isinstance(result, pd.DataFrame):
+            frames[stage] = result
+        # Drop outputs that none of the remaining stages consumes
+        remaining = {source for later in stages[i + 1 :] for source in STAGE_INPUTS[later].values()}
+        frames = {name: df for name, df in frames.items() if name in remaining}
+    logger.info("Done!")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--stages",
+        type=lambda value: value.split(","),
+        default=STAGES,
+        help=f"Comma separated stages to run, of {','.join(STAGES)}",
+    )
+    parser.add_argument("--dvc-path", default="dvc.yaml")
+    parser.add_argument("overrides", nargs="*", help="Config overrides as stage.key=value")
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages {sorted(unknown)}, choose from {STAGES}")
+
+    overrides: dict[str, list[str]] = {}
+    for override in args.overrides:
+        stage, _, value = override.partition(".")
+        overrides.setdefault(stage, []).append(value)
+    run_all(args.stages, overrides, args.dvc_path)
+
+
+if __name__ == "__main__":
+    main()
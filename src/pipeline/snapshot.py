@@ -0,0 +1,62 @@
+from dataclasses import dataclass
+from typing import Optional
+
+import dill
+import hydra
+from loguru import logger
+from omegaconf import DictConfig
+
+from src.features import FeaturePlan
+from src.forest import is_compiled, load_forest
+from src.instrumentation import instrument_stage
+from src.model import Predictor, model_version
+from src.pipeline.calculate_features import FeatureConfig
+from src.snapshot import build_snapshot, save_snapshot
+from src.utils import parse_dict_config, read_parquet
+
+
+@dataclass
+class SnapshotConfig:
+    input_path: str
+    output_path: str
+    # Config of features stage, which computed the input
+    features: FeatureConfig
+    # Model to add latest prediction of each symbol with, compiled forest being preferred over
+    # pickled model like the API does, so that versions of both match
+    model_path: Optional[str] = None
+    forest_path: Optional[str] = None
+
+
+def load_serving_model(config: SnapshotConfig) -> tuple[Optional[Predictor], Optional[str]]:
+    """Model served by API and its version, None if no model is configured"""
+    if config.forest_path is not None and is_compiled(config.forest_path):
+        forest = load_forest(config.forest_path)
+        return forest, forest.version
+    if config.model_path is not None:
+        with open(config.model_path, "rb") as f:
+            content = f.read()
+        return dill.loads(content), model_version(content)
+    return None, None
+
+
+@hydra.main(config_path="../../config", config_name="snapshot", version_base=None)
+@instrument_stage("snapshot")
+def main(config_: DictConfig) -> None:
+    config: SnapshotConfig = parse_dict_config(SnapshotConfig, config_)
+    logger.info(f"Starting feature snapshot step, using config: \n{config}")
+
+    plan = FeaturePlan.from_spec(config.features.window_lengths, config.features.features)
+    features = list(plan.features)
+    logger.info("Reading data")
+    df = read_parquet(config.input_path, columns=["Date", "Symbol", *plan.columns, *features])
+
+    model, version = load_serving_model(config)
+    snapshot = build_snapshot(df, features, model, version)
+    logger.info(f"Saving snapshot of {len(snapshot.symbols)} symbols, version {snapshot.version}")
+    save_snapshot(snapshot, config.output_path)
+
+    logger.info("Done!")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=E1120:no-value-for-parameter
@@ -0,0 +1,238 @@
+import hashlib
+import itertools
+import json
+import math
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import partial
+from typing import Any, Optional
+
+import hydra
+import numpy as np
+import pandas as pd
+from loguru import logger
+from omegaconf import DictConfig
+
+from src.instrumentation import instrument, instrument_stage
+from src.matrix import MATRIX_FORMAT_VERSION, FeatureMatrix, load_matrix, save_matrix
+from src.model import make_pipeline, score
+from src.schema import SPLIT_COLUMN
+from src.utils import parse_dict_config, read_parquet
+
+
+@dataclass
+class SweepConfig:
+    input_path: str
+    output_path: str
+    cache_path: str
+    features: list[str]
+    # Configs of Hydra model groups, by name
+    models: dict[str, dict[str, Any]]
+    # Lists of values of model parameters to try, by model name
+    search_space: dict[str, dict[str, list[Any]]]
+    target_col: str = "target"
+    max_workers: int = 1
+    # Successive halving trains all candidates on smallest fraction of training rows, that's
+    # power of 1 / `eta` and at least `min_fraction`, then keeps best 1 / `eta` of them and
+    # trains them on `eta` times more rows, until all rows are used. With `min_fraction` of 1,
+    # all candidates are trained on all rows.
+    min_fraction: float = 1.0
+    eta: int = 3
+    seed: int = 42
+    # Candidates are selected by score on validation rows, the latest dates of train split,
+    # which aren't trained on, so that test split is only used to report their scores.
+    validation_fraction: float = 0.2
+    # Number of days target looks ahead, as `look_ahead_days` of target stage
+    look_ahead_days: int = 1
+    # Number of dates left out before validation, to keep targets looking ahead from leaking
+    # validation prices into training, `look_ahead_days` if not set, as in `CVConfig`
+    gap: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if self.gap is None:
+            self.gap = self.look_ahead_days
+        if self.gap < self.look_ahead_days:
+            raise ValueError(
+                f"Gap of {self.gap} dates leaks targets looking {self.look_ahead_days} days "
+                "ahead into training"
+            )
+
+
+@dataclass
+class Candidate:
+    model: str
+    params: dict[str, Any]
+    steps: dict[str, Any]
+
+
+@dataclass
+class CandidateResult:
+    model: str
+    params: str
+    rung: int
+    train_fraction: float
+    train_rows: int
+    train_score: float
+    validation_score: float
+    test_score: float
+    fit_s: float
+    score_s: float
+
+
+def make_candidates(config: SweepConfig) -> list[Candidate]:
+    """Pipeline steps for every combination of parameter values in search space of each model,
+    selecting features with `ColumnSelector` like train stage does"""
+    candidates = []
+    for name, space in config.search_space.items():
+        for values in itertools.product(*space.values()):
+            params = dict(zip(space.keys(), values))
+            classifier = {**config.models[name], **params}
+            # Share cores between parallel workers instead of each model using all of them
+            if "n_jobs" in classifier and config.max_workers > 1:
+                classifier["n_jobs"] = max((os.cpu_count() or 1) // config.max_workers, 1)
+            steps = {
+                "selector": {"_target_": "src.model.ColumnSelector", "columns": config.features},
+                "classifier": classifier,
+            }
+            candidates.append(Candidate(name, params, steps))
+    return candidates
+
+
+def validation_split(dates: np.ndarray, fraction: float, gap: int) -> tuple[np.ndarray, np.ndarray]:
+    """Masks of rows to train on and of validation rows, which are the last `fraction` of
+    unique `dates`. Rows of `gap` dates before validation are in neither of them."""
+    unique = np.unique(dates)
+    n_validation = max(int(len(unique) * fraction), 1)
+    if n_validation + gap >= len(unique):
+        raise ValueError(
+            f"Can't split {len(unique)} dates into validation of {n_validation} dates "
+            f"after gap of {gap} dates"
+        )
+    validation_start = unique[-n_validation]
+    train_end = unique[-n_validation - gap - 1]
+    return dates <= train_end, dates >= validation_start
+
+
+def cached_matrices(config: SweepConfig) -> str:
+    """Directory holding train, validation and test `FeatureMatrix` of input dataset, built
+    once and reused while dataset, features, target and validation split stay the same"""
+    stat = os.stat(config.input_path)
+    key = json.dumps(
+        [os.path.abspath(config.input_path), stat.st_size, stat.st_mtime_ns]
+        + [config.features, config.target_col, MATRIX_FORMAT_VERSION]
+        + [config.validation_fraction, config.gap]
+    )
+    path = os.path.join(config.cache_path, hashlib.sha256(key.encode()).hexdigest()[:12])
+    if os.path.exists(path):
+        logger.info(f"Using cached matrices {path}")
+        return path
+
+    logger.info(f"Caching matrices to {path}")
+    columns = ["Date", *config.features, config.target_col, SPLIT_COLUMN]
+    df = read_parquet(config.input_path, columns=list(dict.fromkeys(columns)))
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    df_train = df.loc[df[SPLIT_COLUMN]]
+    is_fit, is_validation = validation_split(
+        df_train["Date"].to_numpy(), config.validation_fraction, config.gap
+    )
+    datasets = {
+        "train": df_train.loc[is_fit],
+        "validation": df_train.loc[is_validation],
+        "test": df.loc[~df[SPLIT_COLUMN]],
+    }
+    for dataset, df_dataset in datasets.items():
+        matrix = FeatureMatrix.from_frame(df_dataset, config.features, config.target_col)
+        save_matrix(matrix, os.path.join(tmp_path, dataset))
+    os.replace(tmp_path, path)
+    return path
+
+
+def _subsample(n_rows: int, fraction: float, seed: int) -> np.ndarray:
+    """Rows of a random subsample, nested in subsamples of larger fractions with same seed"""
+    if fraction >= 1:
+        return np.arange(n_rows)
+    rows = np.random.default_rng(seed).permutation(n_rows)[: max(int(n_rows * fraction), 1)]
+    return np.sort(rows)
+
+
+def _evaluate(
+    matrices_path: str, rung: int, fraction: float, seed: int, candidate: Candidate
+) -> CandidateResult:
+    train = load_matrix(os.path.join(matrices_path, "train"))
+    validation = load_matrix(os.path.join(matrices_path, "validation"))
+    test = load_matrix(os.path.join(matrices_path, "test"))
+    x_train, y_train = train.frame(_subsample(len(train.y), fraction, seed))
+
+    start = time.perf_counter()
+    model = make_pipeline(candidate.steps).fit(x_train, y_train)
+    fit_s = time.perf_counter() - start
+    start = time.perf_counter()
+    validation_score = score(model, *validation.frame(slice(None)))
+    score_s = time.perf_counter() - start
+    return CandidateResult(
+        model=candidate.model,
+        params=json.dumps(candidate.params),
+        rung=rung,
+        train_fraction=fraction,
+        train_rows=len(y_train),
+        train_score=score(model, x_train, y_train),
+        validation_score=validation_score,
+        test_score=score(model, *test.frame(slice(None))),
+        fit_s=fit_s,
+        score_s=score_s,
+    )
+
+
+def rung_fractions(min_fraction: float, eta: int) -> list[float]:
+    """Fractions of training rows of successive halving rungs, last of them being all rows"""
+    fractions = [1.0]
+    while fractions[0] / eta >= min_fraction:
+        fractions.insert(0, fractions[0] / eta)
+    return fractions
+
+
+@instrument()
+def run_sweep(config: SweepConfig, matrices_path: str) -> pd.DataFrame:
+    """Evaluate candidates in parallel with successive halving, returning leaderboard of all
+    evaluations, best candidates of the last rung by validation score first"""
+    candidates = make_candidates(config)
+    results: list[CandidateResult] = []
+    with ProcessPoolExecutor(max_workers=config.max_workers) as executor:
+        for rung, fraction in enumerate(rung_fractions(config.min_fraction, config.eta)):
+            logger.info(
+                f"Rung {rung}: training {len(candidates)} candidates on {fraction:.0%} of rows"
+            )
+            evaluate = partial(_evaluate, matrices_path, rung, fraction, config.seed)
+            rung_results = list(executor.map(evaluate, candidates))
+            results += rung_results
+            order = np.argsort([-result.validation_score for result in rung_results], kind="stable")
+            n_kept = math.ceil(len(candidates) / config.eta)
+            candidates = [candidates[i] for i in order[:n_kept]]
+
+    return pd.DataFrame([asdict(result) for result in results]).sort_values(
+        ["rung", "validation_score"], ascending=False, ignore_index=True, kind="stable"
+    )
+
+
+@hydra.main(config_path="../../config", config_name="sweep", version_base=None)
+@instrument_stage("sweep")
+def main(config_: DictConfig) -> None:
+    config: SweepConfig = parse_dict_config(SweepConfig, config_)
+    logger.info(f"Starting hyperparameter sweep, using config: \n{config}")
+
+    matrices_path = cached_matrices(config)
+    leaderboard = run_sweep(config, matrices_path)
+
+    logger.info(f"Leaderboard:\n{leaderboard.head(10).to_string()}")
+    os.makedirs(os.path.dirname(config.output_path) or ".", exist_ok=True)
+    leaderboard.to_csv(config.output_path, index=False)
+
+    logger.info("Done!")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=E1120:no-value-for-parameter
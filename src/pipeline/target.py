@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional, Union
 
 import hydra
 import numpy as np
@@ -7,50 +7,107 @@ import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
 
-from src.utils import log_io_length, parse_dict_config
+from src.features import segment_starts
+from src.instrumentation import instrument, instrument_stage
+from src.partition import run_partitioned
+from src.utils import is_sorted_by, parse_dict_config, read_parquet, write_parquet
 
 
 @dataclass
 class TargetConfig:
-    look_ahead_days: int
+    look_ahead_days: Union[int, List[int]]
     columns: List[str]
     input_path: str
     output_path: str
-
-
-@log_io_length
-def calculate_target(df: pd.DataFrame, look_ahead_days: int) -> pd.DataFrame:
+    memory_budget_mb: Optional[float] = None
+    max_workers: int = 1
+
+
+def target_columns(look_ahead_days: Union[int, List[int]]) -> List[str]:
+    if isinstance(look_ahead_days, int):
+        return ["target"]
+    return [f"target_{days}" for days in look_ahead_days]
+
+
+def _future_change(close: np.ndarray, bounds: np.ndarray, days: int) -> np.ndarray:
+    """Sign of close price change after `days` rows, mapped to 0/1, NaN where it would be
+    taken from the next symbol or beyond the last row"""
+    target = np.full_like(close, np.nan)
+    if days < len(close):
+        change = target[: len(close) - days]
+        np.subtract(close[days:], close[: len(close) - days], out=change)
+        np.sign(change, out=change)
+        change += 1
+        change /= 2
+    # Last `days` rows of every symbol, but not rows of the preceding one
+    ends = bounds[1:, None] - np.arange(1, days + 1)
+    target[ends[ends >= bounds[:-1, None]]] = np.nan
+    return target
+
+
+@instrument()
+def calculate_target(df: pd.DataFrame, look_ahead_days: Union[int, List[int]]) -> pd.DataFrame:
     """Calcuate target - if close price for given ticker is higher or lower after specified number
     of days in the future. Using np.sign instead of bool comparison, to avoid casting of
-    NaN values into False."""
+    NaN values into False.
+
+    Given a list of days, one target column is created for each of them, named `target_{days}`.
+    All of them are computed on the close array sorted by symbol and date, masking changes that
+    would cross into the next symbol, which is faster than shifting within groups."""
     logger.info("Creating target")
     input_rows = len(df)
 
-    def _target(x):
-        close_shift = x.groupby("Symbol")["Close"].shift(-look_ahead_days)
-        change_sign = np.sign(close_shift - x["Close"])
-        return (change_sign + 1) / 2
+    if not is_sorted_by(df, ["Symbol", "Date"]):
+        df = df.sort_values(["Symbol", "Date"])
+    close = df["Close"].to_numpy()
+    close = close.astype(np.result_type(close.dtype, np.float32), copy=False)
+    bounds = np.r_[segment_starts(df["Symbol"]), len(df)]
 
-    df = df.sort_values(["Symbol", "Date"]).assign(target=_target)
+    df = df.copy(deep=False)
+    days_list = [look_ahead_days] if isinstance(look_ahead_days, int) else look_ahead_days
+    for column, days in zip(target_columns(look_ahead_days), days_list):
+        df[column] = _future_change(close, bounds, days)
 
     assert input_rows == len(df), "Number of rows changed!"
     return df
 
 
 @hydra.main(config_path="../../config", config_name="target", version_base=None)
+@instrument_stage("target")
 def main(config_: DictConfig) -> None:
     config: TargetConfig = parse_dict_config(TargetConfig, config_)
     logger.info(f"Starting target creation step, using config: \n{config}")
+    run(config)
+    logger.info("Done!")
 
-    logger.info("Reading data")
-    df = pd.read_parquet(config.input_path, columns=config.columns)
+
+def run(config: TargetConfig, df: Optional[pd.DataFrame] = None) -> Optional[pd.DataFrame]:
+    """Create target of raw data and write it to output path. Raw data is read from input
+    path, unless it's given as `df`. Returns the target, unless it was processed out-of-core
+    in partitions, which always read input path."""
+    if config.memory_budget_mb is not None:
+        run_partitioned(
+            calculate_target,
+            config.input_path,
+            config.output_path,
+            config.columns,
+            config.memory_budget_mb,
+            config.max_workers,
+            look_ahead_days=config.look_ahead_days,
+        )
+        return None
+
+    if df is None:
+        logger.info("Reading data")
+        df = read_parquet(config.input_path, columns=config.columns)
+    else:
+        df = df[config.columns]
 
     df = calculate_target(df, config.look_ahead_days)
 
     logger.info("Writing output")
-    df.to_parquet(config.output_path, index=False)
-
-    logger.info("Done!")
+    write_parquet(df, config.output_path)
+    return df
 
 
 if __name__ == "__main__":
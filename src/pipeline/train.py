@@ -1,43 +1,79 @@
-from dataclasses import dataclass
-from typing import Any
+from dataclasses import dataclass, field
+from typing import Any, Optional
 
 import hydra
 import pandas as pd
 from loguru import logger
 from omegaconf import DictConfig
 
-from src.model import Model, ModelTrainer, make_pipeline, save_model
-from src.utils import parse_dict_config
+from src.forest import compile_forest, save_forest, save_not_compiled
+from src.instrumentation import instrument_stage
+from src.model import CVConfig, Model, ModelTrainer, make_pipeline, save_model
+from src.utils import parse_dict_config, read_parquet
 
 
 @dataclass
 class TrainConfig:
-    input_path: str
+    # Dataset parquet file, not needed if directory of its `FeatureMatrix` is given
+    input_path: Optional[str]
     model_path: str
     metrics_path: str
     features: list[str]
     steps: dict[str, Any]
+    # Target column to train on, e.g. `target_5` if target of multiple horizons was created
+    target_col: str = "target"
+    # Directory of dataset saved as `FeatureMatrix`, to train on memory mapped arrays
+    matrix_path: Optional[str] = None
+    # Directory to save model compiled for fast loading and inference, if it's a random forest
+    forest_path: Optional[str] = None
+    cv: CVConfig = field(default_factory=CVConfig)
 
 
 @hydra.main(config_path="../../config", config_name="train", version_base=None)
+@instrument_stage("train")
 def main(config_: DictConfig) -> None:
     config: TrainConfig = parse_dict_config(TrainConfig, config_)
     logger.info(f"Starting training step, using config: \n{config}")
+    run(config)
+    logger.info("Done!")
+
 
+def run(config: TrainConfig, df: Optional[pd.DataFrame] = None) -> Model:
+    """Train model, on dataset matrix if its path is configured, otherwise on dataset read from
+    input path, unless it's given as `df`, and save it with its metrics. Returns the model."""
     logger.info("Loading model")
     model: Model = make_pipeline(config.steps)
 
-    logger.info("Loading data")
-    df = pd.read_parquet(config.input_path)
-
-    trainer = ModelTrainer(config.features)
-    trainer.run(model, df)
+    trainer = ModelTrainer(config.features, config.target_col, config.cv)
+    if config.matrix_path is not None:
+        trainer.run_matrix(model, config.matrix_path)
+    else:
+        if df is None:
+            logger.info("Loading data")
+            assert config.input_path is not None, "Either input or matrix path is required"
+            df = read_parquet(config.input_path)
+        trainer.run(model, df)
 
     logger.info("Saving model and metrics")
     trainer.metrics.save(config.metrics_path)
     save_model(trainer.model, config.model_path)
+    if config.forest_path is not None:
+        save_compiled(trainer.model, config.forest_path)
+    return trainer.model
 
-    logger.info("Done!")
+
+def save_compiled(model: Model, path: str) -> None:
+    """Save model compiled by `compile_forest`. If it can't be compiled, previously compiled
+    model is replaced by a marker, so that it isn't preferred over the dill pickled one, while
+    the directory tracked by DVC still exists."""
+    try:
+        forest = compile_forest(model)
+    except ValueError as e:
+        logger.info(f"Not compiling model: {e}")
+        save_not_compiled(path, str(e))
+        return
+    logger.info(f"Saving compiled model to {path}")
+    save_forest(forest, path)
 
 
 if __name__ == "__main__":
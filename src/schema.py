@@ -0,0 +1,10 @@
+"""Compact column types shared by every stage, from download through model training"""
+import numpy as np
+
+PRICE_DTYPE = np.float32
+FEATURE_DTYPE = np.float32
+TARGET_DTYPE = np.int8
+# Symbol is kept as pandas category, stored as dictionary encoded column in parquet
+SYMBOL_DTYPE = "category"
+# Boolean split flag, True for rows in train set
+SPLIT_COLUMN = "is_train"
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from src.instrumentation import record_io
+from src.model import Predictor
+from src.schema import FEATURE_DTYPE
+
+SNAPSHOT_FORMAT_VERSION = 1
+ARRAYS = ["symbols", "dates", "features", "probability", "records"]
+META_FILE = "meta.json"
+
+
+@dataclass(frozen=True)
+class FeatureSnapshot:
+    """Latest feature row of every symbol as plain arrays, which can be memory mapped and shared
+    by all API workers. Symbols are sorted byte strings, so a row is found by binary search.
+
+    `records` hold each row as JSON record, the way API serves features, and `probability`
+    the prediction of model of `model_version` for rows with all features, NaN otherwise."""
+
+    version: str
+    columns: list[str]
+    model_version: Optional[str]
+    symbols: np.ndarray
+    dates: np.ndarray
+    features: np.ndarray
+    probability: np.ndarray
+    records: np.ndarray
+
+    def find(self, symbol: str) -> Optional[int]:
+        """Row of `symbol`, None if it's not in the snapshot"""
+        key = symbol.encode()
+        row = int(np.searchsorted(self.symbols, key))
+        if row < len(self.symbols) and self.symbols[row] == key:
+            return row
+        return None
+
+    def record(self, row: int) -> str:
+        return self.records[row].decode()
+
+
+def build_snapshot(
+    df: pd.DataFrame,
+    features: list[str],
+    model: Optional[Predictor] = None,
+    model_version: Optional[str] = None,
+) -> FeatureSnapshot:
+    """Snapshot of the last row of each symbol of `df`, predicting them with `model` if given"""
+    latest = (
+        df.sort_values("Date", kind="stable")
+        .drop_duplicates("Symbol", keep="last")
+        .assign(Symbol=lambda x: x["Symbol"].astype(str))
+        .sort_values("Symbol", ignore_index=True)
+    )
+    X = latest[features].to_numpy(dtype=FEATURE_DTYPE)
+    probability = np.full(len(latest), np.nan)
+    complete = ~np.isnan(X).any(axis=1)
+    if model is not None and complete.any():
+        probability[complete] = model.predict_proba(latest.loc[complete])[:, 1]
+    records = latest.to_json(orient="records", lines=True).splitlines()
+    arrays = {
+        "symbols": latest["Symbol"].to_numpy(dtype=bytes),
+        "dates": latest["Date"].to_numpy(dtype="datetime64[ns]"),
+        "features": np.ascontiguousarray(X),
+        "probability": probability,
+        "records": np.array([record.encode() for record in records], dtype=bytes),
+    }
+    return FeatureSnapshot(
+        version=_content_hash(arrays),
+        columns=list(features),
+        model_version=model_version if model is not None else None,
+        **arrays,
+    )
+
+
+def _content_hash(arrays: dict[str, np.ndarray]) -> str:
+    digest = hashlib.sha256()
+    for name in ARRAYS:
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def save_snapshot(snapshot: FeatureSnapshot, path: str) -> None:
+    """Save arrays as .npy files into `path` directory, named by snapshot version, so that
+    arrays memory mapped by readers are never overwritten. Metadata file pointing to them is
+    replaced last and arrays of other versions are removed afterwards."""
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAYS:
+        file_path = os.path.join(path, _array_file(name, snapshot.version))
+        np.save(file_path, getattr(snapshot, name))
+        record_io(bytes_written=os.path.getsize(file_path))
+    meta = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "version": snapshot.version,
+        "columns": snapshot.columns,
+        "model_version": snapshot.model_version,
+    }
+    tmp_path = os.path.join(path, f"{META_FILE}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
+
+    current = {_array_file(name, snapshot.version) for name in ARRAYS}
+    for file in os.listdir(path):
+        if file.endswith(".npy") and file not in current:
+            os.remove(os.path.join(path, file))
+
+
+def load_snapshot(path: str, mmap: bool = True) -> FeatureSnapshot:
+    """Load snapshot saved by `save_snapshot`, memory mapping its arrays by default"""
+    with open(os.path.join(path, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["format_version"] != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version {meta['format_version']}")
+    arrays = {
+        name: np.load(
+            os.path.join(path, _array_file(name, meta["version"])),
+            mmap_mode="r" if mmap else None,
+        )
+        for name in ARRAYS
+    }
+    return FeatureSnapshot(
+        version=meta["version"],
+        columns=meta["columns"],
+        model_version=meta["model_version"],
+        **arrays,
+    )
+
+
+def _array_file(name: str, version: str) -> str:
+    return f"{name}-{version}.npy"
@@ -1,29 +1,82 @@
-from functools import wraps
-from typing import Any, Callable
+import os
+from typing import Any, Optional
 
 import hydra
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dacite import from_dict
-from loguru import logger
 from omegaconf import DictConfig, OmegaConf
 
+from src.instrumentation import record_io
+
+# Rows per parquet row group. Readers filtering by symbol, e.g. partitioned processing, load
+# whole row groups, so memory they need is only as fine grained as this.
+PARQUET_ROW_GROUP_SIZE = 128 * 1024
+
 
 def parse_dict_config(dataclass: Any, dict_config: DictConfig) -> Any:
     config_dict = OmegaConf.to_container(dict_config, resolve=True)
     return from_dict(data_class=dataclass, data=config_dict)  # type: ignore
 
 
-def log_io_length(func: Callable) -> Any:
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        logger.info(f"Input length: {len(args[0])}")
-        result = func(*args, **kwargs)
-        logger.info(f"Output length: {len(result)}")
-        return result
+def is_sorted_by(df: pd.DataFrame, columns: list[str]) -> bool:
+    """Check if rows are already in the order `df.sort_values(columns)` would put them in,
+    which is much cheaper than sorting again. Categoricals are ordered by their codes."""
+    tied = np.ones(max(len(df) - 1, 0), dtype=bool)
+    for column in columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.codes
+        values = values.to_numpy()
+        if np.any(tied & (values[1:] < values[:-1])):
+            return False
+        tied &= values[1:] == values[:-1]
+    return True
+
+
+def parquet_write_options(schema: pa.Schema) -> dict[str, Any]:
+    """Explicit parquet encodings for compact schema: dictionary encoding only for categorical
+    columns, byte stream split for floats and delta encoding for timestamps, which compress
+    much better with zstd than default plain or dictionary encoded values"""
+    encodings = {}
+    for field in schema:
+        if pa.types.is_floating(field.type):
+            encodings[field.name] = "BYTE_STREAM_SPLIT"
+        elif pa.types.is_timestamp(field.type):
+            encodings[field.name] = "DELTA_BINARY_PACKED"
+    return {
+        "compression": "zstd",
+        "use_dictionary": [f.name for f in schema if pa.types.is_dictionary(f.type)],
+        "column_encoding": encodings,
+    }
+
+
+def write_parquet(df: pd.DataFrame, path: str) -> None:
+    """Write `df` without index, using `parquet_write_options`, in row groups of
+    `PARQUET_ROW_GROUP_SIZE` rows"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(
+        table,
+        path,
+        row_group_size=PARQUET_ROW_GROUP_SIZE,
+        **parquet_write_options(table.schema),
+    )
+    record_io(bytes_written=os.path.getsize(path))
+
 
-    return wrapper
+def read_parquet(path: str, **kwargs) -> pd.DataFrame:
+    """`pd.read_parquet`, attributing size of file read to current instrumented step"""
+    df = pd.read_parquet(path, **kwargs)
+    record_io(bytes_read=os.path.getsize(path))
+    return df
 
 
-def load_config(config_name: str, config_path: str = "../config") -> dict:
+def load_config(
+    config_name: str, config_path: str = "../config", overrides: Optional[list[str]] = None
+) -> dict:
+    """Compose config the way `hydra.main` of a stage does, given command line `overrides`"""
     with hydra.initialize(config_path=config_path, version_base=None):
-        cfg = hydra.compose(config_name=config_name)
+        cfg = hydra.compose(config_name=config_name, overrides=overrides or [])
         return OmegaConf.to_container(cfg, resolve=True)  # type: ignore
@@ -0,0 +1,338 @@
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from httpx import ASGITransport, AsyncClient
+from mock import Mock, patch
+
+from api import app
+from api.concurrency import BlockingExecutor, SingleFlight
+from api.history_cache import PriceHistoryCache
+from api.model_store import LoadedModel
+from api.snapshot_store import SnapshotStore
+from src import data
+from src.data import ticker_pipe
+from src.feature_state import FeatureStateStore
+from src.features import calculate_features
+from src.snapshot import build_snapshot, save_snapshot
+from tests.utils import make_price_history
+
+NO_SNAPSHOT = Mock(get=Mock(return_value=None))
+
+
+class StubModel:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        self.calls += 1
+        prob = X["sma_50"].clip(0, 1).to_numpy()
+        return np.column_stack([1 - prob, prob])
+
+
+def test_predict_batch() -> None:
+    """Expected:
+    - histories fetched in a single request, which falls back to one request per ticker
+    when it fails because of an invalid ticker, model is invoked once for all tickers
+    - tickers without data or without enough history reported as errors"""
+    end = datetime.now() + timedelta(days=1)
+    history = pd.concat(
+        [
+            make_price_history(["A", "B"], (end - timedelta(days=400)).strftime("%F"), f"{end:%F}"),
+            make_price_history(["C"], (end - timedelta(days=30)).strftime("%F"), f"{end:%F}"),
+        ]
+    )
+
+    def fetch(tickers, start_date, end_date):
+        if "BAD" in tickers:
+            raise ValueError("Failed validation")
+        return history.loc[
+            lambda x: x["Symbol"].isin(tickers) & (x["Date"] >= start_date) & (x["Date"] < end_date)
+        ]
+
+    fetch_mock = Mock(side_effect=fetch)
+    model = StubModel()
+    model_store = Mock(get=Mock(return_value=LoadedModel(model, "v1", 0)))
+    with (
+        patch.object(app, "history_cache", PriceHistoryCache(fetch_mock)),
+        patch.object(app, "model_store", model_store),
+    ):
+        res = json.loads(asyncio.run(app.predict_batch(["a", "B", "C", "BAD"])).body)
+
+    assert model.calls == 1
+    assert fetch_mock.call_count == 1 + 4
+    assert res["model_version"] == "v1"
+    assert set(res["predictions"]) == {"A", "B"}
+    assert set(res["errors"]) == {"C", "BAD"}
+
+
+class SlowFetch:
+    """Local stand-in for upstream price source with fixed latency per request"""
+
+    def __init__(self, history: pd.DataFrame, latency: float) -> None:
+        self.history = history
+        self.latency = latency
+        self.calls: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, tickers, start_date, end_date):
+        with self._lock:
+            self.calls.append(list(tickers))
+        time.sleep(self.latency)
+        return self.history.loc[
+            lambda x: x["Symbol"].isin(tickers) & (x["Date"] >= start_date) & (x["Date"] < end_date)
+        ]
+
+
+def test_concurrent_features_load() -> None:
+    """Expected:
+    - concurrent requests for distinct tickers are served in parallel, finishing much
+    faster than the same requests sent one after another
+    - concurrent requests for the same ticker are coalesced into a single upstream fetch,
+    every caller receiving the same features"""
+    end = datetime.now() + timedelta(days=1)
+    tickers = [f"T{i}" for i in range(8)]
+    history = make_price_history(tickers, (end - timedelta(days=400)).strftime("%F"), f"{end:%F}")
+    latency = 0.2
+
+    async def run(requests: list[str], concurrent: bool) -> tuple[float, list]:
+        transport = ASGITransport(app=app.app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            start = time.perf_counter()
+            calls = [client.post("/features", params={"ticker": t}) for t in requests]
+            if concurrent:
+                responses = await asyncio.gather(*calls)
+            else:
+                responses = [await call for call in calls]
+            return time.perf_counter() - start, [r.json() for r in responses]
+
+    def load(requests: list[str], concurrent: bool) -> tuple[float, list, SlowFetch]:
+        fetch = SlowFetch(history, latency)
+        with (
+            patch.object(app, "history_cache", PriceHistoryCache(fetch)),
+            patch.object(app, "feature_state", FeatureStateStore(app.FEATURE_PLAN)),
+            patch.object(app, "snapshot_store", NO_SNAPSHOT),
+            patch.object(app, "executor", BlockingExecutor(len(tickers))),
+        ):
+            elapsed, results = asyncio.run(run(requests, concurrent))
+        return elapsed, results, fetch
+
+    sequential, _, _ = load(tickers, concurrent=False)
+    concurrent, results, fetch = load(tickers, concurrent=True)
+    assert len(fetch.calls) == len(tickers)
+    assert all("err" not in json.loads(res)[0] for res in results)
+    assert sequential >= latency * len(tickers)
+    assert concurrent < sequential / 2
+
+    _, results, fetch = load(["T0"] * 20, concurrent=True)
+    assert fetch.calls == [["T0"]]
+    assert len(set(results)) == 1
+
+
+def test_single_flight_cancelled() -> None:
+    """Expected:
+    - when the executing caller is cancelled, waiting caller executes again instead of hanging
+    - waiting caller that is cancelled itself is cancelled"""
+    single_flight = SingleFlight()
+    calls = []
+
+    async def func() -> str:
+        calls.append(len(calls))
+        await asyncio.sleep(0.1)
+        return f"result {len(calls)}"
+
+    async def run() -> tuple[str, bool]:
+        leader = asyncio.create_task(single_flight.do("key", func))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(single_flight.do("key", func))
+        cancelled_follower = asyncio.create_task(single_flight.do("key", func))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        cancelled_follower.cancel()
+        result = await asyncio.wait_for(follower, timeout=1)
+        return result, cancelled_follower.cancelled()
+
+    assert asyncio.run(run()) == ("result 2", True)
+    assert len(calls) == 2
+
+
+def test_score() -> None:
+    """Expected:
+    - ticker validated, features calculated and scored reusing a single history download
+    - ticker with too short history returns its features with an error instead of score
+    - ticker that fails to download and has no metadata is not found"""
+    end = datetime.now() + timedelta(days=1)
+    history = pd.concat(
+        [
+            make_price_history(["A"], (end - timedelta(days=400)).strftime("%F"), f"{end:%F}"),
+            make_price_history(["C"], (end - timedelta(days=30)).strftime("%F"), f"{end:%F}"),
+        ]
+    )
+
+    def fetch(tickers, start_date, end_date):
+        if "BAD" in tickers:
+            raise KeyError("Date")
+        return history.loc[
+            lambda x: x["Symbol"].isin(tickers) & (x["Date"] >= start_date) & (x["Date"] < end_date)
+        ]
+
+    fetch_mock = Mock(side_effect=fetch)
+    model = StubModel()
+    model_store = Mock(get=Mock(return_value=LoadedModel(model, "v1", 0)))
+    with (
+        patch.object(app, "history_cache", PriceHistoryCache(fetch_mock)),
+        patch.object(app, "model_store", model_store),
+        patch.object(app, "feature_state", FeatureStateStore(app.FEATURE_PLAN)),
+        patch.object(app, "snapshot_store", NO_SNAPSHOT),
+        patch.object(app, "_validate_ticker", Mock(return_value={"ticker": "Not found!"})),
+    ):
+        res, short, bad = (
+            json.loads(asyncio.run(app.score_ticker(ticker)).body) for ticker in ["a", "C", "BAD"]
+        )
+
+    assert fetch_mock.call_count == 3
+    assert model.calls == 1
+    assert res["ticker"] == "A" and res["model_version"] == "v1"
+    assert res["features"][0]["Symbol"] == "A" and 0 <= res["probability"] <= 1
+    assert short["err"] == "Not enough price history" and "probability" not in short
+    assert bad == {"ticker": "Not found!"}
+
+
+def test_features_state(tmp_path) -> None:
+    """Expected:
+    - first request initializes ticker state from history of lookback window, later ones only
+    download bars after the last seen one and return the same features as calculated from
+    whole history
+    - restored states serve features without downloading history again"""
+    end = datetime.now() + timedelta(days=1)
+    history = make_price_history(["A"], (end - timedelta(days=400)).strftime("%F"), f"{end:%F}")
+    start_date = (datetime.now() - timedelta(days=app.LOOKBACK_WINDOW)).strftime("%F")
+    cutoff = history["Date"].iloc[-5]
+    calls: list[str] = []
+
+    def fetch(tickers, start_date, end_date):
+        calls.append(start_date)
+        return history.loc[
+            lambda x: x["Symbol"].isin(tickers)
+            & (x["Date"] >= start_date)
+            & (x["Date"] < end_date)
+            & (x["Date"] < cutoff)
+        ]
+
+    store = FeatureStateStore(app.FEATURE_PLAN)
+    with (
+        patch.object(app, "history_cache", PriceHistoryCache(fetch, ttl=0)),
+        patch.object(app, "feature_state", store),
+        patch.object(app, "snapshot_store", NO_SNAPSHOT),
+    ):
+        app._current_features("A")
+        cutoff = history["Date"].max() + timedelta(days=1)
+        res = app._current_features("A")
+
+    expected = (
+        history.loc[lambda x: x["Date"] >= start_date]
+        .assign(Symbol=lambda x: x["Symbol"].astype("category"))
+        .pipe(calculate_features, **app.FEATURE_SPEC)
+        .tail(1)
+        .to_json(orient="records")
+    )
+    assert calls[0] == start_date and calls[1] > start_date
+    assert res == expected
+
+    store.save(str(tmp_path / "state.npz"))
+    restored = FeatureStateStore(app.FEATURE_PLAN)
+    restored.restore(str(tmp_path / "state.npz"))
+    calls.clear()
+    with (
+        patch.object(app, "history_cache", PriceHistoryCache(fetch)),
+        patch.object(app, "feature_state", restored),
+        patch.object(app, "snapshot_store", NO_SNAPSHOT),
+    ):
+        assert app._current_features("A") == expected
+    assert all(call > start_date for call in calls)
+
+
+def test_features_state_without_trading_days(tmp_path) -> None:
+    """Expected:
+    - restored state is served on a weekend without downloading
+    - after a holiday without bars, restored state is served as well"""
+    history = make_price_history(["A"], "2019-01-01", "2020-01-04")
+    store = FeatureStateStore(app.FEATURE_PLAN)
+    store.update(history.assign(Symbol=lambda x: x["Symbol"].astype("category")))
+    store.save(str(tmp_path / "state.npz"))
+    expected = store.get("A").record
+
+    class Now(datetime):
+        today = datetime(2020, 1, 5)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.today
+
+    restored = FeatureStateStore(app.FEATURE_PLAN)
+    restored.restore(str(tmp_path / "state.npz"))
+    no_bars = Mock(return_value=Mock(history=Mock(return_value=pd.DataFrame())))
+    cache = PriceHistoryCache(partial(ticker_pipe, validation_mode=app.VALIDATION_MODE))
+    with (
+        patch.object(app, "history_cache", cache),
+        patch.object(app, "feature_state", restored),
+        patch.object(app, "snapshot_store", NO_SNAPSHOT),
+        patch.object(app, "datetime", Now),
+        patch(f"{data.__name__}.yf.Ticker", no_bars),
+    ):
+        assert app._current_features("A") == expected
+        assert no_bars.call_count == 0
+        Now.today = datetime(2020, 1, 7)
+        assert app._current_features("A") == expected
+        assert no_bars.call_count == 1
+
+
+def test_features_snapshot(tmp_path) -> None:
+    """Expected:
+    - features and prediction of ticker in up to date snapshot are served without download
+    or inference, prediction of a different model version is computed again
+    - unknown ticker and ticker with stale snapshot row fall back to live features"""
+    end = datetime.now() + timedelta(days=1)
+    history = make_price_history(
+        ["A", "B", "C"], (end - timedelta(days=400)).strftime("%F"), f"{end:%F}"
+    )
+    last_closed = pd.Timestamp.now().normalize() - pd.offsets.BDay(1)
+    features = (
+        history.loc[lambda x: (x["Date"] <= last_closed) & (x["Symbol"] != "C")]
+        .assign(Symbol=lambda x: x["Symbol"].astype("category"))
+        .pipe(calculate_features, **app.FEATURE_SPEC)
+        .loc[lambda x: (x["Symbol"] == "A") | (x["Date"] < last_closed)]
+    )
+    model = StubModel()
+    path = str(tmp_path / "snapshot")
+    save_snapshot(build_snapshot(features, list(app.FEATURE_PLAN.features), model, "v1"), path)
+    fetch = SlowFetch(history, latency=0)
+
+    with (
+        patch.object(app, "history_cache", PriceHistoryCache(fetch)),
+        patch.object(app, "feature_state", FeatureStateStore(app.FEATURE_PLAN)),
+        patch.object(app, "snapshot_store", SnapshotStore(path)),
+        patch.object(app, "model_store", Mock(get=Mock(return_value=LoadedModel(model, "v1", 0)))),
+    ):
+        res = json.loads(app._current_features("A"))
+        score = app._score_ticker("A")
+        assert fetch.calls == [] and model.calls == 1
+        assert score["features"] == res and score["model_version"] == "v1"
+
+        app._current_features("B")
+        app._current_features("C")
+        assert fetch.calls == [["B"], ["C"]]
+
+        with patch.object(
+            app, "model_store", Mock(get=Mock(return_value=LoadedModel(model, "v2", 0)))
+        ):
+            assert app._score_ticker("A")["probability"] == score["probability"]
+        assert model.calls == 2
+
+    assert res[0]["Symbol"] == "A"
+    assert res[0]["Date"] == int(last_closed.timestamp() * 1000)
@@ -0,0 +1,54 @@
+import json
+
+import pandas as pd
+
+from benchmarks.compare import compare, load_results
+from benchmarks.run import run_benchmarks, save_results
+from benchmarks.synthetic import SyntheticDownload, make_ohlcv
+from src.data import get_daily_ticker_data, validate
+
+
+def test_make_ohlcv() -> None:
+    """Expected:
+    - same seed generates same market, shaped like downloaded and validated ticker data"""
+    df = make_ohlcv(n_symbols=5, n_days=300, seed=1)
+    pd.testing.assert_frame_equal(df, make_ohlcv(n_symbols=5, n_days=300, seed=1))
+    assert df["Symbol"].nunique() == 5
+
+    symbols = df["Symbol"].unique().tolist()
+    downloaded = get_daily_ticker_data(
+        symbols, "2000-01-01", "2024-01-01", download=SyntheticDownload(df)
+    )
+    pd.testing.assert_frame_equal(
+        downloaded.reset_index(drop=True), df.astype(downloaded.dtypes.to_dict())
+    )
+    validate(downloaded, "2000-01-01", "2024-01-01", mode="fast")
+
+
+def test_run_benchmarks(tmp_path) -> None:
+    """Expected:
+    - every stage and API handler is benchmarked offline, results saved as JSON
+    - comparing results with themselves shows no regression"""
+    results = run_benchmarks(n_symbols=3, n_days=400, repeat=1)
+    path = str(tmp_path / "results.json")
+    save_results(results, path, {"symbols": 3, "days": 400})
+
+    with open(path, encoding="utf-8") as f:
+        saved = json.load(f)
+    names = [res["name"] for res in saved["benchmarks"]]
+    assert names == [
+        "downcast_dtypes",
+        "validate_full",
+        "validate_fast",
+        "validate_sampled",
+        "calculate_features",
+        "calculate_target",
+        "create_dataset",
+        "model_trainer_run",
+        "walk_forward",
+        "api_features_cold",
+        "api_features_warm",
+        "api_predict",
+    ]
+    assert all(res["median_s"] > 0 for res in saved["benchmarks"])
+    assert compare(load_results(path), load_results(path), threshold=1.0) == []
@@ -0,0 +1,37 @@
+import pandas as pd
+
+from src.features import calculate_features
+from src.pipeline.build_dataset import build_dataset
+from src.pipeline.calculate_features import FeatureConfig
+from src.pipeline.dataset import DatasetConfig, create_dataset
+from src.pipeline.target import TargetConfig, calculate_target
+from src.utils import load_config
+from tests.utils import make_price_history
+
+
+def test_build_dataset() -> None:
+    """Expected:
+    - fused build gives same result as running features, target and dataset steps"""
+    df = make_price_history(["A", "B"], "2020-01-01", "2020-03-01").sample(frac=1, random_state=0)
+    columns = ["Date", "Symbol", "Close"]
+    features = FeatureConfig("", "", columns, window_lengths=[2, 5])
+    target = TargetConfig(1, columns, "", "")
+    dataset = DatasetConfig("", "", "sma_5", "2020-02-01", "")
+
+    expected = create_dataset(
+        calculate_features(df.copy(), features.window_lengths),
+        calculate_target(df.copy(), target.look_ahead_days),
+        dataset.longest_window_feature,
+        dataset.train_cutoff,
+    )
+    res = build_dataset(df, features, target, dataset)
+    pd.testing.assert_frame_equal(res, expected)
+
+
+def test_build_dataset_config() -> None:
+    """Expected:
+    - nested dataset config takes matrix columns from the model features, as train does"""
+    overrides = ["input_path=a", "output_path=b"]
+    config = load_config("build_dataset", overrides=overrides)
+    train = load_config("train", overrides=["matrix_path=m", "model_path=p", "metrics_path=j"])
+    assert config["dataset"]["matrix_columns"] == train["features"]
@@ -1,7 +1,7 @@
 import numpy as np
 import pandas as pd
 
-from src.pipeline.dataset import create_dataset
+from src.pipeline.dataset import create_dataset, keys_aligned
 
 
 def test_dataset() -> None:
@@ -34,9 +34,9 @@ def test_dataset() -> None:
     )
 
     expected = pd.DataFrame(
-        [["2020-01-01", "A", 100, 1.0, "train"], ["2020-02-01", "A", 100, 0, "test"]],
-        columns=["Date", "Symbol", "some_feat", "target", "dataset"],
-    ).assign(target=lambda x: x["target"].astype("int32"))
+        [["2020-01-01", "A", 100, 1.0, True], ["2020-02-01", "A", 100, 0, False]],
+        columns=["Date", "Symbol", "some_feat", "target", "is_train"],
+    ).assign(target=lambda x: x["target"].astype("int8"))
 
     res = create_dataset(
         df_feat,
@@ -46,3 +46,51 @@ def test_dataset() -> None:
     )
 
     pd.testing.assert_frame_equal(res, expected)
+
+
+def test_dataset_aligned_inputs() -> None:
+    """Expected:
+    - attaching target of aligned inputs column-wise gives same result as joining them"""
+    df = pd.DataFrame(
+        {
+            "Date": pd.to_datetime(["2020-01-01", "2020-02-01", "2020-01-01", "2020-02-01"]),
+            "Symbol": pd.Categorical(["A", "A", "B", "B"]),
+            "some_feat": [np.nan, 1.0, 2.0, 3.0],
+            "target": [1.0, np.nan, 0.0, 1.0],
+        },
+        index=[3, 2, 1, 0],
+    )
+    df_feat = df.drop(columns="target")
+    df_target = df[["Date", "Symbol", "target"]]
+
+    res = create_dataset(df_feat, df_target, "some_feat", "2020-02-01")
+    expected = create_dataset(df_feat, df_target.iloc[::-1], "some_feat", "2020-02-01")
+
+    assert keys_aligned(df_feat, df_target, ["Date", "Symbol"])
+    assert not keys_aligned(df_feat, df_target.iloc[::-1], ["Date", "Symbol"])
+    pd.testing.assert_frame_equal(res, expected)
+
+
+def test_dataset_target_horizons() -> None:
+    """Expected:
+    - all target columns joined, keeping rows where each of them is available
+    - only chosen target columns joined when given"""
+    df_feat = pd.DataFrame(
+        {
+            "Date": ["2020-01-01", "2020-02-01", "2020-03-01"],
+            "Symbol": ["A", "A", "A"],
+            "some_feat": [1.0, 2.0, 3.0],
+        }
+    )
+    df_target = df_feat[["Date", "Symbol"]].assign(
+        target_1=[1.0, 0.0, np.nan], target_2=[0.0, np.nan, np.nan]
+    )
+
+    res = create_dataset(df_feat, df_target, "some_feat", "2020-02-01")
+    assert list(res.columns) == ["Date", "Symbol", "some_feat", "target_1", "target_2", "is_train"]
+    assert len(res) == 1
+    assert res["target_2"].dtype == np.int8
+
+    res = create_dataset(df_feat, df_target, "some_feat", "2020-02-01", target_cols=["target_1"])
+    assert list(res.columns) == ["Date", "Symbol", "some_feat", "target_1", "is_train"]
+    assert len(res) == 2
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.feature_state import FeatureStateStore
+from src.features import FeaturePlan, calculate_features
+
+SPEC = {"window_lengths": [3, 10], "features": {"volatility": [4], "rsi": [3], "volume_ratio": [5]}}
+
+
+def _history() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    frames = []
+    for symbol, length in [("A", 60), ("B", 35), ("C", 4)]:
+        close = rng.lognormal(3, 0.1, length).astype("float32")
+        close[rng.random(length) < 0.05] = np.nan
+        frames.append(
+            pd.DataFrame(
+                {
+                    "Symbol": symbol,
+                    "Date": pd.bdate_range("2020-01-01", periods=length),
+                    "Close": close,
+                    "Volume": rng.lognormal(10, 1, length).astype("float32"),
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True).assign(
+        Symbol=lambda x: x["Symbol"].astype("category")
+    )
+
+
+def test_feature_state_update():
+    """Expected:
+    - features of bars appended one day at a time, spanning several blocks of cumulative
+    sums, are identical to calculating features over whole history
+    - bars already seen are skipped"""
+    df = _history()
+    expected = calculate_features(df.copy(), **SPEC).reset_index(drop=True)
+    store = FeatureStateStore(FeaturePlan.from_spec(**SPEC))
+
+    results = [store.update(df.loc[lambda x: x["Date"] < "2020-01-10"])]
+    for date in df.loc[lambda x: x["Date"] >= "2020-01-10", "Date"].unique():
+        results.append(store.update(df.loc[lambda x: x["Date"] <= date]))
+    res = pd.concat(results).sort_values(["Symbol", "Date"], ignore_index=True)
+
+    pd.testing.assert_frame_equal(res, expected, check_exact=True)
+    last = expected.groupby("Symbol", observed=True).tail(1)
+    np.testing.assert_array_equal(
+        store.get("A").features,
+        last.loc[lambda x: x["Symbol"] == "A", list(store.plan.features)].to_numpy()[0],
+    )
+
+
+def test_feature_state_persistence(tmp_path):
+    """Expected:
+    - restored states continue with the same features as states that were saved
+    - states saved for a different feature plan are rejected"""
+    df = _history()
+    path = str(tmp_path / "state.npz")
+    store = FeatureStateStore(FeaturePlan.from_spec(**SPEC))
+    store.update(df.loc[lambda x: x["Date"] < "2020-02-01"])
+    store.save(path)
+    restored = FeatureStateStore(FeaturePlan.from_spec(**SPEC))
+    restored.restore(path)
+
+    assert len(restored) == 3
+    assert restored.get("B").record == store.get("B").record
+    pd.testing.assert_frame_equal(restored.update(df), store.update(df), check_exact=True)
+
+    with pytest.raises(ValueError):
+        FeatureStateStore(FeaturePlan.from_spec([3])).restore(path)
+
+
+def test_feature_state_capacity(tmp_path):
+    """Expected:
+    - least recently used symbols are evicted above capacity, also when restoring
+    - update replaces state of a symbol, leaving the state got before it unchanged"""
+    df = _history()
+    store = FeatureStateStore(FeaturePlan.from_spec(**SPEC), capacity=2)
+    store.update(df.loc[lambda x: (x["Symbol"] != "C") & (x["Date"] < "2020-02-01")])
+    before = store.get("A")
+    features, record = before.features.copy(), before.record
+    store.update(df.loc[lambda x: x["Symbol"] == "C"])
+    assert (len(store), store.get("B")) == (2, None)
+
+    store.update(df.loc[lambda x: x["Symbol"] == "A"])
+    assert store.get("A") is not before
+    np.testing.assert_array_equal(before.features, features)
+    assert before.record == record
+
+    path = str(tmp_path / "state.npz")
+    store.save(path)
+    restored = FeatureStateStore(FeaturePlan.from_spec(**SPEC), capacity=1)
+    restored.restore(path)
+    assert len(restored) == 1 and restored.get("A") is not None
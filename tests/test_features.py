@@ -1,7 +1,8 @@
 import numpy as np
 import pandas as pd
+import pytest
 
-from src.features import calculate_features
+from src.features import FeaturePlan, calculate_features, moving_avg, update_features
 
 
 def test_calculate_features():
@@ -25,6 +26,142 @@ def test_calculate_features():
             ["B", "2020-01-02", 1, 1],
         ],
         columns=["Symbol", "Date", "Close", "sma_2"],
-    )
+    ).astype({"sma_2": "float32"})
     res = calculate_features(df, window_lengths=[2]).reset_index(drop=True)
     pd.testing.assert_frame_equal(res, expected, atol=1e-2)
+
+
+def test_calculate_features_matches_moving_avg():
+    """Expected:
+    - all windows match pandas groupby rolling mean, including windows that span
+    several blocks, NaN warm-up rows and windows containing missing values"""
+    rng = np.random.default_rng(42)
+    df = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "Symbol": symbol,
+                    "Date": pd.bdate_range("2020-01-01", periods=length),
+                    "Close": rng.lognormal(3, 1, length).astype("float32"),
+                }
+            )
+            for symbol, length in [("A", 30), ("B", 1), ("C", 7), ("D", 64)]
+        ],
+        ignore_index=True,
+    ).assign(Symbol=lambda x: x["Symbol"].astype("category"))
+    df.loc[[40, 100], "Close"] = np.nan
+    windows = [1, 3, 5, 8]
+
+    expected = df.copy()
+    for window in windows:
+        expected[f"sma_{window}"] = moving_avg(expected, "Symbol", "Close", window).astype(
+            "float32"
+        )
+    res = calculate_features(df.sample(frac=1, random_state=0), window_lengths=windows)
+    pd.testing.assert_frame_equal(res, expected, rtol=1e-6)
+
+
+def test_update_features():
+    """Expected:
+    - result is identical to full calculation, when previous result covers earlier dates,
+    a new symbol is added, a symbol is dropped and history of another symbol changed"""
+    rng = np.random.default_rng(42)
+    df = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "Symbol": symbol,
+                    "Date": pd.bdate_range("2020-01-01", periods=length),
+                    "Close": rng.lognormal(3, 1, length).astype("float32"),
+                }
+            )
+            for symbol, length in [("A", 40), ("B", 25), ("C", 10), ("D", 30), ("E", 3)]
+        ],
+        ignore_index=True,
+    ).assign(Symbol=lambda x: x["Symbol"].astype("category"))
+    windows = [2, 4]
+
+    df_prev = calculate_features(
+        df.loc[lambda x: (x["Date"] < "2020-01-27") & (x["Symbol"] != "C")].copy(), windows
+    )
+    df_new = df.loc[lambda x: x["Symbol"] != "E"].copy()
+    df_new.loc[lambda x: x["Symbol"] == "D", "Close"] *= 0.5
+    expected = calculate_features(df_new.copy(), windows)
+
+    res = update_features(df_prev, df_new.sample(frac=1, random_state=0), windows)
+    pd.testing.assert_frame_equal(res, expected, check_exact=True)
+
+
+def _history() -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "Symbol": symbol,
+                    "Date": pd.bdate_range("2020-01-01", periods=length),
+                    "Close": rng.lognormal(3, 0.1, length).astype("float32"),
+                    "Volume": rng.lognormal(10, 1, length).astype("float32"),
+                }
+            )
+            for symbol, length in [("A", 40), ("B", 25), ("C", 10), ("D", 30), ("E", 3)]
+        ],
+        ignore_index=True,
+    ).assign(Symbol=lambda x: x["Symbol"].astype("category"))
+
+
+def test_feature_plan():
+    """Expected:
+    - rolling means of series shared by features are planned once per window
+    - features of all families match pandas groupby calculations
+    - unknown feature family or too short window is rejected"""
+    spec = {"volatility": [3, 5], "rsi": [3], "volume_ratio": [4]}
+    plan = FeaturePlan.from_spec([2, 5], spec)
+    assert plan.means == {
+        "close": [2, 5],
+        "return": [3, 5],
+        "return_sq": [3, 5],
+        "gain": [3],
+        "loss": [3],
+        "volume": [4],
+    }
+    assert plan.columns == ["Close", "Volume"]
+
+    df = _history()
+    res = calculate_features(df.sample(frac=1, random_state=0), [2, 5], spec)
+
+    grouped = df.groupby("Symbol", observed=True)
+    change = grouped["Close"].diff().astype("float64")
+    gains = change.clip(lower=0).groupby(df["Symbol"], observed=True).rolling(3).mean()
+    losses = (-change).clip(lower=0).groupby(df["Symbol"], observed=True).rolling(3).mean()
+    expected = {
+        "sma_5": moving_avg(df, "Symbol", "Close", 5),
+        "volatility_5": df.assign(r=grouped["Close"].pct_change())
+        .groupby("Symbol", observed=True)["r"]
+        .rolling(5)
+        .std()
+        .reset_index(level=0, drop=True),
+        "rsi_3": (100 * gains / (gains + losses)).reset_index(level=0, drop=True),
+        "volume_ratio_4": moving_avg(df, "Symbol", "Volume", 4),
+    }
+    for column, values in expected.items():
+        np.testing.assert_allclose(res[column], values.astype("float32"), rtol=1e-4, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        FeaturePlan.from_spec(features={"ema": [5]})
+    with pytest.raises(ValueError):
+        FeaturePlan.from_spec(features={"volatility": [1]})
+
+
+def test_update_features_plan():
+    """Expected:
+    - incremental update of all feature families is identical to full calculation"""
+    df = _history()
+    spec = {"volatility": [3], "rsi": [2], "volume_ratio": [4]}
+    df_prev = calculate_features(df.loc[lambda x: x["Date"] < "2020-01-27"].copy(), [2], spec)
+    df_new = df.loc[lambda x: x["Symbol"] != "E"].copy()
+    df_new.loc[lambda x: x["Symbol"] == "D", "Volume"] *= 0.5
+    expected = calculate_features(df_new.copy(), [2], spec)
+
+    res = update_features(df_prev, df_new.sample(frac=1, random_state=0), [2], spec)
+    pd.testing.assert_frame_equal(res, expected, check_exact=True)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from src.forest import compile_forest, load_forest, save_forest
+from src.model import ColumnSelector
+
+
+def _model() -> tuple[Pipeline, pd.DataFrame]:
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(500, 3)).astype(np.float32), columns=["a", "b", "c"])
+    y = (X["a"] + rng.normal(scale=0.5, size=len(X)) > X["c"]).astype(int)
+    model = Pipeline(
+        [
+            ("selector", ColumnSelector(["c", "a"])),
+            ("classifier", RandomForestClassifier(n_estimators=10, random_state=0)),
+        ]
+    )
+    return model.fit(X, y), X
+
+
+def test_compile_forest(tmp_path) -> None:
+    """Expected:
+    - compiled forest predicts same probabilities and classes as the model
+    - columns are selected by name, in order of the column selector
+    - forest loaded with memory mapped arrays predicts the same, old arrays are removed on save
+    - missing features are rejected like by the model"""
+    model, X = _model()
+    forest = compile_forest(model)
+    X = X[["b", "a", "c"]]
+    np.testing.assert_allclose(forest.predict_proba(X), model.predict_proba(X))
+    np.testing.assert_array_equal(forest.predict(X), model.predict(X))
+    assert forest.columns == ["c", "a"]
+
+    path = str(tmp_path / "forest")
+    other = RandomForestClassifier(n_estimators=2, random_state=0).fit(X, X["a"] > 0)
+    save_forest(compile_forest(other), path)
+    save_forest(forest, path)
+    loaded = load_forest(path)
+    assert isinstance(loaded.threshold, np.memmap)
+    assert loaded.version == forest.version
+    np.testing.assert_allclose(loaded.predict_proba(X.iloc[:1]), model.predict_proba(X.iloc[:1]))
+    assert len(list((tmp_path / "forest").glob("*.npy"))) == 6
+
+    X_missing = X.iloc[:2].assign(a=[0.5, np.nan])
+    for predictor in [model, forest]:
+        with pytest.raises(ValueError):
+            predictor.predict_proba(X_missing)
+
+
+def test_compile_forest_unsupported() -> None:
+    X, y = [[0.0], [1.0]], [0, 1]
+    with pytest.raises(ValueError):
+        compile_forest(LogisticRegression().fit(X, y))
+    with pytest.raises(ValueError):
+        compile_forest(Pipeline([("classifier", LogisticRegression())]).fit(X, y))
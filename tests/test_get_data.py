@@ -1,8 +1,10 @@
 import pandas as pd
+import pandera as pa
 import pytest
 from mock import Mock, patch
 
 from src import data
+from tests.utils import FakeYahooFinance, make_price_history
 
 
 @pytest.fixture
@@ -113,14 +115,168 @@ def get_daily_ticker_data_expected() -> pd.DataFrame:
             "Volume",
         ],
         index=[0, 2, 1, 3],
-    )
+    ).assign(Symbol=lambda x: x["Symbol"].astype("category"))
 
 
 def test_get_daily_ticker_data(yahoo_df, get_daily_ticker_data_expected) -> None:
-    with patch(f"{data.__name__}.yf") as mock_yf:
-        mock_yf.download = Mock(return_value=yahoo_df)
-        tickers = ["LULU", "MMM"]
-        start = "2020-01-01"
-        end = "2020-01-04"
-        res = data.get_daily_ticker_data(tickers, start, end)
-        pd.testing.assert_frame_equal(res, get_daily_ticker_data_expected)
+    download = Mock(return_value=yahoo_df)
+    tickers = ["LULU", "MMM"]
+    start = "2020-01-01"
+    end = "2020-01-04"
+    res = data.get_daily_ticker_data(tickers, start, end, download=download)
+    pd.testing.assert_frame_equal(res, get_daily_ticker_data_expected)
+
+
+def test_get_daily_ticker_data_batches() -> None:
+    """Expected:
+    - tickers are downloaded in batches of given size
+    - failed batches are retried, batch failing after all retries fails the download
+    - download without any rows gives empty frame of the same dtypes"""
+    history = make_price_history(["A", "B", "C", "D", "E"], "2020-01-01", "2020-01-10")
+
+    def download(failures: dict[str, int], start: str = "2020-01-01") -> pd.DataFrame:
+        fake_yf = FakeYahooFinance(history, failures=failures)
+        try:
+            return data.get_daily_ticker_data(
+                ["A", "B", "C", "D", "E"],
+                start,
+                "2020-01-10",
+                batch_size=2,
+                max_workers=2,
+                max_retries=2,
+                backoff=0,
+                download=fake_yf.download,
+            )
+        finally:
+            calls.extend(call[0] for call in fake_yf.calls)
+
+    calls: list[list[str]] = []
+    with pytest.raises(RuntimeError, match="'E'"):
+        download({"C": 1, "E": 3})
+    assert sorted(map(tuple, calls)) == [
+        ("A", "B"),
+        ("C", "D"),
+        ("C", "D"),
+        ("E",),
+        ("E",),
+        ("E",),
+    ]
+
+    res = download({"C": 1, "E": 2})
+    expected = history.pipe(data.downcast_dtypes)
+    pd.testing.assert_frame_equal(res.reset_index(drop=True), expected)
+
+    empty = download({}, start="2020-01-20")
+    assert empty.empty
+    pd.testing.assert_series_equal(empty.dtypes, data.empty_ticker_data().dtypes)
+
+
+def test_update_ticker_data() -> None:
+    """Expected:
+    - existing tickers are extended from the day after their last date
+    - new tickers are downloaded from start date, tickers not listed anymore are dropped
+    - result matches full download of the same tickers"""
+    history = make_price_history(["A", "B", "C", "D"], "2020-01-01", "2020-02-01")
+    fake_yf = FakeYahooFinance(history)
+    with patch(f"{data.__name__}.download_tickers", fake_yf.download):
+        existing = data.ticker_pipe(["A", "B", "D"], "2020-01-01", "2020-01-20").loc[
+            lambda x: (x["Symbol"] != "B") | (x["Date"] < "2020-01-10")
+        ]
+        fake_yf.calls.clear()
+        res = data.update_ticker_data(existing, ["A", "B", "C"], "2020-01-01", "2020-02-01")
+        calls = fake_yf.calls.copy()
+        expected = data.ticker_pipe(["A", "B", "C"], "2020-01-01", "2020-02-01")
+
+    assert calls == [
+        (["C"], "2020-01-01", "2020-02-01"),
+        (["B"], "2020-01-10", "2020-02-01"),
+        (["A"], "2020-01-18", "2020-02-01"),
+    ]
+    pd.testing.assert_frame_equal(res, expected.reset_index(drop=True))
+
+
+def test_download_tickers_without_data() -> None:
+    """Expected:
+    - single ticker is downloaded on its own
+    - symbol without data is left out, without failing other tickers of its batch"""
+    history = make_price_history(["A", "B"], "2020-01-01", "2020-01-10")
+
+    def ticker(symbol: str) -> Mock:
+        df = (
+            history.loc[lambda x: x["Symbol"] == symbol]
+            .drop(columns="Symbol")
+            .set_index("Date")
+            .tz_localize("America/New_York")
+        )
+        # yfinance returns frame with plain index for symbols without data
+        if df.empty:
+            df = df.set_axis(pd.Index([], dtype=object))
+        return Mock(history=Mock(return_value=df))
+
+    with patch(f"{data.__name__}.yf.Ticker", ticker):
+        single = data.get_daily_ticker_data(["A"], "2020-01-01", "2020-01-10")
+        batch = data.get_daily_ticker_data(["A", "UNKNOWN", "B"], "2020-01-01", "2020-01-10")
+
+    expected = history.pipe(data.downcast_dtypes)
+    pd.testing.assert_frame_equal(
+        single.reset_index(drop=True),
+        expected.loc[lambda x: x["Symbol"] == "A"]
+        .assign(Symbol=lambda x: x["Symbol"].cat.remove_unused_categories())
+        .reset_index(drop=True),
+    )
+    pd.testing.assert_frame_equal(batch.reset_index(drop=True), expected)
+
+
+def test_update_ticker_data_without_trading_days() -> None:
+    """Expected:
+    - gap of a weekend is not downloaded
+    - gap of a holiday, whose download has no rows, leaves existing data as it is"""
+    existing = make_price_history(["A", "B"], "2020-01-01", "2020-01-04").pipe(data.downcast_dtypes)
+    ticker = Mock(return_value=Mock(history=Mock(return_value=pd.DataFrame())))
+    with patch(f"{data.__name__}.yf.Ticker", ticker):
+        weekend = data.update_ticker_data(existing, ["A", "B"], "2020-01-01", "2020-01-06")
+        assert ticker.call_count == 0
+        holiday = data.update_ticker_data(
+            existing, ["A", "B"], "2020-01-01", "2020-01-07", validation_mode="fast"
+        )
+        assert ticker.call_count == 2
+
+    for res in [weekend, holiday]:
+        pd.testing.assert_frame_equal(res, existing.reset_index(drop=True))
+
+
+@pytest.mark.parametrize(
+    "corrupt",
+    [
+        lambda df: df,
+        lambda df: df.assign(Symbol=df["Symbol"].where(df.index % 7 != 3, "bad")),
+        lambda df: df.assign(Symbol=df["Symbol"].where(df.index != 5, None)),
+        lambda df: df.assign(Close=df["Close"].where(df.index != 5, -1.0)),
+        lambda df: df.assign(Close=df["Close"].where(df.index != 5)),
+        lambda df: df.assign(Date=df["Date"].where(df.index != 5, pd.Timestamp("2030-01-01"))),
+        lambda df: df.assign(Close=df["Close"].astype(int)),
+        lambda df: df.drop(columns="Close"),
+    ],
+)
+def test_validate_fast(corrupt) -> None:
+    """Expected:
+    - fast validation accepts and rejects same data as pandera, raising the same error"""
+    df = (
+        make_price_history(["AA", "BB"], "2023-01-01", "2023-03-01")
+        .pipe(corrupt)
+        .pipe(data.downcast_dtypes)
+    )
+
+    errors = []
+    for mode in ["full", "fast"]:
+        try:
+            data.validate(df, "2023-01-01", "2023-03-01", mode=mode)
+            errors.append(None)
+        except pa.errors.SchemaError as e:
+            errors.append((str(e), e.reason_code, str(e.check), e.failure_cases.astype(str)))
+
+    if errors[0] is None:
+        assert errors[1] is None
+    else:
+        assert errors[0][:3] == errors[1][:3]
+        pd.testing.assert_frame_equal(errors[0][3], errors[1][3])
@@ -0,0 +1,85 @@
+import pandas as pd
+
+from api.history_cache import PriceHistoryCache
+from tests.utils import make_price_history
+
+
+class StubFetch:
+    def __init__(self, history: pd.DataFrame) -> None:
+        self.history = history
+        self.calls: list[tuple[list[str], str, str]] = []
+
+    def __call__(self, tickers: list[str], start_date: str, end_date: str) -> pd.DataFrame:
+        self.calls.append((tickers, start_date, end_date))
+        return (
+            self.history.loc[
+                lambda x: x["Symbol"].isin(tickers)
+                & (x["Date"] >= start_date)
+                & (x["Date"] < end_date)
+            ]
+            .assign(Symbol=lambda x: x["Symbol"].astype("category"))
+            .reset_index(drop=True)
+        )
+
+
+def test_history_cache() -> None:
+    """Expected:
+    - miss downloads requested history, fresh hit is served without download
+    - expired hit or later end date only downloads bars after the last cached date
+    - served history equals direct download"""
+    history = make_price_history(["A", "B"], "2020-01-01", "2020-03-01")
+    fetch = StubFetch(history)
+    cache = PriceHistoryCache(fetch, ttl=60)
+
+    cache.get("A", "2020-01-01", "2020-02-01")
+    res = cache.get("A", "2020-01-01", "2020-02-01")
+    res_later = cache.get("A", "2020-01-15", "2020-02-15")
+
+    assert fetch.calls == [(["A"], "2020-01-01", "2020-02-01"), (["A"], "2020-02-01", "2020-02-15")]
+    pd.testing.assert_frame_equal(res, StubFetch(history)(["A"], "2020-01-01", "2020-02-01"))
+    pd.testing.assert_frame_equal(res_later, StubFetch(history)(["A"], "2020-01-15", "2020-02-15"))
+    assert cache.info() == {
+        "hits": 2,
+        "misses": 1,
+        "refreshes": 1,
+        "evictions": 0,
+        "entries": 1,
+        "bytes": cache.info()["bytes"],
+    }
+
+
+def test_history_cache_eviction() -> None:
+    """Expected:
+    - least recently used ticker is evicted once cache exceeds its size"""
+    history = make_price_history(["A", "B", "C"], "2020-01-01", "2020-03-01")
+    fetch = StubFetch(history)
+    cache = PriceHistoryCache(fetch, max_bytes=2500)
+
+    for ticker in ["A", "B", "A", "C", "A", "B"]:
+        cache.get(ticker, "2020-01-01", "2020-03-01")
+
+    assert [call[0] for call in fetch.calls] == [["A"], ["B"], ["C"], ["B"]]
+    assert cache.info()["evictions"] == 2
+
+
+def test_history_cache_failed_refresh() -> None:
+    """Expected:
+    - failed refresh serves cached history and isn't retried until retry interval passes"""
+    history = make_price_history(["A"], "2020-01-01", "2020-03-01")
+    fetch = StubFetch(history)
+    cache = PriceHistoryCache(fetch, ttl=0, retry_interval=60)
+    cached = cache.get("A", "2020-01-01", "2020-02-01")
+
+    def fail(*args):
+        fetch.calls.append(args)
+        raise ConnectionError("Upstream down")
+
+    cache.fetch = fail
+    for _ in range(3):
+        pd.testing.assert_frame_equal(cache.get("A", "2020-01-01", "2020-02-15"), cached)
+    assert len(fetch.calls) == 2
+
+    cache.retry_interval = 0
+    cache.fetch = fetch
+    cache.get("A", "2020-01-01", "2020-02-15")
+    assert len(fetch.calls) == 3
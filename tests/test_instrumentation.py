@@ -0,0 +1,56 @@
+import json
+import os
+
+import pandas as pd
+from mock import patch
+
+from src import instrumentation
+from src.instrumentation import instrument, instrument_stage, step
+from src.utils import read_parquet, write_parquet
+
+
+@instrument()
+def _double(df: pd.DataFrame) -> pd.DataFrame:
+    return pd.concat([df, df])
+
+
+def test_instrument_stage(tmp_path, monkeypatch) -> None:
+    """Expected:
+    - nested steps record calls, rows in and out and bytes read and written
+    - peak RSS of a stage covers its steps, metrics are written to stage metrics file
+    - steps selected for profiling dump cProfile stats"""
+    monkeypatch.setattr(instrumentation, "METRICS_DIR", str(tmp_path / "metrics"))
+    monkeypatch.setenv(instrumentation.PROFILE_DIR_ENV, str(tmp_path / "profiles"))
+    monkeypatch.setenv(instrumentation.PROFILE_STEPS_ENV, "_double")
+    path = str(tmp_path / "data.parquet")
+
+    @instrument_stage("stage")
+    def main() -> None:
+        with step("write"):
+            write_parquet(pd.DataFrame({"a": range(10)}), path)
+        df = read_parquet(path)
+        _double(_double(df))
+
+    main()
+    with open(tmp_path / "metrics" / "stage.json", encoding="utf-8") as f:
+        metrics = json.load(f)
+
+    assert set(metrics) == {"stage", "write", "_double"}
+    assert metrics["_double"]["calls"] == 2
+    assert (metrics["_double"]["rows_in"], metrics["_double"]["rows_out"]) == (30, 60)
+    assert metrics["write"]["bytes_written"] == os.path.getsize(path)
+    assert metrics["stage"]["bytes_read"] == os.path.getsize(path)
+    assert metrics["stage"]["peak_rss_mb"] >= metrics["_double"]["peak_rss_mb"] > 0
+    assert metrics["stage"]["wall_s"] >= metrics["_double"]["wall_s"]
+    assert os.listdir(tmp_path / "profiles") == ["_double.prof"]
+
+
+def test_step_outside_stage() -> None:
+    """Expected:
+    - steps outside a stage, e.g. in API threads, don't reset process-wide peak RSS"""
+    instrumentation.reset_metrics()
+    with patch(f"{instrumentation.__name__}._reset_peak_rss") as reset_peak_rss:
+        _double(pd.DataFrame({"a": range(10)}))
+    reset_peak_rss.assert_not_called()
+    assert instrumentation.get_metrics()["_double"]["peak_rss_mb"] == 0
+    instrumentation.reset_metrics()
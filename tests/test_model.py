@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from src.matrix import load_matrix
+from src.model import (
+    ColumnSelector,
+    CVConfig,
+    ModelTrainer,
+    WindowType,
+    score,
+    walk_forward_folds,
+)
+from src.pipeline.dataset import write_matrix
+
+
+def test_walk_forward_folds() -> None:
+    """Expected:
+    - dates split into n_folds + 1 periods, each fold tests on the period after training ones
+    - expanding window trains from first date, sliding one on train_periods last periods
+    - gap dates before test period are left out of training, by default as many as target
+      looks ahead, and fewer of them are rejected"""
+    dates = np.arange("2020-01-01", "2020-01-13", dtype="datetime64[D]").repeat(2)
+
+    expanding = walk_forward_folds(dates, CVConfig(n_folds=3))
+    assert [(str(f.train_start), str(f.test_start), str(f.test_end)) for f in expanding] == [
+        ("2020-01-01", "2020-01-04", "2020-01-06"),
+        ("2020-01-01", "2020-01-07", "2020-01-09"),
+        ("2020-01-01", "2020-01-10", "2020-01-12"),
+    ]
+    assert str(expanding[-1].train_end) == "2020-01-08"
+
+    sliding = walk_forward_folds(dates, CVConfig(n_folds=3, window=WindowType.SLIDING))
+    assert [(str(f.train_start), str(f.train_end)) for f in sliding] == [
+        ("2020-01-01", "2020-01-02"),
+        ("2020-01-04", "2020-01-05"),
+        ("2020-01-07", "2020-01-08"),
+    ]
+
+    with pytest.raises(ValueError):
+        walk_forward_folds(dates, CVConfig(n_folds=3, gap=3))
+    with pytest.raises(ValueError):
+        CVConfig(n_folds=3, look_ahead_days=5, gap=1)
+
+
+def test_model_trainer_walk_forward() -> None:
+    """Expected:
+    - folds evaluated on a process pool score same as fitting each of them directly
+    - only training data is used and fold metrics are added to model metrics"""
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range("2020-01-01", periods=100).repeat(5)
+    df = pd.DataFrame({"Date": dates, "feat": rng.normal(size=len(dates)).astype(np.float32)})
+    df["target"] = (df["feat"] + rng.normal(size=len(df)) > 0).astype(np.int8)
+    df["is_train"] = df["Date"] < dates[400]
+    model = Pipeline([("selector", ColumnSelector(["feat"])), ("clf", LogisticRegression())])
+
+    trainer = ModelTrainer(["feat"], cv=CVConfig(n_folds=3, max_workers=2))
+    trainer.run(model, df)
+
+    folds = trainer.metrics.folds
+    assert len(folds) == 3
+    assert folds[-1].test_end < str(dates[400].date())
+    assert sum(fold.test_rows for fold in folds) == 300
+    train = df.loc[df["Date"] <= folds[1].train_end]
+    test = df.loc[(df["Date"] >= folds[1].test_start) & (df["Date"] <= folds[1].test_end)]
+    fitted = LogisticRegression().fit(train[["feat"]], train["target"])
+    assert folds[1].test_score == pytest.approx(score(fitted, test[["feat"]], test["target"]))
+    assert trainer.metrics.cv_test_score_mean == pytest.approx(
+        np.mean([fold.test_score for fold in folds])
+    )
+
+
+def test_model_trainer_run_matrix(tmp_path) -> None:
+    """Expected:
+    - matrix saved by dataset stage holds contiguous train and test rows of selected features
+    - training on memory mapped matrix gives same metrics as training on the frame
+    - column selector passes through features already in its column order
+    - matrix of other features than the trainer's is rejected"""
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range("2020-01-01", periods=50)
+    df = pd.DataFrame(
+        {
+            "Date": np.tile(dates, 4),
+            "Symbol": np.repeat(list("ABCD"), len(dates)),
+            "Close": rng.normal(size=200),
+            "feat": rng.normal(size=200).astype(np.float32),
+        }
+    )
+    df["target"] = (df["feat"] + rng.normal(size=len(df)) > 0).astype(np.int8)
+    df["is_train"] = df["Date"] < dates[40]
+    path = str(tmp_path / "matrix")
+    write_matrix(df, path, ["feat"])
+
+    matrix = load_matrix(path)
+    assert matrix.splits == {"train": (0, 160), "test": (160, 200)}
+    assert matrix.X.dtype == np.float32 and matrix.X.flags["C_CONTIGUOUS"]
+    assert matrix.columns == ["feat"]
+    x_train, y_train = matrix.split("train")
+    np.testing.assert_array_equal(y_train, df.loc[df["is_train"], "target"])
+    assert ColumnSelector(["feat"]).transform(x_train) is x_train
+
+    def make_model() -> Pipeline:
+        return Pipeline([("selector", ColumnSelector(["feat"])), ("clf", LogisticRegression())])
+
+    from_matrix = ModelTrainer(["feat"], cv=CVConfig(n_folds=2))
+    from_matrix.run_matrix(make_model(), path)
+    from_frame = ModelTrainer(["feat"], cv=CVConfig(n_folds=2))
+    from_frame.run(make_model(), df)
+    assert from_matrix.metrics == from_frame.metrics
+
+    with pytest.raises(ValueError):
+        ModelTrainer(["other"]).run_matrix(make_model(), path)
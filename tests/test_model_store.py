@@ -0,0 +1,72 @@
+import os
+import shutil
+
+import pytest
+from sklearn.dummy import DummyClassifier
+from sklearn.ensemble import RandomForestClassifier
+
+from api.model_store import ModelStore
+from src.forest import compile_forest, save_forest
+from src.model import save_model
+
+
+def _save(path: str, constant: int, mtime_ns: int) -> None:
+    save_model(
+        DummyClassifier(strategy="constant", constant=constant).fit([[0], [1]], [0, 1]), path
+    )
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_model_store(tmp_path) -> None:
+    """Expected:
+    - model is loaded once and kept until artifact changes
+    - changed artifact is reloaded with a new version, previously returned model stays usable
+    - touched, but unchanged artifact and broken artifact keep current model"""
+    path = str(tmp_path / "model.dill")
+    _save(path, 0, 1_000)
+    store = ModelStore(path, check_interval=0)
+
+    first = store.get()
+    assert store.get() is first
+
+    _save(path, 1, 2_000)
+    second = store.get()
+    assert second.version != first.version
+    assert first.model.predict([[0]])[0] == 0
+    assert second.model.predict([[0]])[0] == 1
+
+    os.utime(path, ns=(3_000, 3_000))
+    assert store.get().version == second.version
+
+    with open(path, "wb") as f:
+        f.write(b"partially written")
+    assert store.get().version == second.version
+
+
+def test_model_store_missing_model(tmp_path) -> None:
+    with pytest.raises(FileNotFoundError):
+        ModelStore(str(tmp_path / "model.dill")).get()
+
+
+def test_model_store_forest(tmp_path) -> None:
+    """Expected:
+    - compiled forest is preferred over dill model
+    - dill model is served when forest can't be loaded or is removed"""
+    dill_path = str(tmp_path / "model.dill")
+    forest_path = str(tmp_path / "forest")
+    _save(dill_path, 1, 1_000)
+    X, y = [[0.0], [1.0]], [0, 0]
+    forest = compile_forest(RandomForestClassifier(n_estimators=2).fit(X, y))
+    save_forest(forest, forest_path)
+    store = ModelStore(dill_path, check_interval=0, forest_path=forest_path)
+
+    loaded = store.get()
+    assert loaded.version == forest.version
+    assert loaded.model.predict([[0.0]])[0] == 0
+
+    os.remove(os.path.join(forest_path, f"threshold-{forest.version}.npy"))
+    os.utime(os.path.join(forest_path, "meta.json"), ns=(2_000, 2_000))
+    assert store.get().model.predict([[0]])[0] == 1
+
+    shutil.rmtree(forest_path)
+    assert store.get().path == dill_path
@@ -0,0 +1,42 @@
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src import partition
+from src.features import calculate_features
+from src.partition import partition_symbols, run_partitioned
+from tests.utils import make_price_history
+
+
+def test_partition_symbols() -> None:
+    """Expected:
+    - consecutive symbols grouped up to max rows, oversized symbol gets its own partition"""
+    row_counts = pd.Series([2, 3, 10, 1, 1], index=["A", "B", "C", "D", "E"])
+    assert partition_symbols(row_counts, 5) == [["A", "B"], ["C"], ["D", "E"]]
+
+
+def test_run_partitioned(tmp_path, monkeypatch) -> None:
+    """Expected:
+    - output of processing data in partitions on a process pool is same as all at once
+    - output is written in row groups of limited size"""
+    monkeypatch.setattr(partition, "PARQUET_ROW_GROUP_SIZE", 20)
+    input_path = str(tmp_path / "input.parquet")
+    output_path = str(tmp_path / "output.parquet")
+    make_price_history(["A", "B", "C", "D"], "2020-01-01", "2020-03-01").assign(
+        Symbol=lambda x: x["Symbol"].astype("category")
+    ).sample(frac=1, random_state=0).to_parquet(input_path, index=False)
+
+    run_partitioned(
+        calculate_features,
+        input_path,
+        output_path,
+        ["Date", "Symbol", "Close"],
+        memory_budget_mb=0.01,
+        max_workers=2,
+        window_lengths=[5],
+    )
+
+    expected = calculate_features(pd.read_parquet(input_path), window_lengths=[5])
+    pd.testing.assert_frame_equal(pd.read_parquet(output_path), expected.reset_index(drop=True))
+    metadata = pq.read_metadata(output_path)
+    assert metadata.num_row_groups > 4
+    assert all(metadata.row_group(i).num_rows <= 20 for i in range(metadata.num_row_groups))
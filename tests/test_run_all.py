@@ -0,0 +1,85 @@
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+from mock import patch
+from omegaconf import OmegaConf
+
+from benchmarks.synthetic import make_ohlcv
+from src.data import downcast_dtypes
+from src.pipeline import run_all as run_all_module
+from src.pipeline.run_all import STAGE_RUNNERS, load_stage_config, main, run_all
+from src.utils import write_parquet
+
+STAGES = ["features", "target", "dataset", "train"]
+OUTPUTS = [
+    "data/features.parquet",
+    "data/target.parquet",
+    "data/dataset.parquet",
+    "data/matrix/X.npy",
+    "data/matrix/y.npy",
+    "data/matrix/dates.npy",
+]
+
+
+def write_dvc_yaml(path: Path) -> None:
+    commands = {
+        "features": "python -m src.pipeline.calculate_features "
+        "input_path=data/get_data.parquet output_path=data/features.parquet",
+        "target": "python -m src.pipeline.target "
+        "input_path=data/get_data.parquet output_path=data/target.parquet",
+        "dataset": "python -m src.pipeline.dataset features_path=data/features.parquet "
+        "target_path=data/target.parquet output_path=data/dataset.parquet "
+        "matrix_path=data/matrix train_cutoff=2022-01-01",
+        "train": "python -m src.pipeline.train matrix_path=data/matrix "
+        "model_path=models/model.dill metrics_path=models/metrics.json "
+        "cv.n_folds=0 model.n_jobs=1",
+    }
+    stages = {stage: {"cmd": cmd} for stage, cmd in commands.items()}
+    OmegaConf.save({"stages": stages}, path)
+
+
+def output_hashes() -> dict[str, str]:
+    return {path: hashlib.md5(Path(path).read_bytes()).hexdigest() for path in OUTPUTS}
+
+
+def test_run_all(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Expected:
+    - running stages in one process writes outputs identical to running them one by one,
+      so DVC content hashes stay the same
+    - model and metrics of each stage are written"""
+    monkeypatch.chdir(tmp_path)
+    write_dvc_yaml(tmp_path / "dvc.yaml")
+    os.makedirs("data")
+    os.makedirs("models")
+    write_parquet(downcast_dtypes(make_ohlcv(n_symbols=5, n_days=1500)), "data/get_data.parquet")
+
+    for stage in STAGES:
+        _, run = STAGE_RUNNERS[stage]
+        run(load_stage_config(stage))
+    expected = output_hashes()
+    for path in OUTPUTS:
+        os.remove(path)
+
+    run_all(STAGES)
+
+    assert output_hashes() == expected
+    assert os.path.exists("models/model.dill")
+    for stage in STAGES:
+        assert os.path.exists(f"metrics/{stage}.json")
+
+
+def test_main() -> None:
+    """Expected:
+    - comma separated stages and overrides given after them are parsed, overrides by stage
+    - unknown stage is rejected"""
+    argv = ["run_all", "--stages", "features,train", "train.cv.n_folds=3", "features.x=1"]
+    with patch("sys.argv", argv), patch(f"{run_all_module.__name__}.run_all") as mock_run_all:
+        main()
+    mock_run_all.assert_called_once_with(
+        ["features", "train"], {"train": ["cv.n_folds=3"], "features": ["x=1"]}, "dvc.yaml"
+    )
+
+    with patch("sys.argv", ["run_all", "--stages", "features,nope"]), pytest.raises(SystemExit):
+        main()
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from api.snapshot_store import SnapshotStore
+from src.snapshot import META_FILE, build_snapshot, load_snapshot, save_snapshot
+
+
+class MeanModel:
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        prob = X[["f1", "f2"]].mean(axis=1).to_numpy()
+        return np.column_stack([1 - prob, prob])
+
+
+def _features() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "Date": pd.to_datetime(["2020-01-02", "2020-01-01", "2020-01-01", "2020-01-03"]),
+            "Symbol": pd.Categorical(["B", "B", "A", "C"]),
+            "Close": np.float32([2, 1, 3, 4]),
+            "f1": np.float32([0.2, 0.1, 0.3, np.nan]),
+            "f2": np.float32([0.4, 0.3, 0.5, 0.6]),
+        }
+    )
+
+
+def test_snapshot(tmp_path) -> None:
+    """Expected:
+    - last row of each symbol is found by its symbol, with JSON record like API serves it
+    - probability of rows with all features predicted, NaN otherwise
+    - saved snapshot is memory mapped and replaced by newer version, removing old arrays"""
+    df = _features()
+    snapshot = build_snapshot(df, ["f1", "f2"], MeanModel(), "v1")
+
+    assert snapshot.symbols.tolist() == [b"A", b"B", b"C"]
+    assert snapshot.find("Z") is None and snapshot.find("") is None
+    row = snapshot.find("B")
+    assert snapshot.dates[row] == np.datetime64("2020-01-02")
+    assert f"[{snapshot.record(row)}]" == df.iloc[[0]].to_json(orient="records")
+    np.testing.assert_allclose(snapshot.probability, [0.4, 0.3, np.nan], rtol=1e-6)
+
+    path = str(tmp_path / "snapshot")
+    save_snapshot(snapshot, path)
+    loaded = load_snapshot(path)
+    assert isinstance(loaded.records, np.memmap)
+    assert loaded.record(loaded.find("C")) == snapshot.record(2)
+    assert loaded.model_version == "v1" and loaded.columns == ["f1", "f2"]
+
+    newer = build_snapshot(df.iloc[1:], ["f1", "f2"])
+    save_snapshot(newer, path)
+    assert load_snapshot(path).version == newer.version != snapshot.version
+    assert np.isnan(load_snapshot(path).probability).all()
+    assert len(os.listdir(path)) == 6
+
+
+def test_snapshot_store(tmp_path) -> None:
+    """Expected:
+    - missing snapshot gives None, saved one is loaded and reloaded once it changes"""
+    path = str(tmp_path / "snapshot")
+    store = SnapshotStore(path, check_interval=0)
+    assert store.get() is None
+
+    save_snapshot(build_snapshot(_features(), ["f1"]), path)
+    first = store.get()
+    assert first is not None and store.get() is first
+
+    save_snapshot(build_snapshot(_features().iloc[1:], ["f1"]), path)
+    os.utime(os.path.join(path, META_FILE), ns=(1_000, 1_000))
+    second = store.get()
+    assert second is not None and second.version != first.version
@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.pipeline.sweep import (
+    SweepConfig,
+    cached_matrices,
+    run_sweep,
+    rung_fractions,
+    validation_split,
+)
+
+
+def _config(tmp_path) -> SweepConfig:
+    rng = np.random.default_rng(0)
+    n_rows = 600
+    df = pd.DataFrame(
+        {
+            "Date": pd.bdate_range("2020-01-01", periods=n_rows),
+            "sma_50": rng.normal(size=n_rows).astype(np.float32),
+            "sma_100": rng.normal(size=n_rows).astype(np.float32),
+        }
+    )
+    df["target"] = (df["sma_50"] + rng.normal(scale=0.5, size=n_rows) > 0).astype(np.int8)
+    df["is_train"] = np.arange(n_rows) < 450
+    input_path = str(tmp_path / "dataset.parquet")
+    df.to_parquet(input_path)
+    return SweepConfig(
+        input_path=input_path,
+        output_path=str(tmp_path / "leaderboard.csv"),
+        cache_path=str(tmp_path / "cache"),
+        features=["sma_50", "sma_100"],
+        models={"tree": {"_target_": "sklearn.tree.DecisionTreeClassifier", "random_state": 0}},
+        search_space={"tree": {"max_depth": [1, 3, 5], "min_samples_leaf": [1, 20]}},
+        max_workers=2,
+        min_fraction=0.5,
+        eta=2,
+    )
+
+
+def test_sweep(tmp_path) -> None:
+    """Expected:
+    - train, validation and test matrices cached once and reused
+    - validation rows are the last dates of train split, after a gap
+    - gap defaults to target's look ahead days and can't be shorter
+    - all candidates evaluated on subsample, best half of them by validation score on all
+      training rows
+    - leaderboard starts with best candidate of the last rung by validation score"""
+    config = _config(tmp_path)
+    matrices_path = cached_matrices(config)
+    assert cached_matrices(config) == matrices_path
+    assert os.listdir(config.cache_path) == [os.path.basename(matrices_path)]
+
+    dates = np.repeat(pd.bdate_range("2020-01-01", periods=10).to_numpy(), 2)
+    is_train, is_validation = validation_split(dates, 0.2, 1)
+    assert (is_train == (np.arange(20) < 14)).all()
+    assert (is_validation == (np.arange(20) >= 16)).all()
+    assert config.gap == 1
+    assert SweepConfig(**{**vars(config), "gap": None, "look_ahead_days": 5}).gap == 5
+    with pytest.raises(ValueError):
+        SweepConfig(**{**vars(config), "gap": 2, "look_ahead_days": 5})
+
+    assert rung_fractions(config.min_fraction, config.eta) == [0.5, 1.0]
+    assert rung_fractions(0.1, 3) == [1 / 9, 1 / 3, 1.0]
+    leaderboard = run_sweep(config, matrices_path)
+
+    first_rung = leaderboard.loc[leaderboard["rung"] == 0]
+    last_rung = leaderboard.loc[leaderboard["rung"] == 1]
+    assert len(first_rung) == 6
+    assert (first_rung["train_rows"] == 179).all()
+    assert len(last_rung) == 3
+    assert (last_rung["train_rows"] == 359).all()
+    best = first_rung.nlargest(3, "validation_score")
+    assert set(last_rung["params"]) == set(best["params"])
+    assert leaderboard.iloc[0]["validation_score"] == last_rung["validation_score"].max()
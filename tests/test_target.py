@@ -29,3 +29,26 @@ def test_calculate_target() -> None:
     )
     res = calculate_target(df, 1).reset_index(drop=True)
     pd.testing.assert_frame_equal(res, expected)
+
+
+def test_calculate_target_horizons() -> None:
+    """Expected:
+    - one target column per number of days, same as shifting close within each symbol
+    - target is NaN where price after given days would be taken from the next symbol"""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "Symbol": np.repeat(["A", "B", "C"], [5, 2, 8]),
+            "Date": np.concatenate([np.arange(5), np.arange(2), np.arange(8)]),
+            "Close": rng.normal(size=15).astype(np.float32),
+        }
+    ).astype({"Symbol": "category"})
+
+    res = calculate_target(df, [1, 3])
+
+    assert list(res.columns) == ["Symbol", "Date", "Close", "target_1", "target_3"]
+    for days in [1, 3]:
+        close_shift = df.groupby("Symbol", observed=True)["Close"].shift(-days)
+        expected = (np.sign(close_shift - df["Close"]) + 1) / 2
+        pd.testing.assert_series_equal(res[f"target_{days}"], expected, check_names=False)
+    assert res["target_3"].isnull().sum() == 3 + 2 + 3
@@ -0,0 +1,53 @@
+import os
+
+import dill
+import numpy as np
+import pandas as pd
+
+from api.model_store import ModelStore
+from src.forest import META_FILE, NOT_COMPILED_FILE
+from src.pipeline.train import TrainConfig, run
+
+
+def _config(tmp_path, classifier: dict) -> TrainConfig:
+    rng = np.random.default_rng(0)
+    n_rows = 200
+    df = pd.DataFrame(
+        {
+            "Date": pd.bdate_range("2020-01-01", periods=n_rows),
+            "sma_50": rng.normal(size=n_rows).astype(np.float32),
+        }
+    )
+    df["target"] = (df["sma_50"] + rng.normal(scale=0.5, size=n_rows) > 0).astype(np.int8)
+    df["is_train"] = np.arange(n_rows) < 150
+    input_path = str(tmp_path / "dataset.parquet")
+    df.to_parquet(input_path)
+    return TrainConfig(
+        input_path=input_path,
+        model_path=str(tmp_path / "model.dill"),
+        metrics_path=str(tmp_path / "metrics.json"),
+        features=["sma_50"],
+        steps={
+            "selector": {"_target_": "src.model.ColumnSelector", "columns": ["sma_50"]},
+            "classifier": classifier,
+        },
+        forest_path=str(tmp_path / "forest"),
+    )
+
+
+def test_train_not_compiled(tmp_path) -> None:
+    """Expected:
+    - model that can't be compiled replaces compiled forest by a marker, keeping its directory
+    - model store then serves the pickled model"""
+    forest = {"_target_": "sklearn.ensemble.RandomForestClassifier", "n_estimators": 2}
+    run(_config(tmp_path, forest))
+    assert os.path.exists(tmp_path / "forest" / META_FILE)
+
+    config = _config(tmp_path, {"_target_": "sklearn.linear_model.LogisticRegression"})
+    model = run(config)
+    assert os.listdir(tmp_path / "forest") == [NOT_COMPILED_FILE]
+
+    loaded = ModelStore(config.model_path, forest_path=config.forest_path).get()
+    assert loaded.path == config.model_path
+    with open(config.model_path, "rb") as f:
+        assert type(dill.load(f)) is type(model)
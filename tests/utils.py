@@ -1,3 +1,7 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
 from hydra import compose, initialize
 from omegaconf import DictConfig
 
@@ -5,3 +9,43 @@ from omegaconf import DictConfig
 def load_config(config_name: str, overrides: list[str]) -> DictConfig:
     with initialize(config_path="../cofig", version_base=None):
         return compose(config_name, overrides=overrides)
+
+
+class FakeYahooFinance:
+    """Offline stand-in for `yf.download`, serving wide price frames shaped like
+    yahoo finance output from a fixed long format history. Requests containing a ticker
+    listed in `failures` raise an error until its failure count is used up."""
+
+    def __init__(self, history: pd.DataFrame, failures: Optional[dict[str, int]] = None) -> None:
+        self.history = history
+        self.failures = failures or {}
+        self.calls: list[tuple[list[str], str, str]] = []
+
+    def download(self, tickers: list[str], start: str, end: str, **kwargs) -> pd.DataFrame:
+        self.calls.append((list(tickers), start, end))
+        for ticker in tickers:
+            if self.failures.get(ticker, 0) > 0:
+                self.failures[ticker] -= 1
+                raise ConnectionError(f"Failed to download {ticker}")
+        fields = [col for col in self.history.columns if col not in ("Date", "Symbol")]
+        columns = pd.MultiIndex.from_product([fields, [t for t in tickers if t]])
+        return (
+            self.history.loc[
+                lambda x: x["Symbol"].isin(tickers) & (x["Date"] >= start) & (x["Date"] < end)
+            ]
+            .pivot(index="Date", columns="Symbol")
+            .reindex(columns=columns)
+        )
+
+
+def make_price_history(tickers: list[str], start: str, end: str) -> pd.DataFrame:
+    dates = pd.bdate_range(start, end, inclusive="left", name="Date")
+    return pd.concat(
+        [
+            pd.DataFrame(
+                {"Date": dates, "Symbol": ticker, "Close": 100.0 + i + np.arange(len(dates))}
+            )
+            for i, ticker in enumerate(tickers)
+        ],
+        ignore_index=True,
+    )
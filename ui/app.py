@@ -1,9 +1,57 @@
 import json
 import os
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
 
+import numpy as np
+import pandas as pd
 import requests
 import streamlit as st
 
+# Scores only change once a day, so they are reused for the same ticker and data date
+CACHE_TTL = 24 * 60 * 60
+
+
+class StaleScore(Exception):
+    """Score computed from data older than the last closed trading day"""
+
+    def __init__(self, resp: dict) -> None:
+        super().__init__(resp)
+        self.resp = resp
+
+
+def last_closed_day() -> date:
+    """Last closed trading day in exchange time zone, the latest date scores are computed from"""
+    today = datetime.now(ZoneInfo("America/New_York")).date()
+    return np.busday_offset(today, -1, roll="forward").astype(date)
+
+
+def data_date(resp: dict) -> date:
+    """Date of the bar score features were computed from"""
+    return pd.Timestamp(resp["features"][0]["Date"], unit="ms").date()
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=1000)
+def score(base_url: str, ticker: str, day: date) -> dict:
+    resp: dict = json.loads(requests.post(base_url + "/score", params={"ticker": ticker}).content)
+    if "err" in resp and "features" not in resp:
+        # Raised rather than returned, so that failed requests aren't cached
+        raise RuntimeError(resp["err"])
+    if resp.get("features") and data_date(resp) < day:
+        # Nor are scores of older data than the cache key's date, e.g. before the last close
+        # is available, so they are requested again instead of being served for the whole day
+        raise StaleScore(resp)
+    return resp
+
+
+def latest_score(base_url: str, ticker: str) -> dict:
+    """Score of ticker, cached by the date of data it should be computed from"""
+    try:
+        return score(base_url, ticker, last_closed_day())
+    except StaleScore as e:
+        return e.resp
+
+
 if __name__ == "__main__":
     # Define how to reach model endpoints
     host: str = os.getenv("MODEL_HOST", "127.0.0.1")
@@ -15,18 +63,21 @@ if __name__ == "__main__":
         clicked_predict: bool = st.button(label="Predict")
 
         if clicked_predict:
-            validate_request_url = base_url + f"/validate?ticker={ticker}"
-            validate_resp: dict = json.loads(requests.post(validate_request_url).content)
-            if validate_resp["ticker"] == "Not found!":
+            score_resp: dict = latest_score(base_url, ticker.upper())
+            if score_resp.get("ticker") == "Not found!":
                 st.write(f"Ticker {ticker} not found!")
             else:
-                features_request_url = base_url + f"/features?ticker={ticker}"
-                features_resp: str = json.loads(requests.post(features_request_url).content)
-                st.write(features_resp)
-
-                predict_request_url = base_url + f"/predict?features={features_resp}"
-                predict_resp: str = json.loads(requests.post(predict_request_url).content)
-                st.write(predict_resp)
+                if "features" in score_resp:
+                    st.write(score_resp["features"])
+                if "err" in score_resp:
+                    st.error(score_resp["err"])
+                else:
+                    st.write(
+                        {
+                            "probability": score_resp["probability"],
+                            "model_version": score_resp["model_version"],
+                        }
+                    )
 
     except Exception as e:
         st.error(e)